@@ -0,0 +1,161 @@
+"""
+Стресс-тест общей сессии API
+
+Поднимает локальную заглушку бэкенда и выполняет одновременные запросы
+разных пользователей (привычки на сегодня, настройки, привычка по id,
+отметка выполнения). Заглушка проверяет заголовок Authorization каждого
+запроса и отдаёт данные только владельцу токена, поэтому ошибки сессии
+("Session is closed", "Connector is closed") и перепутанные между
+пользователями токены видны как ошибки. У части пользователей токен
+истёк: на них проверяется обновление токена посреди чужих запросов.
+
+Использование:
+    python -m benchmarks.api_stress [количество запросов] [пользователей]
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+from aiohttp import web
+
+HOST = "127.0.0.1"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def habit_ids(telegram_id: int):
+    return telegram_id * 10 + 1, telegram_id * 10 + 2
+
+
+def notify_time(telegram_id: int) -> str:
+    return f"{telegram_id // 60 % 24:02d}:{telegram_id % 60:02d}"
+
+
+def make_backend(users: int) -> web.Application:
+    tokens = {f"a{i}": i for i in range(1, users + 1)}
+
+    def owner(request: web.Request) -> int:
+        user = tokens.get(request.headers.get("Authorization", "").removeprefix("Bearer "))
+        if user is None:
+            raise web.HTTPUnauthorized()
+        return user
+
+    def habit(user: int, habit_id: int, is_done: bool = False) -> dict:
+        return {"id": habit_id, "title": f"user{user}", "type": "count", "value": 1,
+                "unit": "раз", "is_done": is_done, "series": 0}
+
+    def own_habit(request: web.Request) -> tuple:
+        user = owner(request)
+        habit_id = int(request.match_info["id"])
+        if habit_id not in habit_ids(user):
+            raise web.HTTPForbidden()
+        return user, habit_id
+
+    async def habits(request: web.Request):
+        user = owner(request)
+        return web.json_response([habit(user, habit_id) for habit_id in habit_ids(user)])
+
+    async def get_habit(request: web.Request):
+        return web.json_response(habit(*own_habit(request)))
+
+    async def patch_habit(request: web.Request):
+        user, habit_id = own_habit(request)
+        body = await request.json()
+        return web.json_response(habit(user, habit_id, body.get("is_done", False)))
+
+    async def settings(request: web.Request):
+        user = owner(request)
+        return web.json_response({"user_id": 1000 + user, "timezone": "Europe/Moscow",
+                                  "do_not_disturb": False, "notify_times": [notify_time(user)]})
+
+    async def refresh(request: web.Request):
+        body = await request.json()
+        refresh_token = body.get("refresh_token", "")
+        if not refresh_token.startswith("r"):
+            raise web.HTTPUnauthorized()
+        return web.json_response({"access_token": f"a{refresh_token[1:]}"})
+
+    app = web.Application()
+    app.router.add_get("/habits", habits)
+    app.router.add_get("/habits/{id}", get_habit)
+    app.router.add_patch("/habits/{id}", patch_habit)
+    app.router.add_get("/user/me/settings", settings)
+    app.router.add_post("/auth/getaccesstoken", refresh)
+    return app
+
+
+async def request(api, n: int, users: int):
+    """Один запрос пользователя n % users + 1; возвращает описание ошибки или None"""
+    telegram_id = n % users + 1
+    params = {"telegram_id": telegram_id, "username": f"user{telegram_id}"}
+    kind = n % 4
+    if kind == 0:
+        habits = (await api.get("/habits/today", params=params))["habits"]
+        owners = {h.get("name") for h in habits}
+    elif kind == 1:
+        morning_time = (await api.get("/telegram/settings", params=params))["settings"]["morning_time"]
+        owners = {f"user{telegram_id}" if morning_time == notify_time(telegram_id) else morning_time}
+    elif kind == 2:
+        habit_id = habit_ids(telegram_id)[n % 2]
+        owners = {(await api.get(f"/habits/{habit_id}", params=params))["habit"].get("name")}
+    else:
+        habit_id = habit_ids(telegram_id)[n % 2]
+        result = await api.post("/habits/complete", {**params, "habit_id": habit_id})
+        owners = {result["habit"].get("name")}
+    if owners != {f"user{telegram_id}"}:
+        return f"чужие данные для {telegram_id}: {owners}"
+    return None
+
+
+async def run(total: int, users: int) -> int:
+    from services.api import api
+    from services.token_storage import token_storage
+
+    for i in range(1, users + 1):
+        # у каждого пятого пользователя токен истёк и будет обновлён во время теста
+        await token_storage.save_tokens(i, f"x{i}" if i % 5 == 0 else f"a{i}", f"r{i}", 1000 + i, f"user{i}")
+    await token_storage.flush()
+
+    runner = web.AppRunner(make_backend(users))
+    await runner.setup()
+    port = int(api.base_url.rsplit(":", 1)[1])
+    await web.TCPSite(runner, HOST, port).start()
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(request(api, n, users) for n in range(total)), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+    finally:
+        await api.close()
+        await runner.cleanup()
+        await token_storage.flush()
+
+    errors = [str(result) for result in results if result is not None]
+    session_errors = [error for error in errors if "closed" in error.lower()]
+    print(f"{total} запросов от {users} пользователей за {elapsed * 1000:.1f} мс: "
+          f"ошибок {len(errors)}, из них ошибок сессии {len(session_errors)}")
+    for error in errors[:5]:
+        print(f"  {error}")
+    return len(errors)
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    # config и token_storage читают окружение и data/ при импорте
+    os.environ["BACKEND_URL"] = f"http://{HOST}:{free_port()}"
+    os.environ.setdefault("BOT_TOKEN", "0:stress")
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        errors = asyncio.run(run(total, users))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
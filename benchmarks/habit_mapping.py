@@ -0,0 +1,91 @@
+"""
+Микробенчмарк преобразования привычек из ответа бэкенда
+
+Сравнивает прежнее построение словаря на каждую привычку с Habit.from_backend:
+время на один список и количество выделенной памяти.
+
+Использование:
+    python -m benchmarks.habit_mapping
+"""
+import timeit
+import tracemalloc
+from services.models import Habit
+
+
+def legacy_map_habit(h):
+    habit_type = h.get("type", "count")
+    bot_type = "quantity" if habit_type in ("time", "count") else "boolean"
+
+    value = h.get("value", 0) or 0
+    is_done = h.get("is_done", False)
+    unit = h.get("unit") or ""
+
+    backend_progress = h.get("progress") or h.get("current_value") or (value if is_done else 0)
+
+    display_value = value
+    display_progress = backend_progress
+    display_unit = unit
+    if unit == "минут" and value >= 60 and value % 60 == 0:
+        display_value = value / 60
+        display_progress = backend_progress / 60
+        display_unit = "часов"
+
+    return {
+        "id": h.get("id"),
+        "name": h.get("title", "Привычка"),
+        "emoji": "📌",
+        "progress": display_progress,
+        "goal": display_value,
+        "unit": display_unit,
+        "completed": is_done,
+        "type": bot_type,
+        "streak": h.get("series", 0),
+        "reminder_settings": {
+            "enabled": True,
+            "time": "18:00",
+            "days": ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"],
+        },
+    }
+
+
+def make_payload(count: int = 30) -> list:
+    units = ["минут", "страниц", "литров", "", "минут"]
+    return [
+        {
+            "id": i,
+            "title": f"Привычка {i}",
+            "format": "time" if i % 2 else "count",
+            "type": "count",
+            "value": 60 * (i % 3 + 1) if units[i % 5] == "минут" else 10,
+            "unit": units[i % 5],
+            "is_done": i % 3 == 0,
+            "series": i % 7,
+            "is_active": True,
+        }
+        for i in range(count)
+    ]
+
+
+def measure_allocations(mapper, payload) -> int:
+    tracemalloc.start()
+    result = [mapper(h) for h in payload]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    payload = make_payload()
+    number = 2000
+
+    for name, mapper in (("dict", legacy_map_habit), ("Habit", Habit.from_backend)):
+        seconds = min(timeit.repeat(lambda: [mapper(h) for h in payload], number=number, repeat=5))
+        per_list = seconds / number * 1e6
+        allocated = measure_allocations(mapper, payload)
+        print(f"{name:>6}: {per_list:8.1f} мкс на список из {len(payload)}, "
+              f"{allocated / 1024:7.1f} КиБ на список")
+
+
+if __name__ == "__main__":
+    main()
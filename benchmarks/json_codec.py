@@ -0,0 +1,45 @@
+"""
+Бенчмарк JSON-кодека на типичных ответах бэкенда
+
+Сравнивает стандартный json с кодеком utils.json_codec (orjson/ujson,
+если установлены) на списке привычек и настройках пользователя.
+
+Использование:
+    python -m benchmarks.json_codec
+"""
+import json
+import timeit
+from benchmarks.habit_mapping import make_payload
+from utils import json_codec
+
+
+SETTINGS_PAYLOAD = {
+    "user_id": 42,
+    "timezone": "Europe/Moscow",
+    "do_not_disturb": False,
+    "notify_times": ["08:00", "13:30", "21:00"],
+}
+
+
+def bench(name: str, loads, dumps, payload, number: int) -> None:
+    raw = json.dumps(payload, ensure_ascii=False)
+    decode = min(timeit.repeat(lambda: loads(raw), number=number, repeat=5)) / number * 1e6
+    encode = min(timeit.repeat(lambda: dumps(payload), number=number, repeat=5)) / number * 1e6
+    print(f"  {name:>8}: decode {decode:7.2f} мкс, encode {encode:7.2f} мкс ({len(raw.encode())} байт)")
+
+
+def main():
+    payloads = (
+        ("привычки (30)", make_payload(30), 2000),
+        ("привычки (200)", make_payload(200), 300),
+        ("настройки", SETTINGS_PAYLOAD, 20000),
+    )
+    print(f"Кодек: {json_codec.BACKEND}")
+    for title, payload, number in payloads:
+        print(title)
+        bench("json", json.loads, json.dumps, payload, number)
+        bench(json_codec.BACKEND, json_codec.loads, json_codec.dumps, payload, number)
+
+
+if __name__ == "__main__":
+    main()
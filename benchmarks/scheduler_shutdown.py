@@ -0,0 +1,88 @@
+"""
+Проверка остановки планировщика посреди пачки напоминаний
+
+Кладёт в кучу пачку уже наступивших слотов, отправка каждого из которых
+занимает send_delay секунд, и останавливает планировщик с таймаутом меньше
+времени отправки всей пачки. Цикл отменяется посреди пачки; сохранённая
+отметка шарда не должна уйти дальше первого неотправленного слота, иначе
+после перезапуска эти напоминания не будут досланы.
+
+Использование:
+    python -m benchmarks.scheduler_shutdown [слотов] [время отправки, с] [таймаут остановки, с]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+
+class SlowBot:
+    def __init__(self, send_delay: float):
+        self.send_delay = send_delay
+        self.sent = set()
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        await asyncio.sleep(self.send_delay)
+        self.sent.add(chat_id)
+
+
+async def run(total: int, send_delay: float, timeout: float) -> bool:
+    import pytz
+    from services.notification_scheduler import NotificationScheduler, UserSchedule
+
+    bot = SlowBot(send_delay)
+    scheduler = NotificationScheduler(bot)
+    await scheduler.shards.renew()
+    scheduler.running = True
+    scheduler._ready_shards = set(scheduler.shards.owned)
+
+    loop = asyncio.get_running_loop()
+    now = time.time()
+    fire_times = {}
+    for telegram_id in range(1, total + 1):
+        fire_ts = now - 60 + telegram_id * 0.15
+        local = datetime.fromtimestamp(fire_ts, pytz.UTC)
+        slot = local.strftime("%H:%M")
+        scheduler._generation += 1
+        scheduler._schedules[telegram_id] = UserSchedule((slot,), pytz.UTC, False, {}, scheduler._generation)
+        scheduler._heap.append((fire_ts, telegram_id, scheduler._generation, slot, local.date()))
+        future = loop.create_future()
+        future.set_result("⏰ Напоминание")
+        scheduler._prepared[(telegram_id, slot, local.date())] = (fire_ts, future)
+        fire_times[telegram_id] = fire_ts
+    scheduler._heap.sort()
+
+    scheduler._tasks = [asyncio.create_task(scheduler._scheduler_loop())]
+    await asyncio.sleep(0)
+    await scheduler.stop(timeout=timeout)
+
+    watermark = (await scheduler.shards.get_watermarks()).get(0)
+    unsent = [fire_times[t] for t in fire_times if t not in bot.sent]
+    print(f"слотов {total}: отправлено {len(bot.sent)}, не отправлено {len(unsent)}")
+    if not unsent:
+        print("пачка успела отправиться целиком, уменьшите таймаут")
+        return True
+    earliest = min(unsent)
+    print(f"отметка {watermark:.3f}, первый неотправленный слот {earliest:.3f}")
+    if watermark is None or watermark >= earliest:
+        print("ОШИБКА: отметка ушла дальше неотправленных слотов, они будут потеряны")
+        return False
+    return True
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    send_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    timeout = float(sys.argv[3]) if len(sys.argv) > 3 else 0.3
+    os.environ.setdefault("BOT_TOKEN", "0:shutdown")
+    sys.path.insert(0, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        ok = asyncio.run(run(total, send_delay, timeout))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Бенчмарк всплеска обновлений токенов в TokenStorage
+
+Сравнивает прежнее чтение-изменение-запись (SELECT и INSERT OR REPLACE всей
+строки в двух соединениях) с точечными UPDATE и UPSERT во временной базе,
+а также с отложенной пакетной записью (write-behind).
+
+Использование:
+    python -m benchmarks.token_refresh [количество пользователей] [одновременных запросов]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import aiosqlite
+from services.token_storage import TokenStorage
+
+
+class LegacyTokenStorage(TokenStorage):
+    async def _save_tokens_data(self, telegram_id: int, tokens_data: dict):
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO tokens
+                (bot_id, telegram_id, access_token, refresh_token, user_id, username, first_name, last_name, photo_url)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                self.bot_id,
+                telegram_id,
+                tokens_data.get("access_token"),
+                tokens_data.get("refresh_token"),
+                tokens_data.get("user_id"),
+                tokens_data.get("username"),
+                tokens_data.get("first_name"),
+                tokens_data.get("last_name"),
+                tokens_data.get("photo_url")
+            ))
+            await db.commit()
+
+    async def update_tokens(self, telegram_id: int, access_token: str, refresh_token: str):
+        tokens_data = await self._get_tokens_data(telegram_id)
+        if tokens_data:
+            tokens_data["access_token"] = access_token
+            tokens_data["refresh_token"] = refresh_token
+            await self._save_tokens_data(telegram_id, tokens_data)
+
+    async def save_tokens(self, telegram_id: int, access_token: str, refresh_token: str, user_id=None,
+                          username=None, first_name=None, last_name=None, photo_url=None):
+        tokens_data = await self._get_tokens_data(telegram_id) or {}
+        tokens_data.update({"access_token": access_token, "refresh_token": refresh_token, "user_id": user_id})
+        for key, value in (("username", username), ("first_name", first_name),
+                           ("last_name", last_name), ("photo_url", photo_url)):
+            if value is not None:
+                tokens_data[key] = value
+        await self._save_tokens_data(telegram_id, tokens_data)
+
+
+async def seed(storage: TokenStorage, users: int):
+    await storage._init_db()
+    async with aiosqlite.connect(storage.db_path) as db:
+        await db.executemany(
+            "INSERT INTO tokens (bot_id, telegram_id, access_token, refresh_token, user_id, username, first_name) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(storage.bot_id, i, f"a{i}", f"r{i}", 1000 + i, f"user{i}", "Имя") for i in range(users)]
+        )
+        await db.commit()
+
+
+async def bounded(calls, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(factory):
+        async with semaphore:
+            await factory()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(call(factory) for factory in calls))
+    return time.perf_counter() - started
+
+
+async def burst(storage: TokenStorage, users: int, concurrency: int) -> float:
+    return await bounded(
+        [lambda i=i: storage.update_tokens(i, f"a{i}-new", f"r{i}-new") for i in range(users)],
+        concurrency
+    )
+
+
+async def reregister(storage: TokenStorage, users: int, concurrency: int) -> float:
+    return await bounded(
+        [lambda i=i: storage.save_tokens(i, f"a{i}-re", f"r{i}-re", 1000 + i) for i in range(users)],
+        concurrency
+    )
+
+
+async def timed_flush(storage: TokenStorage) -> float:
+    started = time.perf_counter()
+    await storage.flush()
+    return time.perf_counter() - started
+
+
+async def run(users: int, concurrency: int):
+    variants = (
+        ("legacy", LegacyTokenStorage, 0),
+        ("upsert", TokenStorage, 0),
+        ("behind", TokenStorage, 50),
+    )
+    for name, cls, write_delay_ms in variants:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = cls(db_path=os.path.join(tmp, "tokens.db"), bot_id=1, write_delay_ms=write_delay_ms)
+            await seed(storage, users)
+            refresh = await burst(storage, users, concurrency)
+            save = await reregister(storage, users, concurrency)
+            save += await timed_flush(storage)
+            tokens = await storage.get_tokens(users - 1)
+            assert tokens["username"] == f"user{users - 1}" and tokens["access_token"].endswith("-re")
+        print(f"{name:>6}: update_tokens {refresh * 1000:8.1f} мс, save_tokens {save * 1000:8.1f} мс "
+              f"на {users} пользователей, {concurrency} одновременно")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    asyncio.run(run(users, concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,181 @@
+import time
+
+STARTED_AT = time.perf_counter()
+
 import asyncio
 import logging
 import sys
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN, BACKEND_URL, NOTIFICATION_SERVER_HOST, NOTIFICATION_SERVER_PORT
+from aiogram.client.session.aiohttp import AiohttpSession
+from config import (
+    BOT_TOKEN, BACKEND_URL, NOTIFICATION_SERVER_HOST, NOTIFICATION_SERVER_PORT, SHUTDOWN_TIMEOUT,
+    LOG_LEVEL, LOG_FORMAT, LOOP_SLOW_CALLBACK_MS
+)
+from services import background
 from services.api import api
-from services.token_storage import TokenStorage
-from services.notification_server import NotificationServer
-from services.notification_scheduler import NotificationScheduler
+from services.fsm_storage import CompactMemoryStorage
+from services.habit_history import habit_history
+from services.progress_aggregates import progress_aggregates
+from services.profiler import LoopWatchdog
+from services.token_storage import token_storage
+from utils import json_codec
+from utils.logging_setup import setup_logging
 
-from handlers import start, main_menu, habits_today, habit_actions, habit_manage, settings, profile, notifications
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+setup_logging(LOG_LEVEL, LOG_FORMAT)
 
 logger = logging.getLogger(__name__)
 
 
-async def main():
-    if not BOT_TOKEN:
-        raise ValueError("BOT_TOKEN не задан! Проверь .env файл")
+def load_routers() -> list:
+    from handlers import start, main_menu, habits_today, habit_actions, habit_manage, settings, profile, notifications
+    return [
+        start.router,
+        main_menu.router,
+        habits_today.router,
+        habit_actions.router,
+        habit_manage.router,
+        settings.router,
+        profile.router,
+        notifications.router,
+    ]
 
-    bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    
-    from middleware.throttling import ThrottlingMiddleware
-    dp.message.middleware(ThrottlingMiddleware(rate_limit=1.0))
-    dp.callback_query.middleware(ThrottlingMiddleware(rate_limit=0.5))
-    
-    bot_info = await bot.get_me()
-    from services import token_storage as token_storage_module
-    token_storage_module.token_storage = TokenStorage(bot_id=bot_info.id)
-    await token_storage_module.token_storage._init_db()
-    
-    await api.check_connection()
-    dp.include_router(start.router)
-    dp.include_router(main_menu.router)
-    dp.include_router(habits_today.router)
-    dp.include_router(habit_actions.router)
-    dp.include_router(habit_manage.router)
-    dp.include_router(settings.router)
-    dp.include_router(profile.router)
-    dp.include_router(notifications.router)
-
-    notification_server = None
-    notification_scheduler = None
-    
+
+async def start_notification_server(bot: Bot):
     try:
+        from services.notification_server import NotificationServer
         notification_server = NotificationServer(
             bot=bot,
             host=NOTIFICATION_SERVER_HOST,
-            port=NOTIFICATION_SERVER_PORT
+            port=NOTIFICATION_SERVER_PORT,
+            shutdown_timeout=SHUTDOWN_TIMEOUT / 2
         )
         await notification_server.start()
+        return notification_server
     except Exception as e:
         logger.error(f"Ошибка при запуске HTTP сервера уведомлений: {e}", exc_info=True)
         logger.warning("Бот будет работать без HTTP сервера уведомлений")
-    
+        return None
+
+
+async def start_notification_scheduler(bot: Bot):
     try:
+        from services.notification_scheduler import NotificationScheduler
         notification_scheduler = NotificationScheduler(bot=bot, check_interval=10)
         await notification_scheduler.start()
+        return notification_scheduler
     except Exception as e:
         logger.error(f"Ошибка при запуске планировщика уведомлений: {e}", exc_info=True)
+        return None
+
+
+async def start_services(bot: Bot):
+    """Привязать хранилище к боту, затем запустить сервер и планировщик уведомлений"""
+    bot_info = await bot.get_me()
+    await token_storage.configure(bot_info.id)
+    return await asyncio.gather(
+        start_notification_server(bot),
+        start_notification_scheduler(bot)
+    )
+
+
+async def main(routers: list):
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN не задан! Проверь .env файл")
+
+    from middleware.throttling import ThrottlingMiddleware
+    from middleware.startup_timer import FirstUpdateTimerMiddleware
+    from middleware.tracing import TracingMiddleware, HandlerTracingMiddleware, TelegramTracingMiddleware
+
+    watchdog = LoopWatchdog(LOOP_SLOW_CALLBACK_MS)
+    watchdog.start()
+
+    session = AiohttpSession(json_loads=json_codec.loads, json_dumps=json_codec.dumps)
+    session.middleware(TelegramTracingMiddleware())
+    bot = Bot(token=BOT_TOKEN, session=session)
+    storage = CompactMemoryStorage()
+    dp = Dispatcher(storage=storage)
+    
+    dp.update.outer_middleware(FirstUpdateTimerMiddleware(STARTED_AT))
+    dp.update.outer_middleware(TracingMiddleware())
+    dp.message.middleware(ThrottlingMiddleware(rate_limit=1.0, name="message"))
+    dp.callback_query.middleware(ThrottlingMiddleware(rate_limit=0.5, name="callback"))
+    dp.message.middleware(HandlerTracingMiddleware())
+    dp.callback_query.middleware(HandlerTracingMiddleware())
+    
+    # Независимые сетевые шаги запуска (Telegram и бэкенд) идут параллельно
+    (notification_server, notification_scheduler), _ = await asyncio.gather(
+        start_services(bot),
+        api.check_connection()
+    )
+    for router in routers:
+        dp.include_router(router)
+    
+    logger.info(f"Бот готов к приёму обновлений через {time.perf_counter() - STARTED_AT:.2f} с после запуска")
 
     try:
-        await dp.start_polling(bot, handle_as_tasks=True)
+        await dp.start_polling(bot, handle_as_tasks=True, close_bot_session=False)
     except Exception as e:
         logger.error(f"Ошибка при работе бота: {e}", exc_info=True)
     finally:
+        await shutdown(dp, bot, notification_server, notification_scheduler)
+        await watchdog.stop()
+
+
+async def shutdown(dp: Dispatcher, bot: Bot, notification_server, notification_scheduler):
+    """
+    Остановка с дедлайном SHUTDOWN_TIMEOUT: перестать принимать работу, дождаться
+    начатых обработчиков, запросов /notify и отправок планировщика, затем
+    сохранить отложенные записи и закрыть соединения
+    """
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+    def remaining() -> float:
+        return max(0.0, deadline - time.monotonic())
+
+    logger.info(f"Остановка бота: завершаем начатую работу (не дольше {SHUTDOWN_TIMEOUT:.0f} с)")
+
+    async def stop_scheduler():
         if notification_scheduler:
             try:
-                await notification_scheduler.stop()
+                await notification_scheduler.stop(timeout=remaining())
             except Exception as e:
                 logger.error(f"Ошибка при остановке планировщика: {e}")
+
+    async def stop_server():
         if notification_server:
             try:
                 await notification_server.stop()
             except Exception as e:
                 logger.error(f"Ошибка при остановке HTTP сервера: {e}")
-        await api.close()
-        await bot.session.close()
+
+    await asyncio.gather(
+        stop_scheduler(),
+        stop_server(),
+        background.wait_tasks(set(dp._handle_update_tasks), remaining(), "Обработчики обновлений")
+    )
+    await background.drain(remaining())
+
+    try:
+        await token_storage.flush()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении токенов: {e}")
+    try:
+        await habit_history.flush()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении истории привычек: {e}")
+    try:
+        await progress_aggregates.flush()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении агрегатов прогресса: {e}")
+    await api.close()
+    await bot.session.close()
+    logger.info("Бот остановлен")
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # Обработчики импортируются в основном потоке до запуска цикла событий:
+        # импорт из рабочего потока параллельно с основным рискует блокировкой импорта
+        asyncio.run(main(load_routers()))
     except KeyboardInterrupt:
         pass
     except Exception as e:
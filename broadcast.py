@@ -14,43 +14,31 @@ import os
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from dotenv import load_dotenv
-import aiosqlite
+from services.token_storage import TokenStorage
+from utils.logging_setup import setup_logging
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Настройка логирования: запись в stdout идёт в отдельном потоке
+setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "text"))
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_PATH = "data/tokens.db"
+USERS_BATCH_SIZE = int(os.getenv("USERS_BATCH_SIZE", "500"))
 
+storage = TokenStorage(db_path=DB_PATH)
 
-async def get_all_users():
-    """Получить список всех пользователей из базы данных"""
-    users = []
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT telegram_id, first_name, username FROM tokens"
-            )
-            rows = await cursor.fetchall()
-            for row in rows:
-                users.append({
-                    "telegram_id": row[0],
-                    "first_name": row[1] or "Пользователь",
-                    "username": row[2] or None
-                })
-        logger.info(f"Найдено {len(users)} пользователей в базе данных")
-        return users
-    except Exception as e:
-        logger.error(f"Ошибка при получении списка пользователей: {e}")
-        return []
+
+async def iter_users():
+    """Потоково перебрать пользователей из базы данных пачками по USERS_BATCH_SIZE"""
+    async for telegram_id, user_data in storage.iter_users(USERS_BATCH_SIZE):
+        yield {
+            "telegram_id": telegram_id,
+            "first_name": user_data["first_name"] or "Пользователь",
+            "username": user_data["username"] or None
+        }
 
 
 async def send_message_to_user(bot: Bot, telegram_id: int, message_text: str, user_info: dict):
@@ -61,16 +49,16 @@ async def send_message_to_user(bot: Bot, telegram_id: int, message_text: str, us
             text=message_text,
             parse_mode="HTML"
         )
-        logger.info(f"✅ Сообщение отправлено пользователю {telegram_id} ({user_info['first_name']})")
+        logger.info("✅ Сообщение отправлено пользователю %s (%s)", telegram_id, user_info['first_name'], extra={"sample": 100})
         return True
     except TelegramForbiddenError:
-        logger.warning(f"❌ Пользователь {telegram_id} ({user_info['first_name']}) заблокировал бота")
+        logger.warning("❌ Пользователь %s (%s) заблокировал бота", telegram_id, user_info['first_name'])
         return False
     except TelegramBadRequest as e:
-        logger.warning(f"❌ Ошибка при отправке пользователю {telegram_id}: {e}")
+        logger.warning("❌ Ошибка при отправке пользователю %s: %s", telegram_id, e)
         return False
     except Exception as e:
-        logger.error(f"❌ Неожиданная ошибка при отправке пользователю {telegram_id}: {e}")
+        logger.error("❌ Неожиданная ошибка при отправке пользователю %s: %s", telegram_id, e)
         return False
 
 
@@ -89,14 +77,22 @@ async def broadcast_message(message_text: str, delay: float = 0.05):
     bot = Bot(token=BOT_TOKEN)
     
     try:
-        # Получаем список всех пользователей
-        users = await get_all_users()
+        bot_info = await bot.get_me()
+        await storage.configure(bot_info.id)
+        
+        # Считаем пользователей, сам список читается пачками во время рассылки
+        try:
+            total = await storage.count_users()
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка пользователей: {e}")
+            return
+        logger.info(f"Найдено {total} пользователей в базе данных")
         
-        if not users:
+        if not total:
             logger.warning("Не найдено пользователей для рассылки")
             return
         
-        logger.info(f"Начинаем рассылку сообщения {len(users)} пользователям...")
+        logger.info(f"Начинаем рассылку сообщения {total} пользователям...")
         logger.info(f"Текст сообщения: {message_text[:50]}...")
         
         # Статистика
@@ -105,9 +101,11 @@ async def broadcast_message(message_text: str, delay: float = 0.05):
         blocked_count = 0
         
         # Отправляем сообщения
-        for i, user in enumerate(users, 1):
+        i = 0
+        async for user in iter_users():
+            i += 1
             telegram_id = user["telegram_id"]
-            logger.info(f"[{i}/{len(users)}] Отправка пользователю {telegram_id} ({user['first_name']})...")
+            logger.info("[%s/%s] Отправка пользователю %s (%s)...", i, total, telegram_id, user['first_name'], extra={"sample": 100})
             
             result = await send_message_to_user(bot, telegram_id, message_text, user)
             
@@ -122,7 +120,7 @@ async def broadcast_message(message_text: str, delay: float = 0.05):
                     blocked_count += 1
             
             # Задержка между отправками для избежания rate limit
-            if i < len(users):
+            if i < total:
                 await asyncio.sleep(delay)
         
         # Итоговая статистика
@@ -131,7 +129,7 @@ async def broadcast_message(message_text: str, delay: float = 0.05):
         logger.info(f"✅ Успешно отправлено: {success_count}")
         logger.info(f"❌ Ошибок: {failed_count}")
         logger.info(f"🚫 Заблокировали бота: {blocked_count}")
-        logger.info(f"📈 Всего пользователей: {len(users)}")
+        logger.info(f"📈 Всего пользователей: {i}")
         logger.info("="*50)
         
     except Exception as e:
@@ -8,6 +8,25 @@ BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 BACKEND_USER_ID = os.getenv("BACKEND_USER_ID")
 BACKEND_ACCESS_TOKEN = os.getenv("BACKEND_ACCESS_TOKEN")
 BACKEND_REFRESH_TOKEN = os.getenv("BACKEND_REFRESH_TOKEN")
+BACKEND_BATCH_PATH = os.getenv("BACKEND_BATCH_PATH", "")
+BACKEND_BATCH_CONCURRENCY = int(os.getenv("BACKEND_BATCH_CONCURRENCY", "16"))
 WEB_APP_URL = os.getenv("WEB_APP_URL", "https://daily-routine.ru")
 NOTIFICATION_SERVER_HOST = os.getenv("NOTIFICATION_SERVER_HOST", "0.0.0.0")
-NOTIFICATION_SERVER_PORT = int(os.getenv("NOTIFICATION_SERVER_PORT", "8080"))
\ No newline at end of file
+NOTIFICATION_SERVER_PORT = int(os.getenv("NOTIFICATION_SERVER_PORT", "8080"))
+SCHEDULER_SHARDS = int(os.getenv("SCHEDULER_SHARDS", "1"))
+SCHEDULER_WORKER_ID = os.getenv("SCHEDULER_WORKER_ID")
+SCHEDULER_LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", "30"))
+SCHEDULER_REFRESH_INTERVAL = float(os.getenv("SCHEDULER_REFRESH_INTERVAL", "300"))
+SCHEDULER_CATCHUP_MAX_AGE = float(os.getenv("SCHEDULER_CATCHUP_MAX_AGE", "7200"))
+SCHEDULER_CATCHUP_RATE = max(0.0, float(os.getenv("SCHEDULER_CATCHUP_RATE", "5")))
+SCHEDULER_PREFETCH_SECONDS = float(os.getenv("SCHEDULER_PREFETCH_SECONDS", "5"))
+USERS_BATCH_SIZE = int(os.getenv("USERS_BATCH_SIZE", "500"))
+PROGRESS_MAX_AGE = float(os.getenv("PROGRESS_MAX_AGE", "300"))
+TOKEN_WRITE_DELAY_MS = float(os.getenv("TOKEN_WRITE_DELAY_MS", "50"))
+TOKEN_WRITE_BATCH = int(os.getenv("TOKEN_WRITE_BATCH", "200"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+TRACE_SLOW_UPDATE_MS = float(os.getenv("TRACE_SLOW_UPDATE_MS", "2000"))
+LOOP_SLOW_CALLBACK_MS = float(os.getenv("LOOP_SLOW_CALLBACK_MS", "100"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
@@ -1,9 +1,17 @@
-from aiogram import Router, types
+import asyncio
+from functools import partial
+from typing import Dict, Optional, Tuple
+from aiogram import Bot, Router, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from services import background
 from services.api import api
+from services.metrics import metrics
 from utils.helpers import get_user_photo_url
+from utils.render_cache import edit_text
+from keyboards.factory import cached_keyboard
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,6 +23,7 @@ class HabitCompleteStates(StatesGroup):
     waiting_for_amount = State()
 
 
+@cached_keyboard()
 def get_complete_keyboard(habit_id: int, has_quantity: bool):
     keyboard = []
     if has_quantity:
@@ -26,6 +35,137 @@ def get_complete_keyboard(habit_id: int, has_quantity: bool):
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@cached_keyboard()
+def get_completed_keyboard(habit_id: str, completed: bool):
+    keyboard = [[InlineKeyboardButton(text="🔙 Назад", callback_data="back_today")]]
+    if completed:
+        keyboard.insert(0, [InlineKeyboardButton(text="❌ Отменить выполнение", callback_data=f"habit_undo:{habit_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def has_quantity_input(habit) -> bool:
+    unit = habit.get("unit", "")
+    if habit.get("type", "boolean") != "quantity":
+        return False
+    return bool(unit and unit.strip()) or habit.get("goal", 0) > 1
+
+
+def render_completion(habit, streak: int, progress=None, goal=None, unit=None) -> str:
+    name = habit.get("name", "Привычка")
+    if habit.get("type", "boolean") == "quantity":
+        text = f"✅ <b>Привычка \"{name}\" выполнена полностью!</b>\n\n"
+        text += f"📊 Прогресс: <b>{progress} / {goal} {unit}</b> (100%)\n"
+        if streak > 0:
+            text += f"🔥 Текущая серия: <b>{streak} дней</b> подряд"
+        return text
+    text = f"✅ <b>Привычка \"{name}\" выполнена!</b>\n\n"
+    if streak > 0:
+        text += f"🔥 Текущая серия: <b>{streak} дней</b> подряд"
+    else:
+        text += "🎉 Отличная работа!"
+    return text
+
+
+# Незавершённые фоновые отметки выполнения: отмена ждёт их, чтобы не обогнать
+_pending_completions: Dict[Tuple[int, str], asyncio.Task] = {}
+
+
+async def wait_pending_completion(user_id: int, habit_id: str):
+    task = _pending_completions.get((user_id, habit_id))
+    if task is not None and not task.done():
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def complete_optimistically(call: types.CallbackQuery, habit_id: str, habit) -> bool:
+    """
+    Сразу показать выполненную привычку по последнему известному состоянию,
+    а отметку на бэкенде отправить в фоне
+
+    Returns:
+        False, если сообщение недоступно и нужен обычный путь
+    """
+    if not isinstance(call.message, types.Message):
+        return False
+
+    quantity = habit.get("type", "boolean") == "quantity"
+    streak = habit.get("streak", 0) or 0
+    if not habit.get("completed", False):
+        streak += 1
+    goal = habit.get("goal", 0)
+    unit = habit.get("unit", "")
+    text = render_completion(habit, streak, goal, goal, unit)
+    previous = (call.message.html_text, call.message.reply_markup)
+
+    # Колбэк отвечается ровно один раз здесь; ошибки не пробрасываются, чтобы вызывающий не ответил повторно
+    answered, edited = await asyncio.gather(
+        call.answer("🎉 Готово!"),
+        edit_text(call.message, text, reply_markup=get_completed_keyboard(habit_id, True), parse_mode="HTML"),
+        return_exceptions=True
+    )
+    for error in (answered, edited):
+        if isinstance(error, Exception):
+            logger.warning("Не удалось показать выполнение привычки %s для telegram_id=%s: %s", habit_id, call.from_user.id, error)
+    metrics.inc("habits.complete.optimistic")
+
+    amount = (goal * 60 if unit == "часов" else goal) if quantity else None
+    key = (call.from_user.id, habit_id)
+    task = background.spawn(
+        reconcile_completion(call.bot, call.message, call.from_user, habit_id, habit, amount, text, previous),
+        name=f"habit-complete-{habit_id}"
+    )
+    _pending_completions[key] = task
+    task.add_done_callback(partial(_forget_completion, key))
+    return True
+
+
+def _forget_completion(key: Tuple[int, str], task: asyncio.Task):
+    if _pending_completions.get(key) is task:
+        del _pending_completions[key]
+
+
+async def reconcile_completion(bot: Bot, message: types.Message, user: types.User, habit_id: str, habit,
+                               amount, shown_text: str, previous: Tuple[str, Optional[InlineKeyboardMarkup]]):
+    """Отправить отметку на бэкенд; при расхождении поправить сообщение, при ошибке — откатить"""
+    try:
+        photo_url = await get_user_photo_url(bot, user.id)
+        payload = {
+            "telegram_id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "photo_url": photo_url,
+            "habit_id": int(habit_id)
+        }
+        if amount is not None:
+            payload["amount"] = amount
+        result = await api.post("/habits/complete", payload)
+    except Exception as e:
+        metrics.inc("habits.complete.rolled_back")
+        logger.warning("Отметка привычки %s для telegram_id=%s не принята, откатываем: %s", habit_id, user.id, e)
+        text, markup = previous
+        try:
+            await edit_text(message, text, reply_markup=markup, parse_mode="HTML")
+        except TelegramBadRequest as edit_error:
+            logger.warning("Не удалось откатить сообщение для telegram_id=%s: %s", user.id, edit_error)
+        await bot.send_message(
+            message.chat.id,
+            f"⚠️ Не удалось отметить привычку \"{habit.get('name', 'Привычка')}\": {e}\n\nПопробуй ещё раз."
+        )
+        return
+
+    confirmed = result.get("habit", {})
+    completed = confirmed.get("completed", False)
+    text = render_completion(
+        habit, result.get("streak", 0) or 0,
+        confirmed.get("progress", 0), confirmed.get("goal", 0), confirmed.get("unit", "")
+    )
+    if text != shown_text or not completed:
+        try:
+            await edit_text(message, text, reply_markup=get_completed_keyboard(habit_id, completed), parse_mode="HTML")
+        except TelegramBadRequest as e:
+            logger.warning("Не удалось поправить сообщение о выполнении для telegram_id=%s: %s", user.id, e)
+
+
 @router.callback_query(lambda c: c.data and c.data.startswith("habit_complete:"))
 async def start_complete_habit(call: types.CallbackQuery):
     if not call.data or not call.from_user:
@@ -34,6 +174,17 @@ async def start_complete_habit(call: types.CallbackQuery):
     habit_id = call.data.split(":")[1]
     user_id = call.from_user.id
 
+    known = api.known_habit(user_id, habit_id)
+    if known is not None:
+        try:
+            if has_quantity_input(known):
+                await show_amount_prompt(call, habit_id, known)
+                return
+            if await complete_optimistically(call, habit_id, known):
+                return
+        except Exception as e:
+            return await call.answer(f"❌ Ошибка: {e}", show_alert=True)
+
     try:
         photo_url = await get_user_photo_url(call.bot, user_id)
         data = await api.get(f"/habits/{habit_id}", params={
@@ -45,31 +196,27 @@ async def start_complete_habit(call: types.CallbackQuery):
         })
         habit = data.get("habit", {})
         
-        name = habit.get("name", "Неизвестно")
-        progress = habit.get("progress", 0)
-        goal = habit.get("goal", 0)
-        unit = habit.get("unit", "")
-        habit_type = habit.get("type", "boolean")
-        
-        has_quantity = habit_type == "quantity"
-        
-        if not unit or unit.strip() == "":
-            if goal <= 1:
-                has_quantity = False
-        
-        if not has_quantity:
+        if not has_quantity_input(habit):
             await complete_habit_boolean(call, habit_id, user_id, habit, photo_url)
             return
-        text = f"📝 <b>{name}</b>\n"
-        text += f"📊 Цель: {goal} {unit}\n"
-        text += f"📈 Текущий прогресс: {progress} / {goal} {unit}\n\n"
-        text += "💬 <b>Введи количество</b> (можно использовать дробные числа):"
-        await call.message.edit_text(text, reply_markup=get_complete_keyboard(habit_id, True), parse_mode="HTML")
-        await call.answer()
+        await show_amount_prompt(call, habit_id, habit)
     except Exception as e:
         await call.answer(f"❌ Ошибка: {e}", show_alert=True)
 
 
+async def show_amount_prompt(call: types.CallbackQuery, habit_id: str, habit):
+    name = habit.get("name", "Неизвестно")
+    progress = habit.get("progress", 0)
+    goal = habit.get("goal", 0)
+    unit = habit.get("unit", "")
+    text = f"📝 <b>{name}</b>\n"
+    text += f"📊 Цель: {goal} {unit}\n"
+    text += f"📈 Текущий прогресс: {progress} / {goal} {unit}\n\n"
+    text += "💬 <b>Введи количество</b> (можно использовать дробные числа):"
+    await call.message.edit_text(text, reply_markup=get_complete_keyboard(habit_id, True), parse_mode="HTML")
+    await call.answer()
+
+
 @router.callback_query(lambda c: c.data and c.data.startswith("habit_input:"))
 async def start_input_amount(call: types.CallbackQuery, state: FSMContext):
     if not call.data:
@@ -220,6 +367,14 @@ async def complete_habit_full(call: types.CallbackQuery):
     habit_id = call.data.split(":")[1]
     user_id = call.from_user.id
 
+    known = api.known_habit(user_id, habit_id)
+    if known is not None:
+        try:
+            if await complete_optimistically(call, habit_id, known):
+                return
+        except Exception as e:
+            return await call.answer(f"❌ Ошибка: {e}", show_alert=True)
+
     try:
         photo_url = await get_user_photo_url(call.bot, user_id)
         data = await api.get(f"/habits/{habit_id}", params={
@@ -341,6 +496,7 @@ async def undo_habit_completion(call: types.CallbackQuery):
     user_id = call.from_user.id
 
     try:
+        await wait_pending_completion(user_id, habit_id)
         photo_url = await get_user_photo_url(call.bot, user_id)
         result = await api.post("/habits/undo", {
             "telegram_id": user_id,
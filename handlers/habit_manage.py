@@ -5,6 +5,7 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.exceptions import TelegramBadRequest
 from services.api import api
 from utils.helpers import get_user_photo_url
+from keyboards.factory import static_keyboard
 
 router = Router()
 
@@ -16,6 +17,7 @@ class HabitCreateStates(StatesGroup):
     waiting_for_value = State()
 
 
+@static_keyboard
 def get_habit_type_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -4,6 +4,10 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.exceptions import TelegramBadRequest
 from services.api import api
 from utils.helpers import get_user_photo_url
+from utils.render_cache import edit_text, remember_sent
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
@@ -72,11 +76,9 @@ async def habits_today(message: types.Message):
         )
         return
 
-    await message.answer(
-        "📋 <b>Твои привычки:</b>",
-        reply_markup=get_habits_keyboard(habits),
-        parse_mode="HTML"
-    )
+    keyboard = get_habits_keyboard(habits)
+    sent = await message.answer("📋 <b>Твои привычки:</b>", reply_markup=keyboard, parse_mode="HTML")
+    remember_sent(sent, "📋 <b>Твои привычки:</b>", keyboard, "HTML")
 
 @router.message(lambda m: m.text == "🔄 Обновить список")
 async def refresh_habits(message: types.Message):
@@ -91,9 +93,9 @@ async def refresh_habits_callback(call: types.CallbackQuery):
     if not call.from_user or not call.message:
         return await call.answer("❌ Ошибка", show_alert=True)
     
-    await call.answer("Обновляю список...")
-    
     user_id = call.from_user.id
+    # Отвечаем сразу, чтобы индикатор загрузки не висел на время запроса к бэкенду
+    await call.answer("Обновляю список...")
     
     try:
         photo_url = await get_user_photo_url(call.bot, user_id)
@@ -107,7 +109,8 @@ async def refresh_habits_callback(call: types.CallbackQuery):
         habits = data.get("habits", [])
         
         if not habits:
-            await call.message.edit_text(
+            await edit_text(
+                call.message,
                 "📝 <b>У тебя пока нет привычек</b>\n\n"
                 "Создай первую привычку прямо здесь! 🚀",
                 reply_markup=InlineKeyboardMarkup(
@@ -117,22 +120,17 @@ async def refresh_habits_callback(call: types.CallbackQuery):
                 ),
                 parse_mode="HTML"
             )
-            return
-        
-        try:
-            await call.message.edit_text(
+        else:
+            await edit_text(
+                call.message,
                 "📋 <b>Твои привычки:</b>",
                 reply_markup=get_habits_keyboard(habits),
                 parse_mode="HTML"
             )
-        except TelegramBadRequest as e:
-            if "message is not modified" in str(e).lower():
-                await call.answer("Список уже актуален ✅")
-            else:
-                raise
     except Exception as e:
         try:
-            await call.message.edit_text(
+            await edit_text(
+                call.message,
                 f"❌ Ошибка при загрузке привычек: {e}",
                 reply_markup=InlineKeyboardMarkup(
                     inline_keyboard=[
@@ -140,11 +138,8 @@ async def refresh_habits_callback(call: types.CallbackQuery):
                     ]
                 )
             )
-        except TelegramBadRequest as e2:
-            if "message is not modified" in str(e2).lower():
-                await call.answer("Список уже актуален ✅")
-            else:
-                await call.answer(f"❌ Ошибка: {e}", show_alert=True)
+        except TelegramBadRequest as edit_error:
+            logger.warning("Не удалось показать ошибку обновления списка для telegram_id=%s: %s", user_id, edit_error)
 
 @router.callback_query(lambda c: c.data and c.data.startswith("habit_select:"))
 async def show_habit_details(call: types.CallbackQuery, state: FSMContext = None):
@@ -159,6 +154,7 @@ async def show_habit_details(call: types.CallbackQuery, state: FSMContext = None
     
     habit_id = call.data.split(":")[1]
     user_id = call.from_user.id
+    await call.answer()
 
     try:
         photo_url = await get_user_photo_url(call.bot, user_id)
@@ -207,16 +203,21 @@ async def show_habit_details(call: types.CallbackQuery, state: FSMContext = None
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
         
-        try:
-            await call.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
-        except TelegramBadRequest as e:
-            if "message is not modified" in str(e).lower():
-                await call.answer("Информация уже актуальна ✅")
-            else:
-                raise
-        await call.answer()
+        await edit_text(call.message, text, reply_markup=keyboard, parse_mode="HTML")
     except Exception as e:
-        await call.answer(f"❌ Ошибка: {e}", show_alert=True)
+        try:
+            await edit_text(
+                call.message,
+                f"❌ Ошибка при загрузке привычки: {e}",
+                reply_markup=InlineKeyboardMarkup(
+                    inline_keyboard=[
+                        [InlineKeyboardButton(text="🔄 Попробовать снова", callback_data=f"habit_select:{habit_id}")],
+                        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_today")]
+                    ]
+                )
+            )
+        except TelegramBadRequest as edit_error:
+            logger.warning("Не удалось показать ошибку загрузки привычки для telegram_id=%s: %s", user_id, edit_error)
 
 @router.callback_query(lambda c: c.data == "back_today")
 async def back_to_today(call: types.CallbackQuery, state: FSMContext = None):
@@ -245,7 +246,8 @@ async def back_to_today(call: types.CallbackQuery, state: FSMContext = None):
         habits = data.get("habits", [])
         
         if not habits:
-            await call.message.edit_text(
+            await edit_text(
+                call.message,
                 "📝 <b>У тебя пока нет привычек</b>\n\n"
                 "Создай первую привычку прямо здесь! 🚀",
                 reply_markup=InlineKeyboardMarkup(
@@ -257,20 +259,16 @@ async def back_to_today(call: types.CallbackQuery, state: FSMContext = None):
             )
             return
         
-        try:
-            await call.message.edit_text(
-                "📋 <b>Твои привычки:</b>",
-                reply_markup=get_habits_keyboard(habits),
-                parse_mode="HTML"
-            )
-        except TelegramBadRequest as e:
-            if "message is not modified" in str(e).lower():
-                await call.answer("Список уже актуален ✅")
-            else:
-                raise
+        await edit_text(
+            call.message,
+            "📋 <b>Твои привычки:</b>",
+            reply_markup=get_habits_keyboard(habits),
+            parse_mode="HTML"
+        )
     except Exception as e:
         try:
-            await call.message.edit_text(
+            await edit_text(
+                call.message,
                 f"❌ Ошибка при загрузке привычек: {e}",
                 reply_markup=InlineKeyboardMarkup(
                     inline_keyboard=[
@@ -4,6 +4,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from services.api import api
 from keyboards.main_menu import main_menu
+from keyboards.factory import static_keyboard, cached_keyboard
 from utils.helpers import get_user_photo_url
 import re
 
@@ -15,6 +16,7 @@ class SettingsStates(StatesGroup):
     waiting_for_edit_time = State()
 
 
+@static_keyboard
 def get_settings_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -25,9 +27,11 @@ def get_settings_keyboard():
 
 
 def get_reminders_keyboard(notify_times: list = None):
-    if notify_times is None:
-        notify_times = []
-    
+    return _reminders_keyboard(tuple(notify_times or ()))
+
+
+@cached_keyboard()
+def _reminders_keyboard(notify_times: tuple):
     keyboard = []
     
     if notify_times:
@@ -47,6 +51,7 @@ def get_reminders_keyboard(notify_times: list = None):
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@cached_keyboard(maxsize=2)
 def get_dnd_keyboard(dnd_enabled: bool = False):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -324,6 +329,7 @@ async def process_notification_time(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка: {e}")
 
 
+@cached_keyboard()
 def get_time_settings_keyboard(time_str: str):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1,7 +1,7 @@
 import asyncio
 import os
-import aiosqlite
 import logging
+from services.migrations import migrate
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -11,22 +11,9 @@ async def init_database():
     db_path = "data/tokens.db"
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS tokens (
-                telegram_id INTEGER PRIMARY KEY,
-                access_token TEXT,
-                refresh_token TEXT,
-                user_id INTEGER,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                photo_url TEXT
-            )
-        ''')
-        await db.commit()
+    version = await migrate(db_path)
     
-    logger.info(f"База данных SQLite готова: {db_path}")
+    logger.info(f"База данных SQLite готова: {db_path} (версия схемы {version})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+"""
+Кэширование клавиатур
+
+Построение InlineKeyboardMarkup/ReplyKeyboardMarkup — это создание и
+валидация нескольких pydantic-моделей на каждый вызов. Клавиатуры без
+параметров строятся один раз (static_keyboard), а зависящие от habit_id или
+состояния запоминаются в ограниченном LRU-кэше (cached_keyboard). Возвращаемые
+объекты общие для всех пользователей, поэтому изменять их нельзя.
+"""
+from functools import lru_cache
+from typing import Callable, Dict, List, TypeVar
+
+KEYBOARD_CACHE_SIZE = 1024
+
+Builder = TypeVar("Builder", bound=Callable)
+
+_cached: List[Callable] = []
+
+
+def static_keyboard(build: Builder) -> Builder:
+    """Клавиатура без параметров: строится при первом вызове и дальше переиспользуется"""
+    cached = lru_cache(maxsize=1)(build)
+    _cached.append(cached)
+    return cached
+
+
+def cached_keyboard(maxsize: int = KEYBOARD_CACHE_SIZE) -> Callable[[Builder], Builder]:
+    """Клавиатура с хэшируемыми параметрами: последние maxsize вариантов хранятся в LRU-кэше"""
+    def decorator(build: Builder) -> Builder:
+        cached = lru_cache(maxsize=maxsize)(build)
+        _cached.append(cached)
+        return cached
+    return decorator
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """Попадания и промахи кэша по каждой фабрике клавиатур"""
+    stats = {}
+    for cached in _cached:
+        info = cached.cache_info()
+        stats[f"{cached.__module__}.{cached.__qualname__}"] = {
+            "hits": info.hits, "misses": info.misses, "size": info.currsize
+        }
+    return stats
@@ -1,5 +1,7 @@
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from keyboards.factory import static_keyboard
 
+@static_keyboard
 def main_menu():
     """Создать клавиатуру главного меню"""
     kb = ReplyKeyboardBuilder()
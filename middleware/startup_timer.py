@@ -0,0 +1,29 @@
+import time
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FirstUpdateTimerMiddleware(BaseMiddleware):
+    def __init__(self, started_at: float):
+        """
+        Middleware, которое логирует время от запуска процесса до первого обновления
+
+        Args:
+            started_at: Момент запуска процесса по time.perf_counter()
+        """
+        self.started_at = started_at
+        self.reported = False
+
+    async def __call__(
+        self,
+        handler,
+        event: TelegramObject,
+        data: dict
+    ):
+        if not self.reported:
+            self.reported = True
+            logger.info(f"Первое обновление получено через {time.perf_counter() - self.started_at:.2f} с после запуска")
+        return await handler(event, data)
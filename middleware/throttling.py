@@ -1,23 +1,25 @@
-from typing import Dict
-from datetime import datetime
+import time
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery, TelegramObject
+from services.user_registry import user_registry
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class ThrottlingMiddleware(BaseMiddleware):
-    def __init__(self, rate_limit: float = 0.5):
+    def __init__(self, rate_limit: float = 0.5, name: str = "default"):
         """
         Middleware для защиты от спама
         
         Args:
             rate_limit: Минимальное время между сообщениями в секундах (по умолчанию 1 секунда)
+            name: Имя ограничителя; у ограничителей с разными именами отдельные счётчики
         """
         self.rate_limit = rate_limit
-        self.user_last_message: Dict[int, datetime] = {}
-        self.user_warning_count: Dict[int, int] = {}
+        # Время последнего сообщения (time.monotonic()) и число предупреждений по индексу пользователя в реестре
+        self.user_last_message = user_registry.field(f"throttle.{name}.last", "d")
+        self.user_warning_count = user_registry.field(f"throttle.{name}.warnings", "B")
     
     async def __call__(
         self,
@@ -35,20 +37,20 @@ class ThrottlingMiddleware(BaseMiddleware):
         if user_id is None:
             return await handler(event, data)
         
-        now = datetime.now()
+        now = time.monotonic()
+        index = user_registry.index(user_id)
+        last_message = self.user_last_message[index]
         
-        if user_id in self.user_last_message:
-            time_since_last = (now - self.user_last_message[user_id]).total_seconds()
+        if last_message:
+            time_since_last = now - last_message
             
             if time_since_last < self.rate_limit:
                 wait_time = self.rate_limit - time_since_last
                 
-                if user_id not in self.user_warning_count:
-                    self.user_warning_count[user_id] = 0
+                warnings = min(self.user_warning_count[index] + 1, 255)
+                self.user_warning_count[index] = warnings
                 
-                self.user_warning_count[user_id] += 1
-                
-                if self.user_warning_count[user_id] <= 3:
+                if warnings <= 3:
                     if isinstance(event, Message):
                         await event.answer(
                             f"⏳ Слишком много запросов. Подожди {wait_time:.1f} секунд."
@@ -58,15 +60,14 @@ class ThrottlingMiddleware(BaseMiddleware):
                             f"⏳ Подожди {wait_time:.1f} секунд.",
                             show_alert=True
                         )
-                elif self.user_warning_count[user_id] > 10:
+                elif warnings > 10:
                     logger.warning(f"Пользователь {user_id} превысил лимит запросов более 10 раз")
                 
                 return
         
-        self.user_last_message[user_id] = now
+        self.user_last_message[index] = now
         
-        if user_id in self.user_warning_count and self.user_warning_count[user_id] > 0:
-            self.user_warning_count[user_id] = max(0, self.user_warning_count[user_id] - 1)
+        if self.user_warning_count[index] > 0:
+            self.user_warning_count[index] -= 1
         
         return await handler(event, data)
-
@@ -0,0 +1,59 @@
+import time
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+from services import tracing
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: открывает трассу на время обработки обновления
+    """
+
+    async def __call__(
+        self,
+        handler,
+        event: TelegramObject,
+        data: dict
+    ):
+        name = event.event_type if isinstance(event, Update) else type(event).__name__
+        trace = tracing.start_trace(name)
+        try:
+            return await handler(event, data)
+        finally:
+            tracing.finish_trace(trace)
+
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    """
+    Middleware для message/callback_query: подписывает трассу именем обработчика
+    и замеряет сам обработчик отдельно от маршрутизации и ограничения частоты
+    """
+
+    async def __call__(
+        self,
+        handler,
+        event: TelegramObject,
+        data: dict
+    ):
+        trace = tracing.current_trace()
+        handler_object = data.get("handler")
+        if trace is None or handler_object is None:
+            return await handler(event, data)
+
+        name = getattr(handler_object.callback, "__name__", trace.name)
+        trace.name = name
+        started = time.perf_counter()
+        trace.spans.append(("dispatch", 0.0, started - trace.started))
+        with tracing.span(f"handler {name}"):
+            return await handler(event, data)
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: замеряет каждый вызов метода Telegram Bot API
+    """
+
+    async def __call__(self, make_request, bot: Bot, method):
+        with tracing.span(f"telegram {method.__api_method__}"):
+            return await make_request(bot, method)
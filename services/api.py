@@ -5,12 +5,63 @@ import hmac
 import hashlib
 import time
 import logging
-from typing import Optional, Dict, Any, List
-from config import BACKEND_URL, BACKEND_USER_ID, BACKEND_ACCESS_TOKEN, WEB_APP_URL, BOT_TOKEN
+from collections import OrderedDict
+from datetime import date, timedelta
+from functools import partial
+from typing import Optional, Dict, Any, List, Tuple, Callable
+from config import (
+    BACKEND_URL, BACKEND_USER_ID, BACKEND_ACCESS_TOKEN, WEB_APP_URL, BOT_TOKEN,
+    BACKEND_BATCH_PATH, BACKEND_BATCH_CONCURRENCY, PROGRESS_MAX_AGE
+)
 from services.token_storage import token_storage
+from services.habit_history import habit_history
+from services.progress_aggregates import progress_aggregates
+from services.models import Habit
+from services.metrics import metrics
+from services.tracing import span, route
+from utils import json_codec
 
 logger = logging.getLogger(__name__)
 
+CONDITIONAL_CACHE_SIZE = 10000
+KNOWN_HABITS_SIZE = 10000
+
+# Параметры, которые нужны только для перерегистрации пользователя и не влияют на ответ
+IDENTITY_PARAMS = frozenset(("telegram_id", "username", "first_name", "last_name", "photo_url"))
+
+
+class AuthorizedSession:
+    """
+    Общая сессия aiohttp с заголовком Authorization конкретного запроса.
+
+    Токен не хранится в самой сессии, поэтому запросы разных пользователей
+    идут параллельно через один пул соединений, а смена токена не требует
+    закрывать сессию, которой пользуются другие запросы.
+    """
+    __slots__ = ("_session", "_headers")
+
+    def __init__(self, session: aiohttp.ClientSession, access_token: Optional[str]):
+        self._session = session
+        self._headers = {"Authorization": f"Bearer {access_token}"} if access_token else {}
+
+    def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None, **kwargs):
+        return self._session.request(method, url, headers={**self._headers, **headers} if headers else self._headers, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url: str, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url: str, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
 
 class API:
     def __init__(self, base_url: str):
@@ -18,32 +69,58 @@ class API:
         self.session: Optional[aiohttp.ClientSession] = None
         self.user_id = BACKEND_USER_ID
         self.access_token = BACKEND_ACCESS_TOKEN
+        self._conditional_cache: "OrderedDict[Tuple[Optional[int], str], Tuple[Optional[str], Optional[str], Any]]" = OrderedDict()
+        self._settings_listeners: List[Callable[[int, Dict[str, Any]], None]] = []
+        self._known_habits: "OrderedDict[Tuple[int, int], Habit]" = OrderedDict()
+        self._in_flight: Dict[Tuple[Any, ...], asyncio.Task] = {}
         
         if not self.base_url:
             self.base_url = "http://localhost:8000"
 
-    async def _get_session(self, telegram_id: Optional[int] = None, force_new: bool = False, 
-                          access_token: Optional[str] = None) -> aiohttp.ClientSession:
-        should_recreate = (
-            force_new or 
-            self.session is None or 
-            self.session.closed or
-            (access_token is not None and self.session is not None and not self.session.closed)
-        )
-        
-        if should_recreate:
-            if self.session and not self.session.closed:
-                await self.session.close()
-            
-            headers = {}
-            if access_token:
-                headers["Authorization"] = f"Bearer {access_token}"
-            elif self.access_token:
-                headers["Authorization"] = f"Bearer {self.access_token}"
-            
-            self.session = aiohttp.ClientSession(headers=headers)
+    def _shared_session(self) -> aiohttp.ClientSession:
+        """Единственная сессия (пул соединений) API; закрывается только в close()"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(json_serialize=json_codec.dumps)
         return self.session
+
+    async def _get_session(self, access_token: Optional[str] = None) -> "AuthorizedSession":
+        """Общая сессия с авторизацией access_token (или сервисного токена) для каждого запроса"""
+        return AuthorizedSession(self._shared_session(), access_token or self.access_token)
     
+    @staticmethod
+    def _conditional_headers(cached: Optional[Tuple[Optional[str], Optional[str], Any]]) -> Dict[str, str]:
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    async def _read_conditional(self, response: aiohttp.ClientResponse, cache_key: Tuple[Optional[int], str],
+                                cached: Optional[Tuple[Optional[str], Optional[str], Any]]) -> Any:
+        if response.status == 304 and cached:
+            metrics.inc("api.conditional.not_modified")
+            self._conditional_cache[cache_key] = cached
+            self._conditional_cache.move_to_end(cache_key)
+            return cached[2]
+
+        response.raise_for_status()
+        body = await response.json(loads=json_codec.loads)
+        metrics.inc("api.conditional.full")
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._conditional_cache[cache_key] = (etag, last_modified, body)
+            self._conditional_cache.move_to_end(cache_key)
+            if len(self._conditional_cache) > CONDITIONAL_CACHE_SIZE:
+                self._conditional_cache.popitem(last=False)
+        else:
+            self._conditional_cache.pop(cache_key, None)
+        return body
+
     def _generate_telegram_hash(self, data: Dict[str, str]) -> str:
         if not BOT_TOKEN:
             raise Exception("BOT_TOKEN не задан для генерации hash")
@@ -79,7 +156,7 @@ class API:
         telegram_data["hash"] = self._generate_telegram_hash(telegram_data)
         
         url = f"{self.base_url}/login/telegram"
-        session = aiohttp.ClientSession()
+        session = self._shared_session()
         
         try:
             async with session.post(url, json=telegram_data) as response:
@@ -87,19 +164,17 @@ class API:
                     error_text = await response.text()
                     raise Exception(f"Ошибка авторизации: неверные данные Telegram. Ответ сервера: {error_text}")
                 response.raise_for_status()
-                auth_response = await response.json()
+                auth_response = await response.json(loads=json_codec.loads)
         except aiohttp.ClientConnectorError as e:
-            logger.error(f"Не удалось подключиться к серверу {self.base_url} при регистрации: {e}")
+            logger.error("Не удалось подключиться к серверу %s при регистрации: %s", self.base_url, e)
             raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
         except aiohttp.ClientError as e:
-            logger.error(f"Ошибка сети при регистрации: {e}")
+            logger.error("Ошибка сети при регистрации: %s", e)
             raise Exception(f"Ошибка сети при регистрации: {e}")
         except Exception as e:
             if "Ошибка" in str(e):
                 raise
             raise Exception(f"Ошибка API при регистрации: {e}")
-        finally:
-            await session.close()
         
         user = auth_response.get("user", {})
         tokens = auth_response.get("tokens", {})
@@ -108,7 +183,7 @@ class API:
         access_token = tokens.get("access_token")
         refresh_token = tokens.get("refresh_token")
         
-        logger.info(f"Регистрация пользователя: telegram_id={telegram_id}, user_id={user_id}")
+        logger.info("Регистрация пользователя: telegram_id=%s, user_id=%s", telegram_id, user_id)
         
         return {
             "user": {
@@ -128,22 +203,19 @@ class API:
                 return None
             
             url = f"{self.base_url}/auth/getaccesstoken"
-            session = aiohttp.ClientSession()
+            session = self._shared_session()
             
-            try:
-                async with session.post(url, json={"refresh_token": refresh_token}) as response:
-                    if response.status == 401:
-                        return None
-                    response.raise_for_status()
-                    data = await response.json()
-                    new_access_token = data.get("access_token")
-                    if new_access_token:
-                        await token_storage.update_access_token(telegram_id, new_access_token)
-                    return new_access_token
-            finally:
-                await session.close()
+            async with session.post(url, json={"refresh_token": refresh_token}) as response:
+                if response.status == 401:
+                    return None
+                response.raise_for_status()
+                data = await response.json(loads=json_codec.loads)
+                new_access_token = data.get("access_token")
+                if new_access_token:
+                    await token_storage.update_access_token(telegram_id, new_access_token)
+                return new_access_token
         except Exception as e:
-            logger.error(f"Ошибка при обновлении access token для telegram_id={telegram_id}: {e}", exc_info=True)
+            logger.error("Ошибка при обновлении access token для telegram_id=%s: %s", telegram_id, e, exc_info=True)
             return None
     
     async def _refresh_token_pair(self, telegram_id: int) -> Optional[Dict[str, str]]:
@@ -154,24 +226,21 @@ class API:
                 return None
             
             url = f"{self.base_url}/auth/getrefreshtoken"
-            session = aiohttp.ClientSession()
+            session = self._shared_session()
             
-            try:
-                async with session.post(url, json={"refresh_token": refresh_token}) as response:
-                    if response.status == 401:
-                        return None
-                    response.raise_for_status()
-                    data = await response.json()
-                    new_access_token = data.get("access_token")
-                    new_refresh_token = data.get("refresh_token")
-                    if new_access_token and new_refresh_token:
-                        await token_storage.update_tokens(telegram_id, new_access_token, new_refresh_token)
-                        logger.info(f"Пара токенов обновлена для пользователя {telegram_id}")
-                    return {"access_token": new_access_token, "refresh_token": new_refresh_token}
-            finally:
-                await session.close()
+            async with session.post(url, json={"refresh_token": refresh_token}) as response:
+                if response.status == 401:
+                    return None
+                response.raise_for_status()
+                data = await response.json(loads=json_codec.loads)
+                new_access_token = data.get("access_token")
+                new_refresh_token = data.get("refresh_token")
+                if new_access_token and new_refresh_token:
+                    await token_storage.update_tokens(telegram_id, new_access_token, new_refresh_token)
+                    logger.info("Пара токенов обновлена для пользователя %s", telegram_id, extra={"sample": 20})
+                return {"access_token": new_access_token, "refresh_token": new_refresh_token}
         except Exception as e:
-            logger.warning(f"Ошибка при обновлении пары токенов: {e}")
+            logger.warning("Ошибка при обновлении пары токенов: %s", e)
             return None
     
     async def _get_user_token(self, telegram_id: int, username: Optional[str] = None,
@@ -205,30 +274,28 @@ class API:
                     photo_url=photo_url
                 )
             else:
-                logger.error(f"Токены не получены при регистрации для telegram_id={telegram_id}")
+                logger.error("Токены не получены при регистрации для telegram_id=%s", telegram_id)
                 return None
             
             return access_token
         except Exception as e:
-            logger.error(f"Ошибка при регистрации пользователя {telegram_id}: {e}", exc_info=True)
+            logger.error("Ошибка при регистрации пользователя %s: %s", telegram_id, e, exc_info=True)
             return None
 
     async def check_connection(self) -> bool:
         try:
-            session = aiohttp.ClientSession()
+            session = self._shared_session()
             try:
                 async with session.get(f"{self.base_url}/users", timeout=ClientTimeout(total=5)) as response:
                     return True
             except asyncio.TimeoutError:
-                logger.error(f"Таймаут при подключении к {self.base_url}")
+                logger.error("Таймаут при подключении к %s", self.base_url)
                 return False
             except ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к %s: %s", self.base_url, e)
                 return False
-            finally:
-                await session.close()
         except Exception as e:
-            logger.error(f"Ошибка при проверке подключения: {e}")
+            logger.error("Ошибка при проверке подключения: %s", e)
             return False
 
     async def close(self):
@@ -236,16 +303,143 @@ class API:
             await self.session.close()
 
     async def get(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
-        return await self._get(path, params)
+        """
+        GET-запрос к бэкенду. Одинаковые одновременные запросы (telegram_id, путь,
+        параметры) выполняются один раз, все ожидающие получают общий результат
+        """
+        key = self._coalesce_key(path, params)
+        if key is None:
+            return await self._traced_get(path, params)
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._traced_get(path, params))
+            self._in_flight[key] = task
+            task.add_done_callback(partial(self._forget_in_flight, key))
+        else:
+            metrics.inc("api.coalesced")
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def fetch_users(self, users: List[Tuple[int, Dict[str, Any]]], settings: bool = True,
+                          habits: bool = True) -> Dict[int, Dict[str, Any]]:
+        """
+        Настройки и/или привычки на сегодня для многих пользователей сразу
+
+        Если бэкенд поддерживает пакетный запрос (BACKEND_BATCH_PATH), данные
+        забираются одним POST, иначе — параллельными запросами по пользователям,
+        не больше BACKEND_BATCH_CONCURRENCY одновременно.
+
+        Args:
+            users: Пары (telegram_id, данные пользователя из token_storage)
+            settings: Загрузить настройки (ключ "settings")
+            habits: Загрузить привычки на сегодня (ключ "habits")
+
+        Returns:
+            {telegram_id: {"settings": ..., "habits": ...}}; вместо значения,
+            которое не удалось получить, лежит исключение
+        """
+        results: Dict[int, Dict[str, Any]] = {}
+        remaining = list(users)
+        if BACKEND_BATCH_PATH and remaining:
+            try:
+                results = await self._fetch_users_batch([telegram_id for telegram_id, _ in remaining], settings, habits)
+                metrics.inc("api.batch.requests")
+            except Exception as e:
+                logger.warning("Пакетный запрос %s не удался, загружаем по пользователям: %s", BACKEND_BATCH_PATH, e)
+            remaining = [(telegram_id, user_data) for telegram_id, user_data in remaining if telegram_id not in results]
+
+        if remaining:
+            semaphore = asyncio.Semaphore(BACKEND_BATCH_CONCURRENCY)
+
+            async def fetch_one(telegram_id: int, user_data: Dict[str, Any]):
+                params = {
+                    "telegram_id": telegram_id,
+                    "username": user_data.get("username"),
+                    "first_name": user_data.get("first_name"),
+                    "last_name": user_data.get("last_name"),
+                    "photo_url": user_data.get("photo_url")
+                }
+                requests = {}
+                if settings:
+                    requests["settings"] = ("/telegram/settings", {})
+                if habits:
+                    requests["habits"] = ("/habits/today", [])
+                async with semaphore:
+                    responses = await asyncio.gather(
+                        *(self.get(path, params=params) for path, _ in requests.values()),
+                        return_exceptions=True
+                    )
+                results[telegram_id] = {
+                    name: response if isinstance(response, Exception) else response.get(name, default)
+                    for (name, (_, default)), response in zip(requests.items(), responses)
+                }
+
+            await asyncio.gather(*(fetch_one(telegram_id, user_data) for telegram_id, user_data in remaining))
+        return results
+
+    async def _fetch_users_batch(self, telegram_ids: List[int], settings: bool, habits: bool) -> Dict[int, Dict[str, Any]]:
+        include = [name for name, wanted in (("settings", settings), ("habits", habits)) if wanted]
+        headers = {"Authorization": f"Bearer {self.access_token}"} if self.access_token else {}
+        session = self._shared_session()
+        async with session.post(f"{self.base_url}{BACKEND_BATCH_PATH}", headers=headers,
+                                json={"telegram_ids": telegram_ids, "include": include}) as response:
+            response.raise_for_status()
+            body = await response.json(loads=json_codec.loads)
+
+        results: Dict[int, Dict[str, Any]] = {}
+        for entry in body.get("users", []):
+            telegram_id = entry.get("telegram_id")
+            if telegram_id is None:
+                continue
+            telegram_id = int(telegram_id)
+            result: Dict[str, Any] = {}
+            if settings:
+                result["settings"] = self._publish_settings(telegram_id, entry.get("settings") or {})
+            if habits:
+                result["habits"] = [self._map_habit_from_backend(h) for h in entry.get("habits") or []]
+            results[telegram_id] = result
+        if habits and results:
+            await self._sync_histories(
+                [(telegram_id, result["habits"]) for telegram_id, result in results.items() if telegram_id],
+                complete=True
+            )
+        return results
+
+    def _forget_in_flight(self, key: Tuple[Any, ...], task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # ошибка уже передана ожидающим; забираем её, если все они были отменены
+            task.exception()
+
+    @staticmethod
+    def _coalesce_key(path: str, params: Optional[Dict]) -> Optional[Tuple[Any, ...]]:
+        if not params:
+            return (None, path)
+        try:
+            query = tuple(sorted((k, v) for k, v in params.items() if k not in IDENTITY_PARAMS))
+            key = (params.get("telegram_id"), path, query)
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def _traced_get(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
+        with span(route("GET", path)):
+            return await self._get(path, params)
 
     async def post(self, path: str, data: Optional[Dict] = None) -> Dict[str, Any]:
-        return await self._post(path, data)
+        with span(route("POST", path)):
+            return await self._post(path, data)
 
     async def put(self, path: str, data: Optional[Dict] = None) -> Dict[str, Any]:
-        return await self._put(path, data)
+        with span(route("PUT", path)):
+            return await self._put(path, data)
 
     async def delete(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
-        return await self._delete(path, params)
+        with span(route("DELETE", path)):
+            return await self._delete(path, params)
 
     async def _get(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
         telegram_id = params.get("telegram_id") if params else None
@@ -261,10 +455,10 @@ class API:
             access_token = await token_storage.get_access_token(telegram_id)
             user_id = await token_storage.get_user_id(telegram_id)
             
-            logger.debug(f"Получен токен из хранилища для telegram_id={telegram_id}: {'есть' if access_token else 'нет'}")
+            logger.debug("Получен токен из хранилища для telegram_id=%s: %s", telegram_id, 'есть' if access_token else 'нет')
             
             if not access_token:
-                logger.info(f"Токен не найден в хранилище для telegram_id={telegram_id}, регистрируем пользователя")
+                logger.info("Токен не найден в хранилище для telegram_id=%s, регистрируем пользователя", telegram_id)
                 access_token = await self._get_user_token(
                     telegram_id=telegram_id,
                     username=username,
@@ -277,40 +471,38 @@ class API:
                 user_id = await token_storage.get_user_id(telegram_id)
                 if not user_id:
                     raise Exception("Не удалось получить user_id при регистрации. Попробуйте отправить /start")
-                logger.info(f"Пользователь зарегистрирован, токен получен для telegram_id={telegram_id}")
+                logger.info("Пользователь зарегистрирован, токен получен для telegram_id=%s", telegram_id)
         
         if not access_token and self.access_token:
             access_token = self.access_token
             logger.debug("Используется токен из конфигурации")
         
         if not access_token:
-            logger.error(f"Токен не доступен для запроса {path}, telegram_id={telegram_id}")
+            logger.error("Токен не доступен для запроса %s, telegram_id=%s", path, telegram_id)
             raise Exception("Токен не доступен. Попробуйте отправить /start для регистрации")
 
-        if self.session and not self.session.closed:
-            await self.session.close()
-            self.session = None
-        
         if not access_token:
-            logger.warning(f"Токен не получен для telegram_id={telegram_id}, user_id={user_id}")
+            logger.warning("Токен не получен для telegram_id=%s, user_id=%s", telegram_id, user_id)
             if telegram_id:
                 raise Exception("Токен не доступен. Попробуйте отправить /start для регистрации")
             else:
                 raise Exception("Токен не доступен")
         
-        logger.debug(f"Используется токен для запроса {path}, telegram_id={telegram_id}")
+        logger.debug("Используется токен для запроса %s, telegram_id=%s", path, telegram_id)
         session = await self._get_session(access_token=access_token)
 
         if path == "/habits/today":
             url = f"{self.base_url}/habits"
+            cache_key = (telegram_id, url)
+            cached = self._conditional_cache.get(cache_key)
             try:
-                async with session.get(url) as response:
+                async with session.get(url, headers=self._conditional_headers(cached)) as response:
                     if response.status == 401:
                         if telegram_id:
-                            logger.warning(f"Получен 401 для telegram_id={telegram_id}, пытаемся обновить токен")
+                            logger.warning("Получен 401 для telegram_id=%s, пытаемся обновить токен", telegram_id)
                             new_token = await self._refresh_access_token(telegram_id)
                             if not new_token:
-                                logger.info(f"Refresh token истек, перерегистрируем пользователя telegram_id={telegram_id}")
+                                logger.info("Refresh token истек, перерегистрируем пользователя telegram_id=%s", telegram_id, extra={"sample": 20})
                                 new_token = await self._get_user_token(
                                     telegram_id=telegram_id,
                                     username=username,
@@ -319,36 +511,34 @@ class API:
                                     photo_url=photo_url
                                 )
                             if new_token:
-                                logger.info(f"Токен обновлен для telegram_id={telegram_id}, повторяем запрос")
-                                await session.close()
+                                logger.info("Токен обновлен для telegram_id=%s, повторяем запрос", telegram_id, extra={"sample": 20})
                                 session = await self._get_session(access_token=new_token)
-                                async with session.get(url) as retry_response:
+                                async with session.get(url, headers=self._conditional_headers(cached)) as retry_response:
                                     if retry_response.status == 401:
                                         raise Exception("Токен недействителен даже после обновления. Попробуйте отправить /start")
-                                    retry_response.raise_for_status()
-                                    habits = await retry_response.json()
+                                    habits = await self._read_conditional(retry_response, cache_key, cached)
                             else:
                                 raise Exception("Токен истёк, не удалось обновить. Попробуйте отправить /start")
                         else:
                             raise Exception("Ошибка авторизации (401). Попробуйте отправить /start для регистрации")
                     else:
-                        response.raise_for_status()
-                        habits = await response.json()
+                        habits = await self._read_conditional(response, cache_key, cached)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
             if not isinstance(habits, list):
-                logger.warning(f"Ожидался массив привычек, получен: {type(habits)}")
+                logger.warning("Ожидался массив привычек, получен: %s", type(habits))
                 habits = []
             
             mapped_habits = [self._map_habit_from_backend(h) for h in habits]
+            await self._sync_history(telegram_id, mapped_habits, complete=True)
             return {"habits": mapped_habits}
 
         if path.startswith("/habits/") and not path.endswith("/stats") and not path.endswith("/history"):
@@ -372,22 +562,23 @@ class API:
                                 )
                             if not new_token:
                                 raise Exception("Токен истёк, требуется повторная регистрация")
-                            await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.get(url) as retry_response:
                                 if retry_response.status == 404:
                                     raise Exception("Привычка не найдена")
                                 retry_response.raise_for_status()
-                                habit = await retry_response.json()
+                                habit = await retry_response.json(loads=json_codec.loads)
                         else:
                             response.raise_for_status()
-                            habit = await response.json()
+                            habit = await response.json(loads=json_codec.loads)
                 except aiohttp.ClientError as e:
                     raise Exception(f"Ошибка сети: {e}")
                 except Exception as e:
                     raise Exception(f"Ошибка API: {e}")
 
-                return {"habit": self._map_habit_from_backend(habit)}
+                mapped = self._map_habit_from_backend(habit)
+                await self._sync_history(telegram_id, [mapped])
+                return {"habit": mapped}
 
         if path.startswith("/habits/") and path.endswith("/stats"):
             parts = path.split("/")
@@ -409,13 +600,15 @@ class API:
 
         if path == "/telegram/settings":
             url = f"{self.base_url}/user/me/settings"
+            cache_key = (telegram_id, url)
+            cached = self._conditional_cache.get(cache_key)
             try:
-                async with session.get(url) as response:
+                async with session.get(url, headers=self._conditional_headers(cached)) as response:
                     if response.status == 404:
                         create_url = f"{self.base_url}/user/me/settings"
                         async with session.put(create_url, json={}) as create_response:
                             if create_response.status in [200, 201]:
-                                settings = await create_response.json()
+                                settings = await create_response.json(loads=json_codec.loads)
                             else:
                                 settings = {
                                     "user_id": user_id,
@@ -435,14 +628,13 @@ class API:
                             )
                         if not new_token:
                             raise Exception("Токен истёк, автоматическое обновление не удалось. Попробуйте отправить /start")
-                        await session.close()
                         session = await self._get_session(access_token=new_token)
-                        async with session.get(url) as retry_response:
+                        async with session.get(url, headers=self._conditional_headers(cached)) as retry_response:
                             if retry_response.status == 404:
                                 create_url = f"{self.base_url}/user/me/settings"
                                 async with session.put(create_url, json={}) as create_response:
                                     if create_response.status in [200, 201]:
-                                        settings = await create_response.json()
+                                        settings = await create_response.json(loads=json_codec.loads)
                                     else:
                                         settings = {
                                             "user_id": user_id,
@@ -451,22 +643,20 @@ class API:
                                             "notify_times": ["08:00"]
                                         }
                             else:
-                                retry_response.raise_for_status()
-                                settings = await retry_response.json()
+                                settings = await self._read_conditional(retry_response, cache_key, cached)
                     else:
-                        response.raise_for_status()
-                        settings = await response.json()
+                        settings = await self._read_conditional(response, cache_key, cached)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
-            return {"settings": self._map_settings_from_backend(settings)}
+            return {"settings": self._publish_settings(telegram_id, settings)}
 
         if path == "/telegram/users/check":
             telegram_id = params.get("telegram_id") if params else None
@@ -487,7 +677,7 @@ class API:
                                         if retry_response.status == 200:
                                             return {"exists": True}
                 except Exception as e:
-                    logger.debug(f"Ошибка при проверке пользователя telegram_id={telegram_id}: {e}")
+                    logger.debug("Ошибка при проверке пользователя telegram_id=%s: %s", telegram_id, e)
             return {"exists": False}
 
         if path == "/telegram/registration-link":
@@ -500,7 +690,7 @@ class API:
         try:
             async with session.get(url, params=params) as response:
                 response.raise_for_status()
-                return await response.json()
+                return await response.json(loads=json_codec.loads)
         except aiohttp.ClientError as e:
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
@@ -540,10 +730,6 @@ class API:
         if not access_token:
             raise Exception("Токен не доступен")
 
-        if self.session and not self.session.closed:
-            await self.session.close()
-            self.session = None
-        
         session = await self._get_session(access_token=access_token)
 
         if path == "/habits/complete":
@@ -569,28 +755,27 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.patch(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                habit = await retry_response.json()
+                                habit = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        habit = await response.json()
+                        habit = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
             mapped = self._map_habit_from_backend(habit)
+            await self._sync_history(telegram_id, [mapped])
             return {"habit": mapped, "streak": mapped.get("streak", 0)}
 
         if path == "/habits/undo":
@@ -618,28 +803,27 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.patch(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                habit = await retry_response.json()
+                                habit = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        habit = await response.json()
+                        habit = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
             mapped = self._map_habit_from_backend(habit)
+            await self._sync_history(telegram_id, [mapped])
             return {"habit": mapped, "streak": mapped.get("streak", 0)}
 
         if path == "/habits/create":
@@ -672,11 +856,11 @@ class API:
             
             url = f"{self.base_url}/habits"
             try:
-                logger.debug(f"Отправка запроса на создание привычки: {url}, payload: {payload}")
+                logger.debug("Отправка запроса на создание привычки: %s, payload: %s", url, payload)
                 async with session.post(url, json=payload) as response:
                     if response.status == 400:
                         error_text = await response.text()
-                        logger.error(f"Ошибка 400 при создании привычки: {error_text}, payload: {payload}")
+                        logger.error("Ошибка 400 при создании привычки: %s, payload: %s", error_text, payload)
                         raise Exception(f"Ошибка валидации: {error_text}")
                     
                     if response.status == 401 and telegram_id:
@@ -690,22 +874,20 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.post(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                habit = await retry_response.json()
+                                habit = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, требуется повторная регистрация")
                     else:
                         response.raise_for_status()
-                        habit = await response.json()
+                        habit = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 if hasattr(e, 'status') and hasattr(e, 'message'):
                     error_detail = f"Status: {e.status}, Message: {e.message}"
                     if hasattr(e, 'request_info'):
@@ -713,7 +895,7 @@ class API:
                     raise Exception(f"Ошибка сети: {error_detail}")
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
             
             return {"habit": self._map_habit_from_backend(habit)}
@@ -730,17 +912,15 @@ class API:
                         photo_url=photo_url
                     )
                     if new_token:
-                        if session and not session.closed:
-                            await session.close()
                         session = await self._get_session(access_token=new_token)
                         async with session.post(url, json=data) as retry_response:
                             retry_response.raise_for_status()
-                            return await retry_response.json()
+                            return await retry_response.json(loads=json_codec.loads)
                     else:
                         raise Exception("Токен истёк, требуется повторная регистрация")
                 else:
                         response.raise_for_status()
-                return await response.json()
+                return await response.json(loads=json_codec.loads)
         except aiohttp.ClientError as e:
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
@@ -780,10 +960,6 @@ class API:
         if not access_token:
             raise Exception("Токен не доступен")
 
-        if self.session and not self.session.closed:
-            await self.session.close()
-            self.session = None
-        
         session = await self._get_session(access_token=access_token)
 
         if path == "/telegram/settings/reminders":
@@ -806,28 +982,26 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.patch(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                settings = await retry_response.json()
+                                settings = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        settings = await response.json()
+                        settings = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
-            return {"success": True, "settings": self._map_settings_from_backend(settings)}
+            return {"success": True, "settings": self._publish_settings(telegram_id, settings)}
 
         if path == "/telegram/settings/morning-time":
             if not data:
@@ -850,28 +1024,26 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.get(settings_url) as retry_response:
                                 retry_response.raise_for_status()
-                                current_settings = await retry_response.json()
+                                current_settings = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        current_settings = await response.json()
+                        current_settings = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
-            notify_times: List[str] = current_settings.get("notify_times") or []
+            notify_times: List[str] = list(current_settings.get("notify_times") or [])
             if time_str not in notify_times:
                 notify_times.append(time_str)
 
@@ -893,28 +1065,26 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.patch(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                settings = await retry_response.json()
+                                settings = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        settings = await response.json()
+                        settings = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
-            return {"success": True, "settings": self._map_settings_from_backend(settings)}
+            return {"success": True, "settings": self._publish_settings(telegram_id, settings)}
 
         if path == "/telegram/settings/notify-times":
             if not data:
@@ -941,28 +1111,26 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.patch(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                settings = await retry_response.json()
+                                settings = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        settings = await response.json()
+                        settings = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
-            return {"success": True, "settings": self._map_settings_from_backend(settings)}
+            return {"success": True, "settings": self._publish_settings(telegram_id, settings)}
 
         if path == "/telegram/settings/dnd":
             enabled = data.get("enabled", False) if data else False
@@ -985,28 +1153,26 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            if session and not session.closed:
-                                await session.close()
                             session = await self._get_session(access_token=new_token)
                             async with session.patch(url, json=payload) as retry_response:
                                 retry_response.raise_for_status()
-                                settings = await retry_response.json()
+                                settings = await retry_response.json(loads=json_codec.loads)
                         else:
                             raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                     else:
                         response.raise_for_status()
-                        settings = await response.json()
+                        settings = await response.json(loads=json_codec.loads)
             except aiohttp.ClientConnectorError as e:
-                logger.error(f"Не удалось подключиться к серверу {self.base_url}: {e}")
+                logger.error("Не удалось подключиться к серверу %s: %s", self.base_url, e)
                 raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
             except aiohttp.ClientError as e:
-                logger.error(f"Ошибка сети при запросе к {self.base_url}: {e}")
+                logger.error("Ошибка сети при запросе к %s: %s", self.base_url, e)
                 raise Exception(f"Ошибка сети: {e}")
             except Exception as e:
-                logger.error(f"Ошибка API: {e}")
+                logger.error("Ошибка API: %s", e)
                 raise Exception(f"Ошибка API: {e}")
 
-            return {"success": True, "settings": self._map_settings_from_backend(settings)}
+            return {"success": True, "settings": self._publish_settings(telegram_id, settings)}
         
         url = f"{self.base_url}{path}"
         try:
@@ -1022,59 +1188,91 @@ class API:
                             photo_url=photo_url
                         )
                     if new_token:
-                        await session.close()
                         session = await self._get_session(access_token=new_token)
                         async with session.put(url, json=data) as retry_response:
                             retry_response.raise_for_status()
-                            return await retry_response.json()
+                            return await retry_response.json(loads=json_codec.loads)
                     else:
                         raise Exception("Токен истёк, автоматическая перерегистрация не удалась. Попробуйте отправить /start")
                 else:
                         response.raise_for_status()
-                return await response.json()
+                return await response.json(loads=json_codec.loads)
         except aiohttp.ClientError as e:
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
             raise Exception(f"Ошибка API: {e}")
 
     @staticmethod
-    def _map_habit_from_backend(h: Dict[str, Any]) -> Dict[str, Any]:
+    def _map_habit_from_backend(h: Dict[str, Any]) -> Habit:
         if not h:
-            return {}
+            return Habit.empty()
+        return Habit.from_backend(h)
 
-        habit_type = h.get("type", "count")
-        bot_type = "quantity" if habit_type in ("time", "count") else "boolean"
+    def known_habit(self, telegram_id: int, habit_id: Any) -> Optional[Habit]:
+        """
+        Последнее полученное от бэкенда состояние привычки, без запроса
 
-        value = h.get("value", 0) or 0
-        is_done = h.get("is_done", False)
-        unit = h.get("unit") or ""
-        
-        backend_progress = h.get("progress") or h.get("current_value") or (value if is_done else 0)
-        
-        display_value = value
-        display_progress = backend_progress
-        display_unit = unit
-        if unit == "минут" and value >= 60 and value % 60 == 0:
-            display_value = value / 60
-            display_progress = backend_progress / 60
-            display_unit = "часов"
+        Returns:
+            Habit или None, если привычка ещё не загружалась
+        """
+        try:
+            return self._known_habits.get((telegram_id, int(habit_id)))
+        except (TypeError, ValueError):
+            return None
 
-        return {
-            "id": h.get("id"),
-            "name": h.get("title", "Привычка"),
-            "emoji": "📌",
-            "progress": display_progress,
-            "goal": display_value,
-            "unit": display_unit,
-            "completed": is_done,
-            "type": bot_type,
-            "streak": h.get("series", 0),
-            "reminder_settings": {
-                "enabled": True,
-                "time": "18:00",
-                "days": ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"],
-            },
-        }
+    def _remember_habits(self, telegram_id: int, habits: List[Habit]):
+        for habit in habits:
+            try:
+                key = (telegram_id, int(habit.get("id")))
+            except (TypeError, ValueError):
+                continue
+            self._known_habits[key] = habit
+            self._known_habits.move_to_end(key)
+        while len(self._known_habits) > KNOWN_HABITS_SIZE:
+            self._known_habits.popitem(last=False)
+
+    async def _sync_history(self, telegram_id: Optional[int], habits: List[Dict[str, Any]], complete: bool = False):
+        # История и агрегаты ведутся только по пользователям; запросы без telegram_id считаются по ответу бэкенда
+        if telegram_id:
+            await self._sync_histories([(telegram_id, habits)], complete=complete)
+
+    async def _sync_histories(self, users: List[Tuple[int, List[Dict[str, Any]]]], complete: bool = False):
+        """Синхронизировать историю и агрегаты многих пользователей одним чтением и одной записью"""
+        for telegram_id, habits in users:
+            self._remember_habits(telegram_id, habits)
+        try:
+            changed = await habit_history.sync_many(
+                (telegram_id, [(h.get("id"), h.get("completed", False)) for h in habits])
+                for telegram_id, habits in users
+            )
+            await progress_aggregates.observe_many(
+                ((telegram_id, habits, changed.get(telegram_id, ())) for telegram_id, habits in users),
+                complete=complete
+            )
+        except Exception as e:
+            logger.warning("Не удалось обновить историю привычек для %s пользователей: %s", len(users), e)
+
+    def add_settings_listener(self, listener: Callable[[int, Dict[str, Any]], None]):
+        """Подписаться на настройки пользователя, полученные или изменённые через API"""
+        self._settings_listeners.append(listener)
+
+    def _publish_settings(self, telegram_id: Optional[int], settings: Dict[str, Any]) -> Dict[str, Any]:
+        mapped = self._map_settings_from_backend(settings)
+        if telegram_id:
+            for listener in self._settings_listeners:
+                try:
+                    listener(telegram_id, mapped)
+                except Exception as e:
+                    logger.warning("Ошибка обработчика настроек для telegram_id=%s: %s", telegram_id, e)
+        return mapped
+
+    @staticmethod
+    def _series_days(habit: Habit, days: int) -> List[Tuple[date, bool]]:
+        """Дни текущей серии по данным бэкенда, когда локальной истории нет"""
+        today = date.today()
+        first = 0 if habit.get("completed") else 1
+        last = first + (habit.get("streak", 0) or 0)
+        return [(today - timedelta(days=i), first <= i < last) for i in range(days)]
 
     @staticmethod
     def _map_settings_from_backend(s: Dict[str, Any]) -> Dict[str, Any]:
@@ -1088,7 +1286,7 @@ class API:
                 "timezone": "UTC",
             }
 
-        notify_times: List[str] = s.get("notify_times") or []
+        notify_times: List[str] = list(s.get("notify_times") or [])
         morning_time = notify_times[0] if notify_times else "08:00"
 
         dnd = s.get("do_not_disturb", False)
@@ -1148,26 +1346,37 @@ class API:
                             photo_url=photo_url
                         )
                     if new_token:
-                        await session.close()
                         session = await self._get_session(access_token=new_token)
                         async with session.get(url) as retry_response:
                             retry_response.raise_for_status()
-                            habit = await retry_response.json()
+                            habit = await retry_response.json(loads=json_codec.loads)
                     else:
                         raise Exception("Токен истёк, требуется повторная регистрация")
                 else:
                     response.raise_for_status()
-                    habit = await response.json()
+                    habit = await response.json(loads=json_codec.loads)
         except aiohttp.ClientError as e:
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
             raise Exception(f"Ошибка API: {e}")
 
         mapped = self._map_habit_from_backend(habit)
+        await self._sync_history(telegram_id, [mapped])
 
         total_days = 7 if period == "week" else 30
-        completed = mapped.get("streak", 0)
-        completed = min(completed, total_days)
+        series = mapped.get("streak", 0) or 0
+        if telegram_id:
+            stats = await habit_history.stats(telegram_id, habit_id, total_days)
+        else:
+            completed = min(series, total_days)
+            stats = {
+                "completed": completed,
+                "current_streak": series,
+                "best_streak": series,
+                "last_completed": None,
+                "avg_frequency": round(completed / total_days * 7, 1) if total_days else 0,
+            }
+        last_completed = stats["last_completed"]
 
         return {
             "habit": {
@@ -1176,18 +1385,16 @@ class API:
                 "emoji": mapped.get("emoji", "📌"),
             },
             "stats": {
-                "completed": completed,
+                "completed": stats["completed"],
                 "total": total_days,
-                "current_streak": mapped.get("streak", 0),
-                "best_streak": mapped.get("streak", 0),
-                "last_completed": "ранее",
-                "avg_frequency": round(completed / total_days * 7, 1) if total_days else 0,
+                "current_streak": max(series, stats["current_streak"]),
+                "best_streak": max(series, stats["best_streak"]),
+                "last_completed": last_completed.strftime("%d.%m.%Y") if last_completed else "ранее",
+                "avg_frequency": stats["avg_frequency"],
             },
         }
 
     async def _habit_history(self, user_id: str, habit_id: int, period: str, telegram_id: Optional[int] = None) -> Dict[str, Any]:
-        from datetime import datetime, timedelta
-
         username = None
         first_name = None
         last_name = None
@@ -1230,40 +1437,37 @@ class API:
                             photo_url=photo_url
                         )
                     if new_token:
-                        await session.close()
                         session = await self._get_session(access_token=new_token)
                         async with session.get(url) as retry_response:
                             retry_response.raise_for_status()
-                            habit = await retry_response.json()
+                            habit = await retry_response.json(loads=json_codec.loads)
                     else:
                         raise Exception("Токен истёк, требуется повторная регистрация")
                 else:
                     response.raise_for_status()
-                    habit = await response.json()
+                    habit = await response.json(loads=json_codec.loads)
         except aiohttp.ClientError as e:
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
             raise Exception(f"Ошибка API: {e}")
 
         mapped = self._map_habit_from_backend(habit)
+        await self._sync_history(telegram_id, [mapped])
 
         days_count = 7 if period == "week" else 30
-        today = datetime.now()
-        history = []
-
-        for i in range(days_count):
-            date = today - timedelta(days=i)
-            date_str = date.strftime("%d.%m.%Y")
-            completed = (i % 3) != 0
-            amount = mapped.get("goal", 0) if completed else 0
-
-            history.append(
-                {
-                    "date": date_str,
-                    "completed": completed,
-                    "amount": amount,
-                }
-            )
+        goal = mapped.get("goal", 0)
+        if telegram_id:
+            days = await habit_history.days(telegram_id, habit_id, days_count)
+        else:
+            days = self._series_days(mapped, days_count)
+        history = [
+            {
+                "date": day.strftime("%d.%m.%Y"),
+                "completed": completed,
+                "amount": goal if completed else 0,
+            }
+            for day, completed in days
+        ]
 
         return {
             "habit": {
@@ -1278,6 +1482,13 @@ class API:
     async def _progress(self, user_id: Optional[str], period: str, telegram_id: Optional[int] = None,
                       username: Optional[str] = None, first_name: Optional[str] = None,
                       last_name: Optional[str] = None, photo_url: Optional[str] = None) -> Dict[str, Any]:
+        total_days = 1 if period == "today" else (7 if period == "week" else 30)
+
+        if telegram_id and progress_aggregates.is_fresh(telegram_id, PROGRESS_MAX_AGE):
+            aggregates = await progress_aggregates.get_user(telegram_id)
+            if aggregates is not None:
+                return progress_aggregates.summarize(aggregates, total_days)
+
         access_token = None
         
         if telegram_id:
@@ -1289,7 +1500,7 @@ class API:
                     user_id = str(stored_user_id)
             
             if not access_token:
-                logger.info(f"Токен не найден для telegram_id={telegram_id}, регистрируем пользователя")
+                logger.info("Токен не найден для telegram_id=%s, регистрируем пользователя", telegram_id)
                 access_token = await self._get_user_token(
                     telegram_id=telegram_id,
                     username=username,
@@ -1302,7 +1513,7 @@ class API:
                 stored_user_id = await token_storage.get_user_id(telegram_id)
                 if stored_user_id:
                     user_id = str(stored_user_id)
-                logger.info(f"Пользователь зарегистрирован, user_id={user_id}, telegram_id={telegram_id}")
+                logger.info("Пользователь зарегистрирован, user_id=%s, telegram_id=%s", user_id, telegram_id)
         
         if not access_token and self.access_token:
             access_token = self.access_token
@@ -1312,15 +1523,17 @@ class API:
 
         session = await self._get_session(access_token=access_token)
         url = f"{self.base_url}/habits"
+        cache_key = (telegram_id, url)
+        cached = self._conditional_cache.get(cache_key)
 
         try:
-            async with session.get(url) as response:
+            async with session.get(url, headers=self._conditional_headers(cached)) as response:
                 if response.status == 401:
                     if telegram_id:
-                        logger.warning(f"Получен 401 при запросе прогресса для telegram_id={telegram_id}, обновляем токен")
+                        logger.warning("Получен 401 при запросе прогресса для telegram_id=%s, обновляем токен", telegram_id)
                         new_token = await self._refresh_access_token(telegram_id)
                         if not new_token:
-                            logger.info(f"Refresh token истек или не получен, перерегистрируем пользователя telegram_id={telegram_id}")
+                            logger.info("Refresh token истек или не получен, перерегистрируем пользователя telegram_id=%s", telegram_id, extra={"sample": 20})
                             new_token = await self._get_user_token(
                                 telegram_id=telegram_id,
                                 username=username,
@@ -1329,82 +1542,42 @@ class API:
                                 photo_url=photo_url
                             )
                         if new_token:
-                            logger.info(f"Токен обновлен для telegram_id={telegram_id}, повторяем запрос прогресса")
-                            await session.close()
+                            logger.info("Токен обновлен для telegram_id=%s, повторяем запрос прогресса", telegram_id, extra={"sample": 20})
                             session = await self._get_session(access_token=new_token)
-                            async with session.get(url) as retry_response:
+                            async with session.get(url, headers=self._conditional_headers(cached)) as retry_response:
                                 if retry_response.status == 401:
-                                    logger.error(f"Токен все еще недействителен после обновления для telegram_id={telegram_id}")
+                                    logger.error("Токен все еще недействителен после обновления для telegram_id=%s", telegram_id)
                                     raise Exception("Токен недействителен даже после обновления. Попробуйте отправить /start")
-                                retry_response.raise_for_status()
-                                habits = await retry_response.json()
+                                habits = await self._read_conditional(retry_response, cache_key, cached)
                         else:
-                            logger.error(f"Не удалось обновить токен для telegram_id={telegram_id}")
+                            logger.error("Не удалось обновить токен для telegram_id=%s", telegram_id)
                             raise Exception("Токен истёк, не удалось обновить. Попробуйте отправить /start")
                     else:
                         logger.error("Получен 401 без telegram_id при запросе прогресса")
                         raise Exception("Ошибка авторизации (401). Попробуйте отправить /start для регистрации")
                 else:
-                    response.raise_for_status()
-                    habits = await response.json()
+                    habits = await self._read_conditional(response, cache_key, cached)
         except aiohttp.ClientConnectorError as e:
-            logger.error(f"Не удалось подключиться к серверу {self.base_url} при запросе прогресса: {e}")
+            logger.error("Не удалось подключиться к серверу %s при запросе прогресса: %s", self.base_url, e)
             raise Exception(f"Не удалось подключиться к серверу. Проверь, что бэкенд запущен на {self.base_url}")
         except aiohttp.ClientError as e:
-            logger.error(f"Ошибка сети при запросе прогресса к {self.base_url}: {e}")
+            logger.error("Ошибка сети при запросе прогресса к %s: %s", self.base_url, e)
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
-            logger.error(f"Ошибка API при запросе прогресса: {e}")
+            logger.error("Ошибка API при запросе прогресса: %s", e)
             raise Exception(f"Ошибка API: {e}")
 
-        mapped_habits = [self._map_habit_from_backend(h) for h in habits]
+        if not isinstance(habits, list):
+            habits = []
 
-        total_days = 1 if period == "today" else (7 if period == "week" else 30)
-
-        habits_progress = []
-        total_completed = 0
-        total_habits = 0
-        best_streak = None
-        max_streak = 0
-
-        for habit in mapped_habits:
-            streak = habit.get("streak", 0)
-            completed = min(streak, total_days)
-            total = total_days
-
-            habits_progress.append(
-                {
-                    "id": habit.get("id"),
-                    "name": habit.get("name"),
-                    "emoji": habit.get("emoji", "📌"),
-                    "completed": completed,
-                    "total": total,
-                }
-            )
-
-            total_completed += completed
-            total_habits += total
-
-            if streak > max_streak:
-                max_streak = streak
-                best_streak = {
-                    "name": habit.get("name"),
-                    "days": streak,
-                }
+        mapped_habits = [self._map_habit_from_backend(h) for h in habits]
+        if not telegram_id:
+            return progress_aggregates.summarize(progress_aggregates.from_habits(mapped_habits), total_days)
+        await self._sync_history(telegram_id, mapped_habits, complete=True)
 
-        return {
-            "habits": habits_progress,
-            "total": {
-                "completed": total_completed,
-                "total": total_habits,
-            },
-            "best_streak": best_streak or {"name": "Нет данных", "days": 0},
-        }
+        aggregates = await progress_aggregates.get_user(telegram_id)
+        return progress_aggregates.summarize(aggregates or {}, total_days)
     
-    async def close(self):
-        if self.session and not self.session.closed:
-            await self.session.close()
-
     async def _delete(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
         telegram_id = params.get("telegram_id") if params else None
         username = params.get("username")
@@ -1439,10 +1612,6 @@ class API:
         if not access_token:
             raise Exception("Токен не доступен")
 
-        if self.session and not self.session.closed:
-            await self.session.close()
-            self.session = None
-        
         session = await self._get_session(access_token=access_token)
         
         if path.startswith("/habits/delete/"):
@@ -1463,26 +1632,33 @@ class API:
                                     photo_url=photo_url
                                 )
                             if new_token:
-                                await session.close()
                                 session = await self._get_session(access_token=new_token)
                                 async with session.delete(url) as retry_response:
                                     retry_response.raise_for_status()
-                                    return await retry_response.json()
+                                    result = await retry_response.json(loads=json_codec.loads)
                             else:
                                 raise Exception("Токен истёк, требуется повторная регистрация")
                         else:
                             response.raise_for_status()
-                            return await response.json()
+                            result = await response.json(loads=json_codec.loads)
                 except aiohttp.ClientError as e:
                     raise Exception(f"Ошибка сети: {e}")
                 except Exception as e:
                     raise Exception(f"Ошибка API: {e}")
+
+                try:
+                    if telegram_id:
+                        await habit_history.forget(telegram_id, int(habit_id))
+                        await progress_aggregates.forget(telegram_id, int(habit_id))
+                except Exception as e:
+                    logger.warning("Не удалось удалить историю привычки %s: %s", habit_id, e)
+                return result
         
         url = f"{self.base_url}{path}"
         try:
             async with session.delete(url, params=params) as response:
                 response.raise_for_status()
-                return await response.json()
+                return await response.json(loads=json_codec.loads)
         except aiohttp.ClientError as e:
             raise Exception(f"Ошибка сети: {e}")
         except Exception as e:
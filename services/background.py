@@ -0,0 +1,56 @@
+"""
+Фоновые задачи бота.
+
+Задачи, запущенные через spawn, хранятся до завершения, чтобы при остановке
+бота их можно было дождаться (drain), а не потерять вместе с циклом событий.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+_tasks: Set[asyncio.Task] = set()
+
+
+def spawn(coro: Awaitable, name: Optional[str] = None) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    if name:
+        task.set_name(name)
+    _tasks.add(task)
+    task.add_done_callback(_done)
+    return task
+
+
+def _done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка в фоновой задаче {task.get_name()}: {task.exception()}", exc_info=task.exception())
+
+
+def pending() -> int:
+    return len(_tasks)
+
+
+async def wait_tasks(tasks: Set[asyncio.Task], timeout: float, what: str) -> int:
+    """
+    Дождаться задач не дольше timeout секунд, незавершённые отменить
+
+    Returns:
+        Количество отменённых задач
+    """
+    tasks = {task for task in tasks if not task.done()}
+    if not tasks:
+        return 0
+    _, unfinished = await asyncio.wait(tasks, timeout=max(0.0, timeout))
+    for task in unfinished:
+        task.cancel()
+    if unfinished:
+        await asyncio.gather(*unfinished, return_exceptions=True)
+        logger.warning(f"{what}: не завершились за отведённое время и отменены: {len(unfinished)}")
+    return len(unfinished)
+
+
+async def drain(timeout: float) -> int:
+    """Дождаться фоновых задач, запущенных через spawn"""
+    return await wait_tasks(set(_tasks), timeout, "Фоновые задачи")
@@ -0,0 +1,52 @@
+"""
+Хранилище FSM в памяти без записей для пользователей вне диалога.
+
+MemoryStorage из aiogram держит defaultdict: любое чтение состояния создаёт
+запись, поэтому со временем в памяти оказывается по записи на каждого
+написавшего боту. Здесь запись существует, только пока у пользователя есть
+состояние или данные, и удаляется после state.clear().
+"""
+from copy import copy
+from typing import Any, Dict, Mapping, Optional
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage, MemoryStorageRecord
+
+
+class CompactMemoryStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.storage: Dict[StorageKey, MemoryStorageRecord] = {}
+
+    def _store(self, key: StorageKey, record: MemoryStorageRecord):
+        if record.state is None and not record.data:
+            self.storage.pop(key, None)
+        else:
+            self.storage[key] = record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self.storage.get(key) or MemoryStorageRecord()
+        record.state = state.state if isinstance(state, State) else state
+        self._store(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.storage.get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        record = self.storage.get(key) or MemoryStorageRecord()
+        record.data = data.copy()
+        self._store(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self.storage.get(key)
+        return record.data.copy() if record else {}
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any = None) -> Any:
+        record = self.storage.get(storage_key)
+        if record is None:
+            return default
+        return copy(record.data.get(dict_key, default))
@@ -0,0 +1,305 @@
+"""
+Локальная история выполнения привычек.
+
+Для каждой пары (telegram_id, habit_id) хранится битовая карта по дням:
+бит i соответствует дню origin + i (порядковый номер даты, date.toordinal()).
+Статистика за неделю/месяц, серии и частота считаются битовыми операциями
+над целым числом, без циклов по дням.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from datetime import date, timedelta
+from itertools import islice
+from typing import Optional, Dict, Any, List, Set, Tuple, Iterable
+import aiosqlite
+from config import TOKEN_WRITE_DELAY_MS, TOKEN_WRITE_BATCH
+from services.migrations import migrate
+from services.token_storage import token_storage, LOAD_CHUNK
+
+logger = logging.getLogger(__name__)
+
+HISTORY_CACHE_SIZE = 10000
+
+
+def _popcount(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+def _window(bits: int, origin: int, end_day: int, days: int) -> int:
+    """Биты за days дней, заканчивающихся end_day; бит 0 — самый старый день"""
+    shift = end_day - days + 1 - origin
+    window = bits >> shift if shift >= 0 else bits << -shift
+    return window & ((1 << days) - 1)
+
+
+def _current_streak(bits: int, origin: int, end_day: int) -> int:
+    """Длина серии, заканчивающейся end_day (или вчера, если сегодня ещё не отмечено)"""
+    last = end_day - origin
+    if last < 0:
+        return 0
+    if not (bits >> last) & 1:
+        last -= 1
+        if last < 0 or not (bits >> last) & 1:
+            return 0
+    mask = (1 << (last + 1)) - 1
+    gaps = (bits & mask) ^ mask
+    return last - gaps.bit_length() + 1
+
+
+def _best_streak(bits: int) -> int:
+    streak = 0
+    while bits:
+        bits &= bits >> 1
+        streak += 1
+    return streak
+
+
+def _to_blob(bits: int) -> bytes:
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+
+class HabitHistory:
+    """
+    История выполнения привычек с отложенной записью.
+
+    Битовые карты живут в памяти и читаются из базы один раз на пару
+    (telegram_id, habit_id). Изменения копятся и сохраняются одной транзакцией
+    через write_delay_ms миллисекунд или при накоплении write_batch пар, как
+    в TokenStorage; при write_delay_ms = 0 запись синхронная. В памяти
+    остаются не больше max_size давно не использованных пар, кроме ещё
+    не сохранённых.
+    """
+
+    def __init__(self, db_path: str = "data/tokens.db", write_delay_ms: float = 0, write_batch: int = 200,
+                 max_size: int = HISTORY_CACHE_SIZE):
+        self.db_path = db_path
+        self.write_delay = write_delay_ms / 1000
+        self.write_batch = write_batch
+        self.max_size = max_size
+        self._initialized = False
+        self._cache: "OrderedDict[Tuple[int, int], List[int]]" = OrderedDict()
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._deleted: Set[Tuple[int, int]] = set()
+        # Пары, которые сейчас записываются в базу: их нельзя вытеснить до конца записи
+        self._flushing: Set[Tuple[int, int]] = set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+
+    async def _init_db(self):
+        if self._initialized:
+            return
+
+        await migrate(self.db_path)
+        self._initialized = True
+
+    async def _load(self, keys: Iterable[Tuple[int, int]]):
+        """Прочитать из базы историю пользователей, у которых есть отсутствующие в памяти пары"""
+        missing = [key for key in keys if key not in self._cache]
+        if not missing:
+            return
+
+        telegram_ids = sorted({telegram_id for telegram_id, _ in missing})
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path) as db:
+            for start in range(0, len(telegram_ids), LOAD_CHUNK):
+                chunk = telegram_ids[start:start + LOAD_CHUNK]
+                cursor = await db.execute(
+                    f"SELECT telegram_id, habit_id, origin, bitmap FROM habit_history "
+                    f"WHERE bot_id = ? AND telegram_id IN ({','.join('?' * len(chunk))})",
+                    (token_storage.bot_id, *chunk)
+                )
+                for telegram_id, habit_id, origin, blob in await cursor.fetchall():
+                    self._cache.setdefault((telegram_id, habit_id), [origin, int.from_bytes(blob, "little")])
+        for key in missing:
+            self._cache.setdefault(key, [0, 0])
+
+    def _evict(self):
+        """Вытеснить давно не использованные пары сверх max_size, кроме несохранённых"""
+        excess = len(self._cache) - self.max_size
+        if excess <= 0:
+            return
+        pinned = self._dirty | self._deleted | self._flushing
+        evicted = list(islice((key for key in self._cache if key not in pinned), excess))
+        for key in evicted:
+            del self._cache[key]
+
+    def _apply(self, telegram_id: int, habit_id: int, done: bool, day: int) -> bool:
+        key = (telegram_id, habit_id)
+        entry = self._cache[key]
+        self._cache.move_to_end(key)
+        origin, bits = entry
+        if not bits:
+            origin = day
+        elif day < origin:
+            bits <<= origin - day
+            origin = day
+
+        bit = 1 << (day - origin)
+        new_bits = bits | bit if done else bits & ~bit
+        if not new_bits:
+            origin = 0
+        if origin == entry[0] and new_bits == entry[1]:
+            return False
+        entry[0], entry[1] = origin, new_bits
+        return True
+
+    def _cache_row(self, telegram_id: int, habit_id: int) -> Tuple[int, bytes]:
+        origin, bits = self._cache[(telegram_id, habit_id)]
+        return origin, _to_blob(bits)
+
+    async def _schedule_flush(self):
+        if not self.write_delay or len(self._dirty) + len(self._deleted) >= self.write_batch:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.write_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при отложенной записи истории привычек: {e}", exc_info=True)
+
+    async def flush(self):
+        """Сохранить накопленные изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty and not self._deleted:
+                return
+            dirty, self._dirty = self._dirty, set()
+            deleted, self._deleted = self._deleted, set()
+            bot_id = token_storage.bot_id
+            rows = [(bot_id, *key, *self._cache_row(*key)) for key in dirty if key in self._cache]
+            self._flushing = dirty | deleted
+            try:
+                await self._init_db()
+                async with aiosqlite.connect(self.db_path) as db:
+                    if deleted:
+                        await db.executemany(
+                            "DELETE FROM habit_history WHERE bot_id = ? AND telegram_id = ? AND habit_id = ?",
+                            [(bot_id, *key) for key in deleted]
+                        )
+                    if rows:
+                        await db.executemany(
+                            "INSERT OR REPLACE INTO habit_history (bot_id, telegram_id, habit_id, origin, bitmap) VALUES (?, ?, ?, ?, ?)",
+                            rows
+                        )
+                    await db.commit()
+            except Exception:
+                self._deleted |= deleted - self._dirty
+                self._dirty |= dirty - self._deleted
+                raise
+            finally:
+                self._flushing = set()
+            self._evict()
+
+    async def record(self, telegram_id: int, habit_id: int, done: bool, day: Optional[date] = None) -> bool:
+        """Отметить выполнение (или отмену) привычки за день. Возвращает True, если история изменилась"""
+        changed = await self.sync(telegram_id, [(habit_id, done)], day)
+        return bool(changed)
+
+    async def sync(self, telegram_id: int, items: Iterable[Tuple[int, bool]],
+                   day: Optional[date] = None) -> List[int]:
+        """
+        Синхронизировать состояние нескольких привычек за день
+
+        База читается только для пар, которых ещё нет в памяти; изменения
+        записываются отложенно (см. flush).
+
+        Args:
+            telegram_id: ID пользователя в Telegram
+            items: Пары (habit_id, выполнено ли)
+            day: День (по умолчанию сегодня)
+
+        Returns:
+            Список habit_id, история которых изменилась
+        """
+        changed = await self.sync_many([(telegram_id, items)], day)
+        return changed.get(telegram_id, [])
+
+    async def sync_many(self, users: Iterable[Tuple[int, Iterable[Tuple[int, bool]]]],
+                        day: Optional[date] = None) -> Dict[int, List[int]]:
+        """
+        То же, что sync, для многих пользователей: одно чтение базы на всех
+
+        Returns:
+            {telegram_id: список изменившихся habit_id}
+        """
+        users = [
+            (telegram_id, [(int(habit_id), bool(done)) for habit_id, done in items if habit_id is not None])
+            for telegram_id, items in users
+        ]
+        ordinal = (day or date.today()).toordinal()
+
+        await self._load((telegram_id, habit_id) for telegram_id, items in users for habit_id, _ in items)
+        result: Dict[int, List[int]] = {}
+        for telegram_id, items in users:
+            changed = [
+                habit_id for habit_id, done in items
+                if self._apply(telegram_id, habit_id, done, ordinal)
+            ]
+            for habit_id in changed:
+                key = (telegram_id, habit_id)
+                self._deleted.discard(key)
+                self._dirty.add(key)
+            result[telegram_id] = changed
+        self._evict()
+        if any(result.values()):
+            await self._schedule_flush()
+        return result
+
+    async def forget(self, telegram_id: int, habit_id: int):
+        key = (telegram_id, int(habit_id))
+        # пустая запись в памяти не даёт перечитать строку из базы до её удаления
+        self._cache[key] = [0, 0]
+        self._dirty.discard(key)
+        self._deleted.add(key)
+        await self._schedule_flush()
+
+    async def get_bitmap(self, telegram_id: int, habit_id: int) -> Tuple[int, int]:
+        key = (telegram_id, int(habit_id))
+        await self._load([key])
+        self._cache.move_to_end(key)
+        origin, bits = self._cache[key]
+        self._evict()
+        return origin, bits
+
+    async def window(self, telegram_id: int, habit_id: int, days: int, day: Optional[date] = None) -> int:
+        """Биты за последние days дней; бит days - 1 — сегодняшний день"""
+        origin, bits = await self.get_bitmap(telegram_id, habit_id)
+        if not bits:
+            return 0
+        return _window(bits, origin, (day or date.today()).toordinal(), days)
+
+    async def stats(self, telegram_id: int, habit_id: int, days: int,
+                    day: Optional[date] = None) -> Dict[str, Any]:
+        origin, bits = await self.get_bitmap(telegram_id, habit_id)
+        today = (day or date.today()).toordinal()
+
+        completed = _popcount(_window(bits, origin, today, days)) if bits else 0
+        last_completed = None
+        if bits:
+            last_completed = date.fromordinal(origin + bits.bit_length() - 1)
+
+        return {
+            "completed": completed,
+            "total": days,
+            "current_streak": _current_streak(bits, origin, today) if bits else 0,
+            "best_streak": _best_streak(bits),
+            "last_completed": last_completed,
+            "avg_frequency": round(completed / days * 7, 1) if days else 0,
+        }
+
+    async def days(self, telegram_id: int, habit_id: int, days: int,
+                   day: Optional[date] = None) -> List[Tuple[date, bool]]:
+        """Список (дата, выполнено) за последние days дней, начиная с сегодняшнего"""
+        origin, bits = await self.get_bitmap(telegram_id, habit_id)
+        end = day or date.today()
+        window = _window(bits, origin, end.toordinal(), days) if bits else 0
+        flags = format(window, f"0{days}b")
+        return [(end - timedelta(days=i), flags[i] == "1") for i in range(days)]
+
+
+habit_history = HabitHistory(write_delay_ms=TOKEN_WRITE_DELAY_MS, write_batch=TOKEN_WRITE_BATCH)
@@ -0,0 +1,47 @@
+"""
+Счётчики и времена выполнения операций бота для мониторинга
+"""
+from collections import Counter, deque
+from typing import Deque, Dict, Any
+
+TIMING_WINDOW = 1024
+
+
+class Metrics:
+    def __init__(self, timing_window: int = TIMING_WINDOW):
+        self.counters: Counter = Counter()
+        self.timing_window = timing_window
+        self.timings: Dict[str, Deque[float]] = {}
+        self.timing_counts: Counter = Counter()
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        """Записать длительность операции; перцентили считаются по последним timing_window замерам"""
+        window = self.timings.get(name)
+        if window is None:
+            window = self.timings[name] = deque(maxlen=self.timing_window)
+        window.append(seconds)
+        self.timing_counts[name] += 1
+
+    @staticmethod
+    def _percentiles(samples: list) -> Dict[str, float]:
+        samples.sort()
+        last = len(samples) - 1
+        return {
+            "p50_ms": round(samples[last * 50 // 100] * 1000, 2),
+            "p95_ms": round(samples[last * 95 // 100] * 1000, 2),
+            "p99_ms": round(samples[last * 99 // 100] * 1000, 2),
+            "max_ms": round(samples[last] * 1000, 2),
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        timings = {}
+        for name, window in self.timings.items():
+            if window:
+                timings[name] = {"count": self.timing_counts[name], **self._percentiles(list(window))}
+        return {"counters": dict(self.counters), "timings": timings}
+
+
+metrics = Metrics()
@@ -0,0 +1,247 @@
+"""
+Миграции схемы базы данных токенов.
+
+Текущая версия схемы хранится в таблице schema_version. Каждая миграция
+выполняется в своей транзакции (BEGIN IMMEDIATE), поэтому несколько
+процессов бота с общей базой не применят одну миграцию дважды.
+"""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Tuple
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+Migration = Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+async def _create_tokens(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS tokens (
+            telegram_id INTEGER PRIMARY KEY,
+            access_token TEXT,
+            refresh_token TEXT,
+            user_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            photo_url TEXT
+        )
+    ''')
+
+
+async def _add_bot_id(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE tokens_new (
+            bot_id INTEGER NOT NULL DEFAULT 0,
+            telegram_id INTEGER NOT NULL,
+            access_token TEXT,
+            refresh_token TEXT,
+            user_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            photo_url TEXT,
+            PRIMARY KEY (bot_id, telegram_id)
+        )
+    ''')
+    await db.execute('''
+        INSERT INTO tokens_new
+        (bot_id, telegram_id, access_token, refresh_token, user_id, username, first_name, last_name, photo_url)
+        SELECT 0, telegram_id, access_token, refresh_token, user_id, username, first_name, last_name, photo_url
+        FROM tokens
+    ''')
+    await db.execute("DROP TABLE tokens")
+    await db.execute("ALTER TABLE tokens_new RENAME TO tokens")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tokens_user_id ON tokens (bot_id, user_id)")
+
+
+async def _create_notification_slots(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS notification_slots (
+            bot_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            slot TEXT NOT NULL,
+            utc_minute INTEGER NOT NULL,
+            PRIMARY KEY (bot_id, telegram_id, slot)
+        )
+    ''')
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notification_slots_utc_minute ON notification_slots (bot_id, utc_minute)"
+    )
+
+
+async def _create_habit_history(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS habit_history (
+            telegram_id INTEGER NOT NULL,
+            habit_id INTEGER NOT NULL,
+            origin INTEGER NOT NULL,
+            bitmap BLOB NOT NULL,
+            PRIMARY KEY (telegram_id, habit_id)
+        )
+    ''')
+
+
+async def _create_habit_progress(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS habit_progress (
+            telegram_id INTEGER NOT NULL,
+            habit_id INTEGER NOT NULL,
+            name TEXT,
+            emoji TEXT,
+            day INTEGER NOT NULL,
+            bits INTEGER NOT NULL,
+            streak INTEGER NOT NULL,
+            streak_day INTEGER NOT NULL,
+            PRIMARY KEY (telegram_id, habit_id)
+        )
+    ''')
+
+
+async def _create_scheduler_tables(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_leases (
+            shard INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_workers (
+            worker_id TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_watermarks (
+            shard INTEGER PRIMARY KEY,
+            watermark REAL NOT NULL
+        )
+    ''')
+
+
+async def _rebuild_with_bot_id(db: aiosqlite.Connection, table: str, definition: str, columns: str):
+    """Пересоздать таблицу с bot_id в первичном ключе; старые строки получают bot_id = 0"""
+    await db.execute(f"CREATE TABLE {table}_new ({definition})")
+    if columns:
+        await db.execute(f"INSERT INTO {table}_new (bot_id, {columns}) SELECT 0, {columns} FROM {table}")
+    await db.execute(f"DROP TABLE {table}")
+    await db.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+async def _scope_by_bot_id(db: aiosqlite.Connection):
+    await _rebuild_with_bot_id(db, "habit_history", '''
+        bot_id INTEGER NOT NULL DEFAULT 0,
+        telegram_id INTEGER NOT NULL,
+        habit_id INTEGER NOT NULL,
+        origin INTEGER NOT NULL,
+        bitmap BLOB NOT NULL,
+        PRIMARY KEY (bot_id, telegram_id, habit_id)
+    ''', "telegram_id, habit_id, origin, bitmap")
+    await _rebuild_with_bot_id(db, "habit_progress", '''
+        bot_id INTEGER NOT NULL DEFAULT 0,
+        telegram_id INTEGER NOT NULL,
+        habit_id INTEGER NOT NULL,
+        name TEXT,
+        emoji TEXT,
+        day INTEGER NOT NULL,
+        bits INTEGER NOT NULL,
+        streak INTEGER NOT NULL,
+        streak_day INTEGER NOT NULL,
+        PRIMARY KEY (bot_id, telegram_id, habit_id)
+    ''', "telegram_id, habit_id, name, emoji, day, bits, streak, streak_day")
+    # Аренды и список живых процессов продлеваются каждые lease_ttl / 3 секунды, переносить их незачем
+    await _rebuild_with_bot_id(db, "scheduler_leases", '''
+        bot_id INTEGER NOT NULL DEFAULT 0,
+        shard INTEGER NOT NULL,
+        owner TEXT,
+        expires_at REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (bot_id, shard)
+    ''', "")
+    await _rebuild_with_bot_id(db, "scheduler_workers", '''
+        bot_id INTEGER NOT NULL DEFAULT 0,
+        worker_id TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (bot_id, worker_id)
+    ''', "")
+    await _rebuild_with_bot_id(db, "scheduler_watermarks", '''
+        bot_id INTEGER NOT NULL DEFAULT 0,
+        shard INTEGER NOT NULL,
+        watermark REAL NOT NULL,
+        PRIMARY KEY (bot_id, shard)
+    ''', "shard, watermark")
+
+
+# Таблицы 4–6 раньше создавались модулями при первом обращении, поэтому
+# миграции используют IF NOT EXISTS: в существующих базах они уже есть
+MIGRATIONS: List[Tuple[int, Migration]] = [
+    (1, _create_tokens),
+    (2, _add_bot_id),
+    (3, _create_notification_slots),
+    (4, _create_habit_history),
+    (5, _create_habit_progress),
+    (6, _create_scheduler_tables),
+    (7, _scope_by_bot_id),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_applied: Dict[str, int] = {}
+_lock = asyncio.Lock()
+
+
+async def _current_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("SELECT MAX(version) FROM schema_version")
+    row = await cursor.fetchone()
+    return row[0] or 0
+
+
+async def migrate(db_path: str = "data/tokens.db") -> int:
+    """
+    Применить недостающие миграции
+
+    Args:
+        db_path: Путь к файлу базы данных
+
+    Returns:
+        Версия схемы после миграции
+    """
+    if _applied.get(db_path) == SCHEMA_VERSION:
+        return SCHEMA_VERSION
+
+    async with _lock:
+        if _applied.get(db_path) == SCHEMA_VERSION:
+            return SCHEMA_VERSION
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        async with aiosqlite.connect(db_path, timeout=30) as db:
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            await db.commit()
+
+            version = await _current_version(db)
+            for target, migration in MIGRATIONS:
+                if target <= version:
+                    continue
+                await db.execute("BEGIN IMMEDIATE")
+                try:
+                    if await _current_version(db) >= target:
+                        await db.rollback()
+                        continue
+                    await migration(db)
+                    await db.execute("INSERT INTO schema_version (version) VALUES (?)", (target,))
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+                logger.info(f"База данных {db_path}: применена миграция {target} ({migration.__name__})")
+            version = await _current_version(db)
+
+        _applied[db_path] = version
+        return version
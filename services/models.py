@@ -0,0 +1,110 @@
+"""
+Модели данных, получаемых от бэкенда
+"""
+from types import MappingProxyType
+from typing import Any, Dict, Tuple
+
+DEFAULT_REMINDER_SETTINGS = MappingProxyType({
+    "enabled": True,
+    "time": "18:00",
+    "days": ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"),
+})
+
+
+def _display_quantity(unit: str, value: Any, progress: Any) -> Tuple[Any, Any, str]:
+    """Перевести минуты в часы для отображения, если цель кратна часу"""
+    if unit == "минут" and value >= 60 and value % 60 == 0:
+        return value / 60, progress / 60, "часов"
+    return value, progress, unit
+
+
+_QUANTITY_TYPES = frozenset(("time", "count"))
+_new = object.__new__
+
+
+class Habit:
+    """
+    Привычка в формате бота.
+
+    Создаётся один раз на ответ бэкенда и поддерживает доступ как к словарю
+    (habit.get("name"), habit["goal"]), чтобы обработчики работали без изменений.
+    """
+    __slots__ = ("id", "name", "emoji", "progress", "goal", "unit", "completed", "type", "streak")
+
+    _KEYS = frozenset(__slots__) | {"reminder_settings"}
+
+    reminder_settings = DEFAULT_REMINDER_SETTINGS
+
+    def __init__(self, id: Any, name: str, progress: Any, goal: Any, unit: str, completed: bool,
+                 type: str, streak: int, emoji: str = "📌"):
+        self.id = id
+        self.name = name
+        self.emoji = emoji
+        self.progress = progress
+        self.goal = goal
+        self.unit = unit
+        self.completed = completed
+        self.type = type
+        self.streak = streak
+
+    @classmethod
+    def from_backend(cls, h: Dict[str, Any]) -> "Habit":
+        get = h.get
+        value = get("value", 0) or 0
+        is_done = get("is_done", False)
+        progress = get("progress") or get("current_value") or (value if is_done else 0)
+        unit = get("unit") or ""
+        if unit == "минут":
+            value, progress, unit = _display_quantity(unit, value, progress)
+
+        habit = _new(cls)
+        habit.id = get("id")
+        habit.name = get("title", "Привычка")
+        habit.emoji = "📌"
+        habit.progress = progress
+        habit.goal = value
+        habit.unit = unit
+        habit.completed = is_done
+        habit.type = "quantity" if get("type", "count") in _QUANTITY_TYPES else "boolean"
+        habit.streak = get("series") or 0
+        return habit
+
+    @classmethod
+    def empty(cls) -> "Habit":
+        """Привычка для пустого ответа бэкенда; ложна в логическом контексте, как пустой словарь"""
+        return cls(id=None, name="Привычка", progress=0, goal=0, unit="", completed=False, type="boolean", streak=0)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self._KEYS:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._KEYS
+
+    def keys(self):
+        return self._KEYS
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {key: getattr(self, key) for key in self.__slots__}
+        data["reminder_settings"] = dict(self.reminder_settings)
+        return data
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Habit):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __bool__(self) -> bool:
+        return self.id is not None
+
+    def __repr__(self) -> str:
+        return f"Habit(id={self.id!r}, name={self.name!r}, completed={self.completed!r})"
@@ -1,261 +1,690 @@
 import logging
 import asyncio
-from datetime import datetime, timedelta
+import heapq
+import time
+from collections import deque
+from datetime import datetime, date, timedelta
+from typing import Optional, Dict, Any, List, Tuple, Set, Deque
 import pytz
 from aiogram import Bot
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from services.api import api
+from services.background import spawn, wait_tasks
+from services.user_registry import user_registry
 from services.token_storage import token_storage
+from services.scheduler_shards import ShardLeaseManager
+from config import (
+    SCHEDULER_SHARDS, SCHEDULER_WORKER_ID, SCHEDULER_LEASE_TTL, SCHEDULER_REFRESH_INTERVAL,
+    SCHEDULER_CATCHUP_MAX_AGE, SCHEDULER_CATCHUP_RATE, SCHEDULER_PREFETCH_SECONDS,
+    USERS_BATCH_SIZE
+)
 
 logger = logging.getLogger(__name__)
 
+MINUTES_PER_DAY = 24 * 60
+
+# Общая для всех напоминаний разметка. Модели aiogram не заморожены (inline_keyboard —
+# обычный список), поэтому изменять её нельзя
+REMINDER_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📋 Открыть список", callback_data="back_today")],
+    [InlineKeyboardButton(text="✅ Отметить все выполненными", callback_data="morning_complete_all")],
+])
+
+
+def render_reminder(habits: list) -> str:
+    """Текст напоминания о привычках на сегодня"""
+    pending = []
+    completed = []
+    for habit in habits:
+        emoji = habit.get("emoji", "📌")
+        title = habit.get("name", "Привычка")
+        if habit.get("completed", False):
+            completed.append(f"✅ {emoji} {title}")
+            continue
+        unit = habit.get("unit", "")
+        if unit:
+            pending.append(f"{emoji} {title} — {habit.get('goal', 0)} {unit}")
+        else:
+            pending.append(f"{emoji} {title}")
+
+    parts = ["⏰ Напоминание о привычках:\n"]
+    if pending:
+        parts.extend(pending)
+    if completed:
+        if pending:
+            parts.append("")
+        parts.append("✅ Выполнено:")
+        parts.extend(completed)
+    parts.append("\n💪 Ты справишься!")
+    return "\n".join(parts)
+
+
+def next_fire_time(slot: str, tz: Any, after: datetime) -> Tuple[float, date]:
+    """
+    Ближайший момент срабатывания слота HH:MM в часовом поясе пользователя
+
+    Несуществующее при переходе на летнее время локальное время сдвигается
+    вперёд на величину перехода, а повторяющееся при переходе на зимнее
+    срабатывает один раз — в первый из двух моментов.
+
+    Args:
+        slot: Время в формате HH:MM
+        tz: Часовой пояс pytz
+        after: Момент (aware datetime), после которого ищется срабатывание
+
+    Returns:
+        UTC timestamp срабатывания и локальная дата слота
+    """
+    hour, minute = map(int, slot.split(":"))
+    after_ts = after.timestamp()
+    day = after.astimezone(tz).date()
+
+    for offset in range(3):
+        current = day + timedelta(days=offset)
+        naive = datetime(current.year, current.month, current.day, hour, minute)
+        try:
+            local = tz.localize(naive, is_dst=None)
+        except pytz.exceptions.AmbiguousTimeError:
+            local = tz.localize(naive, is_dst=True)
+        except pytz.exceptions.NonExistentTimeError:
+            local = tz.normalize(tz.localize(naive, is_dst=False))
+        fire_ts = local.timestamp()
+        if fire_ts > after_ts:
+            return fire_ts, current
+    raise ValueError(f"Не удалось вычислить время срабатывания для {slot}")
+
+
+class UserSchedule:
+    __slots__ = ("notify_times", "timezone", "dnd", "user_data", "generation")
+
+    def __init__(self, notify_times: Tuple[str, ...], timezone: Any, dnd: bool,
+                 user_data: Dict[str, Any], generation: int):
+        self.notify_times = notify_times
+        self.timezone = timezone
+        self.dnd = dnd
+        self.user_data = user_data
+        self.generation = generation
+
 
 class NotificationScheduler:
-    def __init__(self, bot: Bot, check_interval: int = 10):
+    """
+    Планировщик напоминаний на основе кучи срабатываний.
+
+    Для каждого пользователя из своих шардов планировщик хранит настройки
+    и кладёт в кучу ближайшие моменты (UTC) для каждого времени из notify_times.
+    Цикл спит до ближайшего срабатывания или до сигнала об изменении настроек;
+    устаревшие записи кучи отбрасываются по номеру поколения пользователя.
+
+    Для каждого шарда сохраняется отметка времени, до которой все слоты
+    обработаны. При запуске или получении шарда слоты, пропущенные с этой
+    отметки, но не старше SCHEDULER_CATCHUP_MAX_AGE, досылаются отдельной
+    очередью со скоростью не выше SCHEDULER_CATCHUP_RATE сообщений в секунду
+    (0 — без ограничения).
+    """
+
+    def __init__(self, bot: Bot, check_interval: int = 10, refresh_interval: float = SCHEDULER_REFRESH_INTERVAL):
         self.bot = bot
         self.check_interval = check_interval
+        self.refresh_interval = refresh_interval
         self.running = False
-        self.last_sent_notifications = {}
+        # День (date.toordinal()) и битовая маска отправленных за него слотов по индексу пользователя в реестре;
+        # бит — позиция слота в notify_times; при изменении notify_times биты переносятся (_remap_sent_slots)
+        self.sent_day = user_registry.field("scheduler.sent_day", "l")
+        self.sent_slots = user_registry.field("scheduler.sent_slots", "Q")
+        self.shards = ShardLeaseManager(
+            shard_count=SCHEDULER_SHARDS,
+            worker_id=SCHEDULER_WORKER_ID,
+            lease_ttl=SCHEDULER_LEASE_TTL
+        )
+        self._schedules: Dict[int, UserSchedule] = {}
+        self._heap: List[Tuple[float, int, int, str, date]] = []
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+        self._refresh_requested = asyncio.Event()
+        self.catch_up_max_age = SCHEDULER_CATCHUP_MAX_AGE
+        self.catch_up_rate = SCHEDULER_CATCHUP_RATE
+        self._catch_up: Deque[Tuple[float, int, int, str, date]] = deque()
+        self._catch_up_ready = asyncio.Event()
+        self._ready_shards: Set[int] = set()
+        # Записи текущей пачки срабатываний, ещё не обработанные до конца (по возрастанию времени)
+        self._in_flight: Deque[Tuple[float, int, int, str, date]] = deque()
+        self.prefetch_seconds = SCHEDULER_PREFETCH_SECONDS
+        self._prefetched_until = 0.0
+        self._prepared: Dict[Tuple[int, str, date], Tuple[float, asyncio.Future]] = {}
+        self._dirty_slots: Dict[int, List[Tuple[str, int]]] = {}
+        self._lease_task: Optional[asyncio.Task] = None
+        self._tasks: List[asyncio.Task] = []
+        api.add_settings_listener(self._on_settings_changed)
     
     async def start(self):
         self.running = True
-        asyncio.create_task(self._scheduler_loop())
+        await self.shards.renew()
+        self._lease_task = asyncio.create_task(self._lease_loop())
+        self._tasks = [
+            asyncio.create_task(self._refresh_loop()),
+            asyncio.create_task(self._scheduler_loop()),
+            asyncio.create_task(self._catch_up_loop()),
+        ]
     
-    async def stop(self):
+    async def stop(self, timeout: float = 10.0):
+        """
+        Остановить планировщик: дождаться отправок, которые уже начались,
+        не дольше timeout секунд, сохранить отметку обработанного времени
+        и освободить шарды. Неотправленные напоминания и досылка останутся
+        за отметкой и будут досланы после перезапуска.
+        """
         self.running = False
+        self._wakeup.set()
+        self._refresh_requested.set()
+        self._catch_up_ready.set()
+        if self._lease_task:
+            self._lease_task.cancel()
+        await wait_tasks(set(self._tasks), timeout, "Задачи планировщика")
+
+        try:
+            await self._save_watermark()
+            await self._flush_slots()
+        finally:
+            await self.shards.release()
     
-    def _get_seconds_until_next_minute(self) -> float:
-        now = datetime.now()
-        next_minute = (now.replace(second=0, microsecond=0) + timedelta(minutes=1))
-        delta = (next_minute - now).total_seconds()
-        return max(0.1, delta)
-    
-    async def _scheduler_loop(self):
+    async def _lease_loop(self):
         while self.running:
+            await asyncio.sleep(self.shards.lease_ttl / 3)
+            if not self.running:
+                break
             try:
-                await self._check_and_send_notifications()
+                owned = set(self.shards.owned)
+                await self.shards.renew()
+                if self.shards.owned != owned:
+                    self._ready_shards &= self.shards.owned
+                    self._drop_foreign_users()
+                    self._refresh_requested.set()
+                await self._save_watermark()
+                await self._flush_slots()
             except Exception as e:
-                logger.error(f"Ошибка в цикле планировщика: {e}", exc_info=True)
-                await asyncio.sleep(5)
-            
-            sleep_time = self._get_seconds_until_next_minute()
-            await asyncio.sleep(sleep_time)
+                logger.error(f"Ошибка при продлении аренды шардов планировщика: {e}", exc_info=True)
     
-    async def _check_and_send_notifications(self):
-        try:
-            telegram_ids = await token_storage.get_all_telegram_ids()
-            
-            if not telegram_ids:
-                return
-            
-            for telegram_id in telegram_ids:
+    async def _flush_slots(self):
+        """Сохранить изменившиеся слоты пользователей в notification_slots"""
+        while self._dirty_slots:
+            telegram_id, slots = self._dirty_slots.popitem()
+            await token_storage.set_notification_slots(telegram_id, slots)
+    
+    async def _save_watermark(self):
+        """
+        Сохранить отметку для полностью загруженных шардов: все слоты до неё
+        либо отправлены, либо ещё не наступили
+        """
+        if not self._ready_shards:
+            return
+        watermark = time.time()
+        pending = [self._heap[0][0]] if self._heap else []
+        if self._catch_up:
+            pending.append(min(item[0] for item in self._catch_up))
+        if self._in_flight:
+            pending.append(self._in_flight[0][0])
+        if pending:
+            watermark = min(watermark, min(pending) - 0.001)
+        await self.shards.save_watermarks(self._ready_shards, watermark)
+    
+    def _plan_catch_up(self, telegram_id: int, watermark: Optional[float]) -> int:
+        schedule = self._schedules.get(telegram_id)
+        if watermark is None or schedule is None or schedule.dnd:
+            return 0
+
+        now = time.time()
+        after = datetime.fromtimestamp(max(watermark, now - self.catch_up_max_age), pytz.UTC)
+        planned = 0
+        for slot in schedule.notify_times:
+            try:
+                fire_ts, slot_date = next_fire_time(slot, schedule.timezone, after)
+            except ValueError:
+                continue
+            if fire_ts <= now:
+                self._catch_up.append((fire_ts, telegram_id, schedule.generation, slot, slot_date))
+                planned += 1
+        if planned:
+            self._catch_up_ready.set()
+        return planned
+    
+    async def _catch_up_loop(self):
+        while self.running:
+            if not self._catch_up:
+                self._catch_up_ready.clear()
+                await self._catch_up_ready.wait()
+                continue
+
+            fire_ts, telegram_id, generation, slot, slot_date = self._catch_up[0]
+            schedule = self._schedules.get(telegram_id)
+            sent = False
+            if (schedule is not None and schedule.generation == generation
+                    and self.shards.owns(telegram_id) and time.time() - fire_ts <= self.catch_up_max_age):
                 try:
-                    await self._check_user_notifications(telegram_id)
+                    await self._deliver(telegram_id, schedule, slot, slot_date)
+                    sent = True
                 except Exception as e:
-                    logger.error(f"Ошибка при проверке уведомлений для пользователя {telegram_id}: {e}", exc_info=True)
-                    continue
-                    
-        except Exception as e:
-            logger.error(f"Ошибка при проверке уведомлений: {e}", exc_info=True)
+                    logger.error("Ошибка при досылке напоминания пользователю %s: %s", telegram_id, e, exc_info=True)
+            self._catch_up.popleft()
+
+            if sent and self.catch_up_rate > 0:
+                await asyncio.sleep(1 / self.catch_up_rate)
     
-    async def _check_user_notifications(self, telegram_id: int):
+    def _drop_foreign_users(self):
+        for telegram_id in [t for t in self._schedules if not self.shards.owns(t)]:
+            del self._schedules[telegram_id]
+            index = user_registry.find(telegram_id)
+            if index >= 0:
+                self.sent_day[index] = 0
+                self.sent_slots[index] = 0
+    
+    def _on_settings_changed(self, telegram_id: int, settings: Dict[str, Any]):
+        telegram_id = int(telegram_id)
+        if not self.running or not self.shards.owns(telegram_id):
+            return
+        schedule = self._schedules.get(telegram_id)
+        user_data = schedule.user_data if schedule else {}
+        self._apply_settings(telegram_id, settings, user_data)
+    
+    def _apply_settings(self, telegram_id: int, settings: Dict[str, Any], user_data: Dict[str, Any]):
+        notify_times = tuple(sorted(set(settings.get("notify_times") or [])))
+        dnd = bool(settings.get("dnd_enabled", False))
+        timezone_str = settings.get("timezone", "UTC")
         try:
-            user_data = await token_storage.get_user_data(telegram_id)
-            
-            if not user_data:
-                try:
-                    chat = await self.bot.get_chat(telegram_id)
-                    user_data = {
-                        "username": chat.username,
-                        "first_name": chat.first_name,
-                        "last_name": chat.last_name,
-                        "photo_url": None
-                    }
-                except Exception as e:
-                    logger.error(f"Не удалось получить данные пользователя {telegram_id} из Telegram API: {e}")
-                    return
-            
-            settings = None
+            user_tz = pytz.timezone(timezone_str)
+        except pytz.exceptions.UnknownTimeZoneError:
+            logger.warning("Неизвестный часовой пояс %s для пользователя %s, используем UTC", timezone_str, telegram_id)
+            user_tz = pytz.UTC
+
+        schedule = self._schedules.get(telegram_id)
+        if schedule is not None:
+            schedule.user_data = user_data or schedule.user_data
+            if (schedule.notify_times == notify_times and schedule.timezone is user_tz
+                    and schedule.dnd == dnd):
+                return
+            if schedule.notify_times != notify_times:
+                self._remap_sent_slots(telegram_id, schedule.notify_times, notify_times)
+
+        self._generation += 1
+        schedule = UserSchedule(notify_times, user_tz, dnd, user_data, self._generation)
+        self._schedules[telegram_id] = schedule
+        if dnd or not notify_times:
+            self._dirty_slots[telegram_id] = []
+            return
+
+        now = datetime.now(pytz.UTC)
+        earliest = self._heap[0][0] if self._heap else None
+        slots = []
+        for slot in notify_times:
+            try:
+                fire_ts, slot_date = next_fire_time(slot, user_tz, now)
+            except ValueError:
+                logger.warning("Некорректное время напоминания %s у пользователя %s", slot, telegram_id)
+                continue
+            heapq.heappush(self._heap, (fire_ts, telegram_id, schedule.generation, slot, slot_date))
+            slots.append((slot, int(fire_ts) // 60 % MINUTES_PER_DAY))
+        self._dirty_slots[telegram_id] = slots
+
+        if earliest is None or self._heap[0][0] < earliest:
+            self._wakeup.set()
+    
+    def _remap_sent_slots(self, telegram_id: int, old_times: Tuple[str, ...], new_times: Tuple[str, ...]):
+        """Перенести отметки отправленных слотов на позиции слотов в новом notify_times"""
+        index = user_registry.find(telegram_id)
+        if index < 0 or not self.sent_slots[index]:
+            return
+        sent = self.sent_slots[index]
+        mask = 0
+        for position, slot in enumerate(new_times[:64]):
+            try:
+                old_position = old_times.index(slot)
+            except ValueError:
+                continue
+            if old_position < 64 and sent & (1 << old_position):
+                mask |= 1 << position
+        self.sent_slots[index] = mask
+
+    async def _refresh_loop(self):
+        while self.running:
             try:
-                settings_data = await api.get("/telegram/settings", params={
-                    "telegram_id": telegram_id,
-                    "username": user_data.get("username"),
-                    "first_name": user_data.get("first_name"),
-                    "last_name": user_data.get("last_name"),
-                    "photo_url": user_data.get("photo_url")
-                })
-                settings = settings_data.get("settings", {})
+                await self._refresh_schedules()
             except Exception as e:
-                error_msg = str(e)
-                if "401" in error_msg or "Unauthorized" in error_msg:
-                    try:
-                        from utils.helpers import get_user_photo_url
-                        photo_url = await get_user_photo_url(self.bot, telegram_id)
-                        auth_data = await api.register_telegram_user(
-                            telegram_id=telegram_id,
-                            username=user_data.get("username"),
-                            first_name=user_data.get("first_name"),
-                            last_name=user_data.get("last_name"),
-                            photo_url=photo_url
-                        )
-                        tokens = auth_data.get("tokens", {})
-                        access_token = tokens.get("access_token")
-                        refresh_token = tokens.get("refresh_token")
-                        user_id = auth_data.get("user", {}).get("id")
-                        
-                        if access_token and refresh_token:
-                            await token_storage.save_tokens(
-                                telegram_id=telegram_id,
-                                access_token=access_token,
-                                refresh_token=refresh_token,
-                                user_id=user_id,
-                                username=user_data.get("username"),
-                                first_name=user_data.get("first_name"),
-                                last_name=user_data.get("last_name"),
-                                photo_url=photo_url
-                            )
-                            
-                            try:
-                                settings_data = await api.get("/telegram/settings", params={
-                                    "telegram_id": telegram_id,
-                                    "username": user_data.get("username"),
-                                    "first_name": user_data.get("first_name"),
-                                    "last_name": user_data.get("last_name"),
-                                    "photo_url": photo_url
-                                })
-                                settings = settings_data.get("settings", {})
-                            except Exception as settings_error:
-                                logger.error(f"Пользователь {telegram_id}: не удалось получить настройки после перерегистрации: {settings_error}", exc_info=True)
-                                return
-                        else:
-                            logger.error(f"Пользователь {telegram_id}: не удалось получить токены при перерегистрации")
-                            return
-                    except Exception as reg_error:
-                        logger.error(f"Пользователь {telegram_id}: ошибка при перерегистрации: {reg_error}", exc_info=True)
-                        return
-                else:
-                    logger.error(f"Не удалось получить настройки для пользователя {telegram_id}: {e}", exc_info=True)
-                    return
-            
-            if settings is None:
-                return
-            
-            if settings.get("dnd_enabled", False):
-                return
-            
-            notify_times = settings.get("notify_times", [])
-            if not notify_times:
-                return
-            
-            timezone_str = settings.get("timezone", "UTC")
+                logger.error(f"Ошибка при обновлении расписания напоминаний: {e}", exc_info=True)
+
+            self._refresh_requested.clear()
             try:
-                user_tz = pytz.timezone(timezone_str)
-            except pytz.exceptions.UnknownTimeZoneError:
-                logger.warning(f"Неизвестный часовой пояс {timezone_str} для пользователя {telegram_id}, используем UTC")
-                user_tz = pytz.UTC
-            
-            utc_now = datetime.now(pytz.UTC)
-            user_time = utc_now.astimezone(user_tz)
-            current_time_str = user_time.strftime("%H:%M")
-            current_date = user_time.date()
-            
-            if current_time_str not in notify_times:
-                return
-            
-            last_sent = self.last_sent_notifications.get(telegram_id, {})
-            last_sent_date = last_sent.get(current_time_str)
-            
-            if last_sent_date == current_date:
+                await asyncio.wait_for(self._refresh_requested.wait(), timeout=self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _refresh_schedules(self):
+        owned = set(self.shards.owned)
+        watermarks = await self.shards.get_watermarks() if owned - self._ready_shards else {}
+        catch_up = 0
+        caught_up = set()
+
+        missed_ids = await self._missed_candidates(watermarks)
+        missed = list((await token_storage.get_users_data(missed_ids)).items())
+        for telegram_id, user_data, settings in await self._fetch_settings_batch(missed):
+            if not self.running:
                 return
-            
-            if last_sent_date and last_sent_date < current_date:
-                self.last_sent_notifications[telegram_id] = {}
-            
             try:
-                habits_data = await api.get("/habits/today", params={
-                    "telegram_id": telegram_id,
-                    "username": user_data.get("username"),
-                    "first_name": user_data.get("first_name"),
-                    "last_name": user_data.get("last_name"),
-                    "photo_url": user_data.get("photo_url")
-                })
-                habits = habits_data.get("habits", [])
+                self._apply_settings(telegram_id, settings, user_data)
+                catch_up += self._plan_catch_up(telegram_id, watermarks.get(self.shards.shard_of(telegram_id)))
+                caught_up.add(telegram_id)
             except Exception as e:
-                logger.error(f"Не удалось получить привычки для пользователя {telegram_id}: {e}", exc_info=True)
-                return
-            
-            if not habits:
+                logger.error("Ошибка при досылке напоминаний пользователю %s: %s", telegram_id, e, exc_info=True)
+
+        active = set()
+        batch: List[Tuple[int, Dict[str, Any]]] = []
+
+        async def apply_batch():
+            nonlocal catch_up
+            for telegram_id, user_data, settings in await self._fetch_settings_batch(batch):
+                try:
+                    self._apply_settings(telegram_id, settings, user_data)
+                    shard = self.shards.shard_of(telegram_id)
+                    if shard not in self._ready_shards and telegram_id not in caught_up:
+                        catch_up += self._plan_catch_up(telegram_id, watermarks.get(shard))
+                except Exception as e:
+                    logger.error("Ошибка при обновлении расписания для пользователя %s: %s", telegram_id, e, exc_info=True)
+            batch.clear()
+
+        async for telegram_id, user_data in token_storage.iter_users(USERS_BATCH_SIZE):
+            if not self.running:
                 return
-            
-            await self._send_habits_notification(telegram_id, habits)
-            
-            if telegram_id not in self.last_sent_notifications:
-                self.last_sent_notifications[telegram_id] = {}
-            self.last_sent_notifications[telegram_id][current_time_str] = current_date
-            
+            if not self.shards.owns(telegram_id):
+                continue
+            active.add(telegram_id)
+            batch.append((telegram_id, user_data))
+            if len(batch) >= USERS_BATCH_SIZE:
+                await apply_batch()
+        if batch:
+            await apply_batch()
+        if not self.running:
+            return
+
+        for telegram_id in [t for t in self._schedules if t not in active]:
+            del self._schedules[telegram_id]
+
+        if catch_up:
+            logger.info("Пропущенных напоминаний к досылке: %s", catch_up)
+        self._ready_shards |= owned & self.shards.owned
+        await self._save_watermark()
+        await self._flush_slots()
+    
+    async def _missed_candidates(self, watermarks: Dict[int, float]) -> List[int]:
+        """
+        Пользователи незагруженных шардов, у которых по сохранённым слотам
+        с момента отметки мог быть пропущен слот. Их настройки загружаются
+        до общего обхода, чтобы досылка не ждала его окончания.
+        """
+        shards = [
+            shard for shard in self.shards.owned
+            if shard not in self._ready_shards and shard in watermarks
+        ]
+        if not shards:
+            return []
+
+        now = time.time()
+        since = max(min(watermarks[shard] for shard in shards), now - self.catch_up_max_age)
+        if now - since >= MINUTES_PER_DAY * 60:
+            return []
+        from_minute = int(since) // 60 % MINUTES_PER_DAY
+        to_minute = int(now) // 60 % MINUTES_PER_DAY
+        telegram_ids = await token_storage.get_due_telegram_ids(from_minute, to_minute)
+        return [
+            telegram_id for telegram_id in telegram_ids
+            if self.shards.shard_of(telegram_id) in shards
+        ]
+    
+    async def _scheduler_loop(self):
+        while self.running:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            next_ts = self._heap[0][0]
+            now = time.time()
+            if next_ts > self._prefetched_until and next_ts - now <= self.prefetch_seconds:
+                horizon = now + self.prefetch_seconds
+                spawn(self._prefetch(self._prefetched_until, horizon), name="scheduler-prefetch")
+                self._prefetched_until = horizon
+
+            delay = next_ts - now
+            if next_ts > self._prefetched_until:
+                delay -= self.prefetch_seconds
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._fire_due()
+            except Exception as e:
+                logger.error(f"Ошибка в цикле планировщика: {e}", exc_info=True)
+                await asyncio.sleep(1)
+    
+    async def _fire_due(self):
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        if not due:
+            return
+        self._in_flight = deque(due)
+
+        try:
+            await self._fire_entries(self._in_flight)
+        finally:
+            # Пачка отменена при остановке: неотправленные записи возвращаются в кучу,
+            # чтобы сохранённая отметка не ушла дальше первой из них
+            for entry in self._in_flight:
+                heapq.heappush(self._heap, entry)
+            self._in_flight = deque()
+        await self._save_watermark()
+    
+    async def _prefetch(self, since: float, horizon: float):
+        """Заранее получить привычки и подготовить тексты для слотов в (since, horizon]"""
+        now = time.time()
+        for key in [k for k, (fire_ts, future) in self._prepared.items() if future.done() and fire_ts < now - 60]:
+            del self._prepared[key]
+
+        entries = sorted(
+            entry for entry in self._heap
+            if since < entry[0] <= horizon and self._is_current(entry[1], entry[2])
+        )
+        loop = asyncio.get_running_loop()
+        pending = []
+        for fire_ts, telegram_id, _, slot, slot_date in entries:
+            key = (telegram_id, slot, slot_date)
+            if key not in self._prepared:
+                future = loop.create_future()
+                self._prepared[key] = (fire_ts, future)
+                pending.append((telegram_id, future))
+
+        try:
+            users = {
+                telegram_id: self._schedules[telegram_id].user_data
+                for telegram_id, _ in pending if telegram_id in self._schedules
+            }
+            fetched = await api.fetch_users(list(users.items()), settings=False) if users else {}
+            for telegram_id, future in pending:
+                if not future.done():
+                    future.set_result(self._render_habits(telegram_id, fetched.get(telegram_id, {}).get("habits")))
+        finally:
+            for _, future in pending:
+                if not future.done():
+                    future.set_result(None)
+    
+    def _is_current(self, telegram_id: int, generation: int) -> bool:
+        schedule = self._schedules.get(telegram_id)
+        return schedule is not None and schedule.generation == generation
+    
+    async def _fire_entries(self, due: Deque[Tuple[float, int, int, str, date]]):
+        """Обработать записи по порядку; запись снимается с due, только когда обработана"""
+        while due:
+            fire_ts, telegram_id, generation, slot, slot_date = due[0]
+            schedule = self._schedules.get(telegram_id)
+            if schedule is None or schedule.generation != generation:
+                self._prepared.pop((telegram_id, slot, slot_date), None)
+                due.popleft()
+                continue
+
+            if not self.shards.owns(telegram_id):
+                self._prepared.pop((telegram_id, slot, slot_date), None)
+            elif time.time() - fire_ts > self.catch_up_max_age:
+                self._prepared.pop((telegram_id, slot, slot_date), None)
+                logger.warning("Напоминание %s для пользователя %s устарело и не будет отправлено", slot, telegram_id)
+            else:
+                try:
+                    await self._deliver(telegram_id, schedule, slot, slot_date)
+                except Exception as e:
+                    logger.error("Ошибка при отправке напоминания пользователю %s: %s", telegram_id, e, exc_info=True)
+            due.popleft()
+
+            try:
+                next_ts, next_date = next_fire_time(slot, schedule.timezone, datetime.fromtimestamp(fire_ts, pytz.UTC))
+            except ValueError:
+                logger.warning("Некорректное время напоминания %s у пользователя %s", slot, telegram_id)
+                continue
+            heapq.heappush(self._heap, (next_ts, telegram_id, generation, slot, next_date))
+    
+    async def _deliver(self, telegram_id: int, schedule: UserSchedule, slot: str, slot_date: date):
+        prepared = self._prepared.pop((telegram_id, slot, slot_date), None)
+        index = user_registry.index(telegram_id)
+        day = slot_date.toordinal()
+        position = schedule.notify_times.index(slot) if slot in schedule.notify_times else -1
+        bit = 1 << position if 0 <= position < 64 else 0
+
+        if bit and self.sent_day[index] == day and self.sent_slots[index] & bit:
+            return
+
+        if prepared is not None:
+            text = await prepared[1]
+        else:
+            text = await self._prepare(telegram_id, schedule.user_data)
+        if text is None:
+            return
+
+        await self._send_reminder(telegram_id, text)
+
+        if self.sent_day[index] < day:
+            self.sent_day[index] = day
+            self.sent_slots[index] = bit
+        elif self.sent_day[index] == day:
+            self.sent_slots[index] |= bit
+    
+    async def _prepare(self, telegram_id: int, user_data: Dict[str, Any]) -> Optional[str]:
+        """Текст напоминания или None, если привычек нет или их не удалось получить"""
+        try:
+            habits_data = await api.get("/habits/today", params={
+                "telegram_id": telegram_id,
+                "username": user_data.get("username"),
+                "first_name": user_data.get("first_name"),
+                "last_name": user_data.get("last_name"),
+                "photo_url": user_data.get("photo_url")
+            })
+            habits = habits_data.get("habits", [])
         except Exception as e:
-            logger.error(f"Ошибка при проверке уведомлений для пользователя {telegram_id}: {e}", exc_info=True)
+            habits = e
+        return self._render_habits(telegram_id, habits)
+
+    @staticmethod
+    def _render_habits(telegram_id: int, habits: Any) -> Optional[str]:
+        if isinstance(habits, Exception):
+            logger.error("Не удалось получить привычки для пользователя %s: %s", telegram_id, habits, exc_info=habits)
+            return None
+        if not habits:
+            return None
+        return render_reminder(habits)
+
+    async def _fetch_settings_batch(self, users: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, Dict[str, Any], Dict[str, Any]]]:
+        """
+        Настройки пачки пользователей одним обращением к API
+
+        Returns:
+            Тройки (telegram_id, данные пользователя, настройки) для тех, чьи настройки получены
+        """
+        if not users:
+            return []
+        fetched = await api.fetch_users(users, habits=False)
+        loaded = []
+        for telegram_id, user_data in users:
+            settings = fetched.get(telegram_id, {}).get("settings")
+            if settings is None or isinstance(settings, Exception):
+                settings = await self._recover_settings(telegram_id, user_data, settings or Exception("нет ответа"))
+            if settings is not None:
+                loaded.append((telegram_id, user_data, settings))
+        return loaded
+
+    async def _recover_settings(self, telegram_id: int, user_data: Dict[str, Any], error: Exception) -> Optional[Dict[str, Any]]:
+        """После ошибки авторизации перерегистрировать пользователя и запросить настройки снова"""
+        error_msg = str(error)
+        if not ("401" in error_msg or "Unauthorized" in error_msg):
+            logger.error("Не удалось получить настройки для пользователя %s: %s", telegram_id, error, exc_info=error)
+            return None
+
+        try:
+            from utils.helpers import get_user_photo_url
+            photo_url = await get_user_photo_url(self.bot, telegram_id)
+            auth_data = await api.register_telegram_user(
+                telegram_id=telegram_id,
+                username=user_data.get("username"),
+                first_name=user_data.get("first_name"),
+                last_name=user_data.get("last_name"),
+                photo_url=photo_url
+            )
+            tokens = auth_data.get("tokens", {})
+            access_token = tokens.get("access_token")
+            refresh_token = tokens.get("refresh_token")
+            user_id = auth_data.get("user", {}).get("id")
+
+            if not (access_token and refresh_token):
+                logger.error("Пользователь %s: не удалось получить токены при перерегистрации", telegram_id)
+                return None
+
+            await token_storage.save_tokens(
+                telegram_id=telegram_id,
+                access_token=access_token,
+                refresh_token=refresh_token,
+                user_id=user_id,
+                username=user_data.get("username"),
+                first_name=user_data.get("first_name"),
+                last_name=user_data.get("last_name"),
+                photo_url=photo_url
+            )
+        except Exception as reg_error:
+            logger.error("Пользователь %s: ошибка при перерегистрации: %s", telegram_id, reg_error, exc_info=True)
+            return None
+
+        try:
+            settings_data = await api.get("/telegram/settings", params={
+                "telegram_id": telegram_id,
+                "username": user_data.get("username"),
+                "first_name": user_data.get("first_name"),
+                "last_name": user_data.get("last_name"),
+                "photo_url": photo_url
+            })
+            return settings_data.get("settings", {})
+        except Exception as settings_error:
+            logger.error("Пользователь %s: не удалось получить настройки после перерегистрации: %s", telegram_id, settings_error, exc_info=True)
+            return None
     
-    async def _send_habits_notification(self, telegram_id: int, habits: list):
+    async def _send_reminder(self, telegram_id: int, text: str):
         try:
-            message = self._format_habits_message(habits)
-            keyboard = self._create_habits_keyboard(habits)
-            
             await self.bot.send_message(
                 chat_id=telegram_id,
-                text=message,
-                reply_markup=keyboard
+                text=text,
+                reply_markup=REMINDER_KEYBOARD
             )
             
         except TelegramForbiddenError:
             pass
         except TelegramBadRequest as e:
-            logger.error(f"Ошибка Telegram API при отправке напоминания пользователю {telegram_id}: {e}")
+            logger.error("Ошибка Telegram API при отправке напоминания пользователю %s: %s", telegram_id, e)
         except Exception as e:
-            logger.error(f"Ошибка при отправке напоминания пользователю {telegram_id}: {e}", exc_info=True)
-    
-    def _format_habits_message(self, habits: list) -> str:
-        text = "⏰ Напоминание о привычках:\n\n"
-        
-        completed_habits = [h for h in habits if h.get("completed", False)]
-        pending_habits = [h for h in habits if not h.get("completed", False)]
-        
-        if pending_habits:
-            for habit in pending_habits:
-                emoji = habit.get("emoji", "📌")
-                title = habit.get("name", "Привычка")
-                goal = habit.get("goal", 0)
-                unit = habit.get("unit", "")
-                
-                if unit:
-                    text += f"{emoji} {title} — {goal} {unit}\n"
-                else:
-                    text += f"{emoji} {title}\n"
-        
-        if completed_habits:
-            if pending_habits:
-                text += "\n"
-            text += "✅ Выполнено:\n"
-            for habit in completed_habits:
-                emoji = habit.get("emoji", "📌")
-                title = habit.get("name", "Привычка")
-                text += f"✅ {emoji} {title}\n"
-        
-        text += "\n💪 Ты справишься!"
-        
-        return text
-    
-    def _create_habits_keyboard(self, habits: list) -> InlineKeyboardMarkup:
-        keyboard = []
-        
-        keyboard.append([
-            InlineKeyboardButton(text="📋 Открыть список", callback_data="back_today")
-        ])
-        
-        if habits:
-            keyboard.append([
-                InlineKeyboardButton(text="✅ Отметить все выполненными", callback_data="morning_complete_all")
-            ])
-        
-        return InlineKeyboardMarkup(inline_keyboard=keyboard)
+            logger.error("Ошибка при отправке напоминания пользователю %s: %s", telegram_id, e, exc_info=True)
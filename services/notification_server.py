@@ -1,18 +1,35 @@
+import asyncio
+import hmac
 import logging
+import threading
+from functools import partial
 from aiohttp import web
 from aiogram import Bot
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from typing import Optional
+from config import ADMIN_TOKEN
+from keyboards.factory import cache_stats
+from services.metrics import metrics
+from services import profiler
+from services.token_storage import token_storage
+from services.user_registry import user_registry
+from utils import json_codec
 
 logger = logging.getLogger(__name__)
 
+json_response = partial(web.json_response, dumps=json_codec.dumps)
+
 
 class NotificationServer:
-    def __init__(self, bot: Bot, host: str = "0.0.0.0", port: int = 8080):
+    def __init__(self, bot: Bot, host: str = "0.0.0.0", port: int = 8080, shutdown_timeout: float = 10.0,
+                 admin_token: Optional[str] = ADMIN_TOKEN):
         self.bot = bot
+        self.admin_token = admin_token
+        self._profile_lock = asyncio.Lock()
         self.host = host
         self.port = port
+        self.shutdown_timeout = shutdown_timeout
         self.app = web.Application()
         self._setup_routes()
         self.runner: Optional[web.AppRunner] = None
@@ -21,33 +38,89 @@ class NotificationServer:
     def _setup_routes(self):
         self.app.router.add_post("/notify", self.handle_notify)
         self.app.router.add_get("/health", self.handle_health)
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self.app.router.add_get("/debug/profile", self.handle_profile)
     
     async def handle_health(self, request: web.Request) -> web.Response:
-        return web.json_response({"status": "ok", "service": "telegram-bot-notifications"})
+        return json_response({"status": "ok", "service": "telegram-bot-notifications"})
+    
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """Счётчики и задержки; требует заголовок Authorization: Bearer ADMIN_TOKEN"""
+        if not self._is_admin(request):
+            return json_response({"error": "Forbidden"}, status=403)
+        return json_response({
+            **metrics.snapshot(),
+            "keyboards": cache_stats(),
+            "users": {"count": len(user_registry), "bytes": user_registry.memory_bytes()},
+        })
     
+    def _is_admin(self, request: web.Request) -> bool:
+        if not self.admin_token:
+            return False
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        return hmac.compare_digest(token.encode(), self.admin_token.encode())
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        """
+        Профиль цикла событий за ?seconds= секунд (по умолчанию 10, не больше 60)
+        в виде свёрнутых стеков; требует заголовок Authorization: Bearer ADMIN_TOKEN
+        """
+        if not self._is_admin(request):
+            return json_response({"error": "Forbidden"}, status=403)
+        try:
+            seconds = float(request.query.get("seconds", "10"))
+            interval = float(request.query.get("interval", "0.005"))
+        except ValueError:
+            return json_response({"error": "seconds and interval must be numbers"}, status=400)
+        if not 0 < seconds <= profiler.MAX_PROFILE_SECONDS or not 0.001 <= interval <= 1:
+            return json_response({"error": "seconds must be in (0, 60], interval in [0.001, 1]"}, status=400)
+        if self._profile_lock.locked():
+            return json_response({"error": "Profile already running"}, status=409)
+
+        async with self._profile_lock:
+            logger.info(f"Профилирование цикла событий на {seconds:.0f} с")
+            stacks = await asyncio.to_thread(profiler.sample_stacks, threading.get_ident(), seconds, interval)
+        return web.Response(text=profiler.format_collapsed(stacks), content_type="text/plain")
+
     async def handle_notify(self, request: web.Request) -> web.Response:
         try:
-            data = await request.json()
+            data = await request.json(loads=json_codec.loads)
             
             telegram_id = data.get("telegram_id")
+            user_id = data.get("user_id")
             message = data.get("message")
             
+            if telegram_id is None and user_id is not None:
+                try:
+                    user_id = int(user_id)
+                except (ValueError, TypeError):
+                    return json_response(
+                        {"error": "user_id must be a valid integer"},
+                        status=400
+                    )
+                telegram_id = await token_storage.get_telegram_id_by_user_id(user_id)
+                if telegram_id is None:
+                    return json_response(
+                        {"error": "User not found", "user_id": user_id},
+                        status=404
+                    )
+            
             if telegram_id is None:
-                return web.json_response(
-                    {"error": "telegram_id is required"},
+                return json_response(
+                    {"error": "telegram_id or user_id is required"},
                     status=400
                 )
             
             try:
                 telegram_id = int(telegram_id)
             except (ValueError, TypeError):
-                return web.json_response(
+                return json_response(
                     {"error": "telegram_id must be a valid integer"},
                     status=400
                 )
             
             if not message or not isinstance(message, str) or not message.strip():
-                return web.json_response(
+                return json_response(
                     {"error": "message is required and must be a non-empty string"},
                     status=400
                 )
@@ -64,7 +137,7 @@ class NotificationServer:
                     reply_markup=reply_markup
                 )
                 
-                return web.json_response({
+                return json_response({
                     "success": True,
                     "message_id": sent_message.message_id,
                     "telegram_id": telegram_id
@@ -72,7 +145,7 @@ class NotificationServer:
             
             except TelegramForbiddenError:
                 pass
-                return web.json_response(
+                return json_response(
                     {
                         "error": "User blocked the bot",
                         "telegram_id": telegram_id
@@ -81,7 +154,7 @@ class NotificationServer:
                 )
             except TelegramBadRequest as e:
                 logger.error(f"Ошибка Telegram API при отправке уведомления пользователю {telegram_id}: {e}")
-                return web.json_response(
+                return json_response(
                     {
                         "error": f"Telegram API error: {str(e)}",
                         "telegram_id": telegram_id
@@ -90,7 +163,7 @@ class NotificationServer:
                 )
             except Exception as e:
                 logger.error(f"Ошибка при отправке уведомления пользователю {telegram_id}: {e}", exc_info=True)
-                return web.json_response(
+                return json_response(
                     {
                         "error": f"Failed to send message: {str(e)}",
                         "telegram_id": telegram_id
@@ -100,7 +173,7 @@ class NotificationServer:
         
         except Exception as e:
             logger.error(f"Ошибка при обработке запроса на уведомление: {e}")
-            return web.json_response(
+            return json_response(
                 {"error": f"Invalid request: {str(e)}"},
                 status=400
             )
@@ -142,12 +215,13 @@ class NotificationServer:
         return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
     
     async def start(self):
-        self.runner = web.AppRunner(self.app)
+        self.runner = web.AppRunner(self.app, shutdown_timeout=self.shutdown_timeout)
         await self.runner.setup()
         self.site = web.TCPSite(self.runner, self.host, self.port)
         await self.site.start()
     
     async def stop(self):
+        """Перестать принимать запросы и дождаться уже принятых не дольше shutdown_timeout"""
         if self.site:
             await self.site.stop()
         if self.runner:
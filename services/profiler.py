@@ -0,0 +1,131 @@
+"""
+Профилирование работающего бота без перезапуска.
+
+sample_stacks снимает стек потока цикла событий из отдельного потока через
+sys._current_frames и возвращает свёрнутые стеки (формат flamegraph.pl /
+speedscope: "модуль:функция;...;модуль:функция количество").
+
+LoopWatchdog следит за блокировками цикла событий: корутина-пульс отмечается
+каждые threshold/2 секунды, а поток-наблюдатель при задержке пульса снимает
+стек того, что сейчас выполняется в цикле. Когда цикл освобождается, в лог
+пишется длительность блокировки и снятый стек.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_PROFILE_SECONDS = 60.0
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame) -> str:
+    """Стек от внешнего вызова к текущему в одну строку через ';'"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = 0.005) -> Counter:
+    """
+    Снимать стек потока thread_id каждые interval секунд в течение seconds секунд
+
+    Вызывается в отдельном потоке (asyncio.to_thread), чтобы профилируемый
+    цикл событий продолжал работать.
+
+    Returns:
+        Counter свёрнутых стеков
+    """
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[collapse_stack(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+
+def format_collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class LoopWatchdog:
+    def __init__(self, threshold_ms: float = 100.0):
+        """
+        Детектор медленных колбэков цикла событий
+
+        Args:
+            threshold_ms: Блокировка цикла дольше этого времени записывается в лог (0 — выключено)
+        """
+        self.threshold = threshold_ms / 1000
+        self._beat = time.monotonic()
+        self._stalled_stack: Optional[str] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.threshold <= 0:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-watchdog")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _heartbeat(self):
+        period = self.threshold / 2
+        while True:
+            await asyncio.sleep(period)
+            now = time.monotonic()
+            blocked = now - self._beat - period
+            self._beat = now
+            if blocked >= self.threshold:
+                stack, self._stalled_stack = self._stalled_stack, None
+                logger.warning(
+                    "Цикл событий был заблокирован на %.0f мс; стек во время блокировки: %s",
+                    blocked * 1000, stack or "не снят"
+                )
+            else:
+                self._stalled_stack = None
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            if self._stalled_stack is not None:
+                continue
+            if time.monotonic() - self._beat < self.threshold * 1.5:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._stalled_stack = collapse_stack(frame)
+            del frame
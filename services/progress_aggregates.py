@@ -0,0 +1,363 @@
+"""
+Инкрементальные агрегаты прогресса пользователя.
+
+Для каждой привычки хранится кольцо из RING_DAYS битов за последние дни
+(бит RING_DAYS - 1 — сегодня) и текущая серия. Каждое событие выполнения
+или отмены обновляет одну запись за O(1), а экран прогресса читает готовые
+числа без запроса списка привычек к бэкенду.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import date
+from itertools import islice
+from typing import Optional, Dict, Any, List, Iterable, Set, Tuple
+import aiosqlite
+from config import TOKEN_WRITE_DELAY_MS, TOKEN_WRITE_BATCH
+from services.habit_history import habit_history
+from services.migrations import migrate
+from services.token_storage import token_storage, LOAD_CHUNK
+
+logger = logging.getLogger(__name__)
+
+RING_DAYS = 30
+RING_MASK = (1 << RING_DAYS) - 1
+TODAY_BIT = 1 << (RING_DAYS - 1)
+
+PROGRESS_CACHE_SIZE = 10000
+
+
+class HabitProgress:
+    __slots__ = ("name", "emoji", "day", "bits", "streak", "streak_day")
+
+    def __init__(self, name: str, emoji: str, day: int, bits: int = 0, streak: int = 0, streak_day: int = 0):
+        self.name = name
+        self.emoji = emoji
+        self.day = day
+        self.bits = bits
+        self.streak = streak
+        self.streak_day = streak_day
+
+    def state(self) -> tuple:
+        """Сохраняемые поля записи (без day: сдвиг кольца повторяется при чтении)"""
+        return self.name, self.emoji, self.bits, self.streak, self.streak_day
+
+    def advance(self, today: int):
+        if today > self.day:
+            shift = today - self.day
+            self.bits = self.bits >> shift if shift < RING_DAYS else 0
+            self.day = today
+
+    def apply(self, done: bool, today: int) -> bool:
+        self.advance(today)
+        if done:
+            if self.bits & TODAY_BIT:
+                return False
+            self.bits |= TODAY_BIT
+            if self.streak_day == today - 1:
+                self.streak += 1
+            elif self.streak_day != today:
+                self.streak = 1
+            self.streak_day = today
+        else:
+            if not self.bits & TODAY_BIT:
+                return False
+            self.bits &= ~TODAY_BIT
+            if self.streak_day == today:
+                self.streak -= 1
+                self.streak_day = today - 1 if self.streak else 0
+        return True
+
+    def completed(self, days: int, today: int) -> int:
+        self.advance(today)
+        return bin(self.bits >> (RING_DAYS - days)).count("1")
+
+    def current_streak(self, today: int) -> int:
+        return self.streak if self.streak_day >= today - 1 else 0
+
+
+class ProgressAggregates:
+    """
+    Агрегаты прогресса с отложенной записью, как в HabitHistory: изменения
+    копятся и сохраняются одной транзакцией через write_delay_ms миллисекунд
+    или при накоплении write_batch записей. В памяти остаются не больше
+    max_size давно не использованных пользователей, кроме тех, у кого есть
+    несохранённые изменения.
+    """
+
+    def __init__(self, db_path: str = "data/tokens.db", write_delay_ms: float = 0, write_batch: int = 200,
+                 max_size: int = PROGRESS_CACHE_SIZE):
+        self.db_path = db_path
+        self.write_delay = write_delay_ms / 1000
+        self.write_batch = write_batch
+        self.max_size = max_size
+        self._initialized = False
+        self._cache: "OrderedDict[int, Dict[int, HabitProgress]]" = OrderedDict()
+        # Когда (time.monotonic()) агрегаты пользователя последний раз сверялись с полным списком привычек
+        self._synced: Dict[int, float] = {}
+        self._dirty: Set[Tuple[int, int]] = set()
+        self._deleted: Set[Tuple[int, int]] = set()
+        # Пары (telegram_id, habit_id), которые сейчас записываются в базу
+        self._flushing: Set[Tuple[int, int]] = set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+
+    async def _init_db(self):
+        if self._initialized:
+            return
+
+        await migrate(self.db_path)
+        self._initialized = True
+
+    async def _load_users(self, telegram_ids: Iterable[int]):
+        """Прочитать агрегаты отсутствующих в памяти пользователей одним соединением"""
+        missing = set()
+        for telegram_id in telegram_ids:
+            if telegram_id in self._cache:
+                self._cache.move_to_end(telegram_id)
+            else:
+                missing.add(telegram_id)
+        if not missing:
+            return
+        missing = sorted(missing)
+
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path) as db:
+            for start in range(0, len(missing), LOAD_CHUNK):
+                chunk = missing[start:start + LOAD_CHUNK]
+                cursor = await db.execute(
+                    f"SELECT telegram_id, habit_id, name, emoji, day, bits, streak, streak_day FROM habit_progress "
+                    f"WHERE bot_id = ? AND telegram_id IN ({','.join('?' * len(chunk))})",
+                    (token_storage.bot_id, *chunk)
+                )
+                for row in await cursor.fetchall():
+                    self._cache.setdefault(row[0], {})[row[1]] = HabitProgress(*row[2:])
+
+    def _evict(self):
+        """Вытеснить давно не использованных пользователей сверх max_size, кроме несохранённых"""
+        excess = len(self._cache) - self.max_size
+        if excess <= 0:
+            return
+        pinned = {telegram_id for telegram_id, _ in self._dirty | self._deleted | self._flushing}
+        evicted = list(islice((key for key in self._cache if key not in pinned), excess))
+        for telegram_id in evicted:
+            del self._cache[telegram_id]
+            self._synced.pop(telegram_id, None)
+
+    async def get_user(self, telegram_id: int) -> Optional[Dict[int, HabitProgress]]:
+        """Агрегаты пользователя или None, если пользователь ещё не наблюдался"""
+        await self._load_users([telegram_id])
+        current = self._cache.get(telegram_id)
+        self._evict()
+        return current
+
+    def is_fresh(self, telegram_id: int, max_age: float) -> bool:
+        """Сверялись ли агрегаты с бэкендом не раньше max_age секунд назад"""
+        synced = self._synced.get(telegram_id)
+        return synced is not None and time.monotonic() - synced <= max_age
+
+    async def observe(self, telegram_id: int, habits: List[Dict[str, Any]], changed: Iterable[int] = (),
+                      complete: bool = False):
+        """
+        Обновить агрегаты по привычкам, полученным от бэкенда
+
+        Args:
+            telegram_id: ID пользователя в Telegram
+            habits: Привычки в формате бота
+            changed: habit_id, у которых изменилось выполнение за сегодня
+            complete: habits — полный список привычек пользователя
+        """
+        await self.observe_many([(telegram_id, habits, changed)], complete=complete)
+
+    async def observe_many(self, users: Iterable[Tuple[int, List[Dict[str, Any]], Iterable[int]]],
+                           complete: bool = False):
+        """То же, что observe, для многих пользователей: одно чтение и одна транзакция записи"""
+        users = list(users)
+        await self._load_users(telegram_id for telegram_id, _, _ in users)
+        today = date.today().toordinal()
+        writes = []
+        for telegram_id, habits, changed in users:
+            dirty, removed = await self._apply_habits(telegram_id, habits, set(changed), complete, today)
+            if dirty or removed:
+                writes.append((telegram_id, dirty, removed))
+        self._evict()
+        if writes:
+            await self._store(writes)
+
+    async def _apply_habits(self, telegram_id: int, habits: List[Dict[str, Any]], changed: Set[int],
+                            complete: bool, today: int) -> Tuple[List[int], List[int]]:
+        current = self._cache.get(telegram_id) or {}
+        dirty = []
+        for habit in habits:
+            habit_id = habit.get("id")
+            if habit_id is None:
+                continue
+            habit_id = int(habit_id)
+            done = bool(habit.get("completed", False))
+            progress = current.get(habit_id)
+
+            if progress is None:
+                bits = await habit_history.window(telegram_id, habit_id, RING_DAYS)
+                progress = HabitProgress(habit.get("name", "Привычка"), habit.get("emoji", "📌"), today, bits)
+                current[habit_id] = progress
+                before = None
+            else:
+                progress.advance(today)
+                before = progress.state()
+                if habit_id in changed:
+                    progress.apply(done, today)
+
+            progress.name = habit.get("name", progress.name)
+            progress.emoji = habit.get("emoji", progress.emoji)
+            series = habit.get("streak", 0) or 0
+            if series:
+                progress.streak = series
+                progress.streak_day = today if done else today - 1
+            if progress.state() != before:
+                dirty.append(habit_id)
+
+        removed = []
+        if complete:
+            seen = {int(h.get("id")) for h in habits if h.get("id") is not None}
+            removed = [habit_id for habit_id in current if habit_id not in seen]
+            for habit_id in removed:
+                del current[habit_id]
+
+        self._cache[telegram_id] = current
+        self._cache.move_to_end(telegram_id)
+        if complete:
+            self._synced[telegram_id] = time.monotonic()
+        return dirty, removed
+
+    async def forget(self, telegram_id: int, habit_id: int):
+        current = self._cache.get(telegram_id)
+        if current is not None:
+            current.pop(int(habit_id), None)
+        await self._store([(telegram_id, [], [int(habit_id)])])
+
+    async def _store(self, writes: List[Tuple[int, List[int], List[int]]]):
+        """Запомнить изменённые и удалённые записи и запланировать их сохранение"""
+        for telegram_id, habit_ids, removed in writes:
+            for habit_id in habit_ids:
+                key = (telegram_id, habit_id)
+                self._deleted.discard(key)
+                self._dirty.add(key)
+            for habit_id in removed:
+                key = (telegram_id, habit_id)
+                self._dirty.discard(key)
+                self._deleted.add(key)
+        await self._schedule_flush()
+
+    async def _schedule_flush(self):
+        if not self.write_delay or len(self._dirty) + len(self._deleted) >= self.write_batch:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.write_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при отложенной записи агрегатов прогресса: {e}", exc_info=True)
+
+    async def flush(self):
+        """Сохранить накопленные изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty and not self._deleted:
+                return
+            dirty, self._dirty = self._dirty, set()
+            deleted, self._deleted = self._deleted, set()
+            bot_id = token_storage.bot_id
+            upserts = []
+            for telegram_id, habit_id in dirty:
+                p = self._cache.get(telegram_id, {}).get(habit_id)
+                if p is not None:
+                    upserts.append((bot_id, telegram_id, habit_id, p.name, p.emoji, p.day, p.bits, p.streak, p.streak_day))
+            self._flushing = dirty | deleted
+            try:
+                await self._init_db()
+                async with aiosqlite.connect(self.db_path) as db:
+                    if upserts:
+                        await db.executemany(
+                            '''
+                            INSERT OR REPLACE INTO habit_progress
+                            (bot_id, telegram_id, habit_id, name, emoji, day, bits, streak, streak_day)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ''',
+                            upserts
+                        )
+                    if deleted:
+                        await db.executemany(
+                            "DELETE FROM habit_progress WHERE bot_id = ? AND telegram_id = ? AND habit_id = ?",
+                            [(bot_id, *key) for key in deleted]
+                        )
+                    await db.commit()
+            except Exception:
+                self._deleted |= deleted - self._dirty
+                self._dirty |= dirty - self._deleted
+                raise
+            finally:
+                self._flushing = set()
+            self._evict()
+
+    @staticmethod
+    def from_habits(habits: List[Dict[str, Any]]) -> Dict[int, HabitProgress]:
+        """Агрегаты по сериям из ответа бэкенда, без локальной истории"""
+        today = date.today().toordinal()
+        result = {}
+        for habit in habits:
+            habit_id = habit.get("id")
+            if habit_id is None:
+                continue
+            offset = 0 if habit.get("completed") else 1
+            streak = habit.get("streak", 0) or 0
+            days = min(streak, RING_DAYS - offset)
+            bits = ((1 << days) - 1) << (RING_DAYS - offset - days)
+            result[int(habit_id)] = HabitProgress(habit.get("name", "Привычка"), habit.get("emoji", "📌"), today,
+                                                  bits, streak, today - offset if streak else 0)
+        return result
+
+    @staticmethod
+    def summarize(habits: Dict[int, HabitProgress], total_days: int) -> Dict[str, Any]:
+        today = date.today().toordinal()
+        habits_progress = []
+        total_completed = 0
+        best_streak = None
+        max_streak = 0
+
+        for habit_id, progress in habits.items():
+            completed = progress.completed(total_days, today)
+            habits_progress.append(
+                {
+                    "id": habit_id,
+                    "name": progress.name,
+                    "emoji": progress.emoji,
+                    "completed": completed,
+                    "total": total_days,
+                }
+            )
+            total_completed += completed
+
+            streak = progress.current_streak(today)
+            if streak > max_streak:
+                max_streak = streak
+                best_streak = {
+                    "name": progress.name,
+                    "days": streak,
+                }
+
+        return {
+            "habits": habits_progress,
+            "total": {
+                "completed": total_completed,
+                "total": total_days * len(habits_progress),
+            },
+            "best_streak": best_streak or {"name": "Нет данных", "days": 0},
+        }
+
+
+progress_aggregates = ProgressAggregates(write_delay_ms=TOKEN_WRITE_DELAY_MS, write_batch=TOKEN_WRITE_BATCH)
@@ -0,0 +1,151 @@
+"""
+Распределение пользователей планировщика уведомлений между процессами.
+
+Пользователи делятся на шарды по telegram_id % shard_count. Каждый процесс
+арендует шарды через таблицу аренды в SQLite и периодически продлевает её.
+Если процесс перестаёт продлевать аренду, его шарды забирают остальные.
+Для каждого шарда хранится отметка времени, до которой напоминания уже
+обработаны, — по ней новый владелец досылает пропущенные слоты.
+Аренды, процессы и отметки разделены по bot_id: боты с общей базой
+не делят шарды между собой.
+"""
+import logging
+import math
+import os
+import socket
+import time
+from typing import Optional, Set, Dict, Iterable
+import aiosqlite
+from services.migrations import migrate
+from services.token_storage import token_storage
+
+logger = logging.getLogger(__name__)
+
+
+class ShardLeaseManager:
+    def __init__(self, db_path: str = "data/tokens.db", shard_count: int = 1,
+                 worker_id: Optional[str] = None, lease_ttl: float = 30.0):
+        self.db_path = db_path
+        self.shard_count = max(1, shard_count)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.owned: Set[int] = set()
+        # До какого момента (time.monotonic()) действует аренда, продлённая последним успешным renew()
+        self.owned_until = 0.0
+        self._initialized = False
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+
+    async def _init_db(self):
+        if self._initialized:
+            return
+
+        await migrate(self.db_path)
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO scheduler_leases (bot_id, shard, owner, expires_at) VALUES (?, ?, NULL, 0)",
+                [(token_storage.bot_id, shard) for shard in range(self.shard_count)]
+            )
+            await db.commit()
+            self._initialized = True
+
+    async def renew(self) -> Set[int]:
+        """Продлить свою аренду и захватить свободные шарды в пределах справедливой доли"""
+        await self._init_db()
+        started = time.monotonic()
+        now = time.time()
+        expires_at = now + self.lease_ttl
+        bot_id = token_storage.bot_id
+
+        async with aiosqlite.connect(self.db_path, timeout=self.lease_ttl) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.execute(
+                "INSERT OR REPLACE INTO scheduler_workers (bot_id, worker_id, expires_at) VALUES (?, ?, ?)",
+                (bot_id, self.worker_id, expires_at)
+            )
+            await db.execute("DELETE FROM scheduler_workers WHERE bot_id = ? AND expires_at <= ?", (bot_id, now))
+            cursor = await db.execute("SELECT COUNT(*) FROM scheduler_workers WHERE bot_id = ?", (bot_id,))
+            live_workers = (await cursor.fetchone())[0]
+            fair_share = math.ceil(self.shard_count / max(1, live_workers))
+
+            cursor = await db.execute(
+                "SELECT shard, owner, expires_at FROM scheduler_leases WHERE bot_id = ? AND shard < ? ORDER BY shard",
+                (bot_id, self.shard_count)
+            )
+            rows = await cursor.fetchall()
+            mine = [shard for shard, owner, lease_end in rows if owner == self.worker_id and lease_end > now]
+            free = [shard for shard, owner, lease_end in rows if owner is None or lease_end <= now]
+
+            released = mine[fair_share:]
+            kept = mine[:fair_share]
+            acquired = [shard for shard in free if shard not in mine][:max(0, fair_share - len(kept))]
+
+            if released:
+                await db.executemany(
+                    "UPDATE scheduler_leases SET owner = NULL, expires_at = 0 WHERE bot_id = ? AND shard = ? AND owner = ?",
+                    [(bot_id, shard, self.worker_id) for shard in released]
+                )
+            await db.executemany(
+                "UPDATE scheduler_leases SET owner = ?, expires_at = ? WHERE bot_id = ? AND shard = ?",
+                [(self.worker_id, expires_at, bot_id, shard) for shard in kept + acquired]
+            )
+            await db.commit()
+
+        owned = set(kept + acquired)
+        if owned != self.owned:
+            logger.info(f"Планировщик {self.worker_id}: шарды {sorted(owned)} из {self.shard_count}")
+        self.owned = owned
+        self.owned_until = started + self.lease_ttl
+        return owned
+
+    def shard_of(self, telegram_id: int) -> int:
+        return telegram_id % self.shard_count
+
+    def lease_valid(self) -> bool:
+        """Не истекла ли аренда: если renew() не удаётся, шарды считаются чужими после lease_ttl"""
+        return time.monotonic() < self.owned_until
+
+    def owns(self, telegram_id: int) -> bool:
+        return telegram_id % self.shard_count in self.owned and self.lease_valid()
+
+    async def get_watermarks(self) -> Dict[int, float]:
+        """Отметки обработанного времени по шардам"""
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path, timeout=self.lease_ttl) as db:
+            cursor = await db.execute(
+                "SELECT shard, watermark FROM scheduler_watermarks WHERE bot_id = ?",
+                (token_storage.bot_id,)
+            )
+            rows = await cursor.fetchall()
+        return {shard: watermark for shard, watermark in rows}
+
+    async def save_watermarks(self, shards: Iterable[int], watermark: float):
+        """Сдвинуть отметку обработанного времени вперёд для своих шардов"""
+        shards = [shard for shard in shards if shard in self.owned]
+        if not shards or not self.lease_valid():
+            return
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path, timeout=self.lease_ttl) as db:
+            await db.executemany(
+                '''
+                INSERT INTO scheduler_watermarks (bot_id, shard, watermark) VALUES (?, ?, ?)
+                ON CONFLICT(bot_id, shard) DO UPDATE SET watermark = MAX(watermark, excluded.watermark)
+                ''',
+                [(token_storage.bot_id, shard, watermark) for shard in shards]
+            )
+            await db.commit()
+
+    async def release(self):
+        if not self._initialized:
+            return
+        async with aiosqlite.connect(self.db_path, timeout=self.lease_ttl) as db:
+            await db.execute(
+                "UPDATE scheduler_leases SET owner = NULL, expires_at = 0 WHERE bot_id = ? AND owner = ?",
+                (token_storage.bot_id, self.worker_id)
+            )
+            await db.execute(
+                "DELETE FROM scheduler_workers WHERE bot_id = ? AND worker_id = ?",
+                (token_storage.bot_id, self.worker_id)
+            )
+            await db.commit()
+        self.owned = set()
+        self.owned_until = 0.0
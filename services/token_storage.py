@@ -1,44 +1,104 @@
+import asyncio
 import logging
 import os
-from typing import Optional, Dict
+from typing import Optional, Dict, AsyncIterator, Tuple, Iterable, List, Any
 import aiosqlite
+from config import TOKEN_WRITE_DELAY_MS, TOKEN_WRITE_BATCH
+from services.migrations import migrate
+from services.tracing import span
 
 logger = logging.getLogger(__name__)
 
+# Таблицы со строками, сохранёнными до появления bot_id, и столбец, по которому
+# строка бота считается уже существующей
+LEGACY_TABLES = (
+    ("tokens", "telegram_id"),
+    ("notification_slots", "telegram_id"),
+    ("habit_history", "telegram_id"),
+    ("habit_progress", "telegram_id"),
+    ("scheduler_watermarks", "shard"),
+)
+
+# Не больше стольких telegram_id в одном запросе (ограничение SQLite на число параметров)
+LOAD_CHUNK = 500
+
+TOKEN_FIELDS = ("access_token", "refresh_token", "user_id", "username", "first_name", "last_name", "photo_url")
+
+
+class PendingWrite:
+    """Накопленные изменения строки tokens для одного telegram_id"""
+    __slots__ = ("insert", "fields")
+
+    def __init__(self):
+        self.insert = False
+        self.fields: Dict[str, Any] = {}
+
+    def merge(self, newer: "PendingWrite"):
+        self.insert = self.insert or newer.insert
+        self.fields.update(newer.fields)
+
 
 class TokenStorage:
-    def __init__(self, db_path: str = "data/tokens.db", bot_id: int = 0):
+    """
+    Хранилище токенов и профилей пользователей.
+
+    Записи откладываются (write-behind): изменения одного telegram_id
+    объединяются в памяти и сохраняются одной транзакцией через write_delay_ms
+    миллисекунд или при накоплении write_batch строк. Чтения видят ещё не
+    сохранённые изменения. При write_delay_ms = 0 запись синхронная.
+    """
+
+    def __init__(self, db_path: str = "data/tokens.db", bot_id: int = 0,
+                 write_delay_ms: float = 0, write_batch: int = 200):
         self.db_path = db_path
         self.bot_id = bot_id
+        self.write_delay = write_delay_ms / 1000
+        self.write_batch = write_batch
         self._initialized = False
+        self._pending: Dict[int, PendingWrite] = {}
+        self._flushing: Dict[int, PendingWrite] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
 
     async def _init_db(self):
         if self._initialized:
             return
         
+        await migrate(self.db_path)
+        self._initialized = True
+
+    async def configure(self, bot_id: int):
+        """
+        Привязать хранилище к боту
+
+        Строки, сохранённые до появления bot_id (bot_id = 0), переходят
+        к этому боту, если у него ещё нет записи для того же telegram_id
+        (для отметок планировщика — для того же шарда).
+        """
+        await self.flush()
+        self.bot_id = bot_id
+        await self._init_db()
+        if not bot_id:
+            return
         async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS tokens (
-                    telegram_id INTEGER PRIMARY KEY,
-                    access_token TEXT,
-                    refresh_token TEXT,
-                    user_id INTEGER,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    photo_url TEXT
-                )
-            ''')
+            moved = {}
+            for table, key in LEGACY_TABLES:
+                cursor = await db.execute(f'''
+                    UPDATE {table} SET bot_id = ?
+                    WHERE bot_id = 0 AND {key} NOT IN (SELECT {key} FROM {table} WHERE bot_id = ?)
+                ''', (bot_id, bot_id))
+                moved[table] = cursor.rowcount
             await db.commit()
-            self._initialized = True
+        if moved["tokens"]:
+            logger.info(f"Бот {bot_id}: перенесено {moved['tokens']} записей токенов без bot_id")
 
     async def _get_tokens_data(self, telegram_id: int) -> Optional[Dict]:
         await self._init_db()
-        async with aiosqlite.connect(self.db_path) as db:
+        async with span("storage get_tokens"), aiosqlite.connect(self.db_path) as db:
             cursor = await db.execute(
-                "SELECT access_token, refresh_token, user_id, username, first_name, last_name, photo_url FROM tokens WHERE telegram_id = ?",
-                (telegram_id,)
+                "SELECT access_token, refresh_token, user_id, username, first_name, last_name, photo_url FROM tokens WHERE bot_id = ? AND telegram_id = ?",
+                (self.bot_id, telegram_id)
             )
             row = await cursor.fetchone()
             if row:
@@ -51,56 +111,100 @@ class TokenStorage:
                     "last_name": row[5],
                     "photo_url": row[6]
                 }
-                return tokens_data
-        return None
+                return self._overlay(telegram_id, tokens_data)
+        return self._overlay(telegram_id, None)
+
+    def _overlay(self, telegram_id: int, tokens_data: Optional[Dict]) -> Optional[Dict]:
+        """Наложить на прочитанную строку изменения, ещё не сохранённые в базу"""
+        for layer in (self._flushing, self._pending):
+            write = layer.get(telegram_id)
+            if write is None:
+                continue
+            if tokens_data is None:
+                if not write.insert:
+                    continue
+                tokens_data = dict.fromkeys(TOKEN_FIELDS)
+            tokens_data.update(write.fields)
+        return tokens_data
+
+    async def _enqueue(self, telegram_id: int, write: PendingWrite):
+        current = self._pending.get(telegram_id)
+        if current is None:
+            self._pending[telegram_id] = write
+        else:
+            current.merge(write)
+
+        if not self.write_delay or len(self._pending) >= self.write_batch:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.write_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при отложенной записи токенов: {e}", exc_info=True)
+
+    async def flush(self):
+        """Сохранить все отложенные изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                with span("storage flush"):
+                    await self._write(self._flushing)
+            except Exception:
+                for telegram_id, write in self._pending.items():
+                    self._flushing.setdefault(telegram_id, PendingWrite()).merge(write)
+                self._pending = self._flushing
+                raise
+            finally:
+                self._flushing = {}
+
+    async def _write(self, writes: Dict[int, PendingWrite]):
+        groups: Dict[Tuple[bool, Tuple[str, ...]], List[Tuple]] = {}
+        for telegram_id, write in writes.items():
+            columns = tuple(sorted(write.fields))
+            groups.setdefault((write.insert, columns), []).append(
+                (self.bot_id, telegram_id, *(write.fields[column] for column in columns))
+            )
 
-    async def _save_tokens_data(self, telegram_id: int, tokens_data: Dict):
         await self._init_db()
         async with aiosqlite.connect(self.db_path) as db:
-            access_token = tokens_data.get("access_token")
-            refresh_token = tokens_data.get("refresh_token")
-            user_id = tokens_data.get("user_id")
-            
-            if not access_token or not refresh_token:
-                logger.warning(f"Попытка сохранить неполные токены для telegram_id={telegram_id}")
-            
-            await db.execute('''
-                INSERT OR REPLACE INTO tokens
-                (telegram_id, access_token, refresh_token, user_id, username, first_name, last_name, photo_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                telegram_id,
-                access_token,
-                refresh_token,
-                user_id,
-                tokens_data.get("username"),
-                tokens_data.get("first_name"),
-                tokens_data.get("last_name"),
-                tokens_data.get("photo_url")
-            ))
+            for (insert, columns), rows in groups.items():
+                if insert:
+                    assignments = ", ".join(f"{column} = excluded.{column}" for column in columns)
+                    sql = (
+                        f"INSERT INTO tokens (bot_id, telegram_id, {', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * (len(columns) + 2))}) "
+                        f"ON CONFLICT (bot_id, telegram_id) DO UPDATE SET {assignments}"
+                    )
+                    await db.executemany(sql, rows)
+                else:
+                    assignments = ", ".join(f"{column} = ?" for column in columns)
+                    await db.executemany(
+                        f"UPDATE tokens SET {assignments} WHERE bot_id = ? AND telegram_id = ?",
+                        [(*row[2:], row[0], row[1]) for row in rows]
+                    )
             await db.commit()
 
     async def save_tokens(self, telegram_id: int, access_token: str, refresh_token: str, user_id: Optional[int] = None,
                     username: Optional[str] = None, first_name: Optional[str] = None, last_name: Optional[str] = None,
                     photo_url: Optional[str] = None):
-        tokens_data = await self._get_tokens_data(telegram_id) or {}
+        """Сохранить токены; не переданные поля профиля остаются прежними"""
+        if not access_token or not refresh_token:
+            logger.warning("Попытка сохранить неполные токены для telegram_id=%s", telegram_id)
 
-        tokens_data.update({
-            "access_token": access_token,
-            "refresh_token": refresh_token,
-            "user_id": user_id
-        })
-
-        if username is not None:
-            tokens_data["username"] = username
-        if first_name is not None:
-            tokens_data["first_name"] = first_name
-        if last_name is not None:
-            tokens_data["last_name"] = last_name
-        if photo_url is not None:
-            tokens_data["photo_url"] = photo_url
-
-        await self._save_tokens_data(telegram_id, tokens_data)
+        write = PendingWrite()
+        write.insert = True
+        write.fields.update(access_token=access_token, refresh_token=refresh_token, user_id=user_id)
+        for field, value in (("username", username), ("first_name", first_name),
+                             ("last_name", last_name), ("photo_url", photo_url)):
+            if value is not None:
+                write.fields[field] = value
+        await self._enqueue(telegram_id, write)
 
     async def get_user_data(self, telegram_id: int) -> Dict[str, Optional[str]]:
         tokens = await self.get_tokens(telegram_id)
@@ -113,6 +217,34 @@ class TokenStorage:
             "photo_url": tokens.get("photo_url")
         }
 
+    async def get_users_data(self, telegram_ids: Iterable[int]) -> Dict[int, Dict[str, Optional[str]]]:
+        """То же, что get_user_data, для многих пользователей: один запрос на LOAD_CHUNK id"""
+        telegram_ids = list(dict.fromkeys(telegram_ids))
+        rows: Dict[int, Dict] = {}
+        if telegram_ids:
+            await self._init_db()
+            async with span("storage get_users_data"), aiosqlite.connect(self.db_path) as db:
+                for start in range(0, len(telegram_ids), LOAD_CHUNK):
+                    chunk = telegram_ids[start:start + LOAD_CHUNK]
+                    cursor = await db.execute(
+                        f"SELECT telegram_id, username, first_name, last_name, photo_url FROM tokens "
+                        f"WHERE bot_id = ? AND telegram_id IN ({','.join('?' * len(chunk))})",
+                        (self.bot_id, *chunk)
+                    )
+                    for row in await cursor.fetchall():
+                        rows[row[0]] = dict(zip(("username", "first_name", "last_name", "photo_url"), row[1:]))
+
+        users = {}
+        for telegram_id in telegram_ids:
+            tokens = self._overlay(telegram_id, rows.get(telegram_id))
+            users[telegram_id] = {
+                "username": tokens.get("username"),
+                "first_name": tokens.get("first_name"),
+                "last_name": tokens.get("last_name"),
+                "photo_url": tokens.get("photo_url")
+            } if tokens else {}
+        return users
+
     async def get_tokens(self, telegram_id: int) -> Optional[Dict[str, str]]:
         return await self._get_tokens_data(telegram_id)
 
@@ -129,28 +261,134 @@ class TokenStorage:
         user_id = tokens.get("user_id") if tokens else None
         return int(user_id) if user_id is not None else None
 
+    async def get_telegram_id_by_user_id(self, user_id: int) -> Optional[int]:
+        for layer in (self._pending, self._flushing):
+            for telegram_id, write in layer.items():
+                if write.fields.get("user_id") == user_id:
+                    return telegram_id
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(
+                "SELECT telegram_id FROM tokens WHERE bot_id = ? AND user_id = ? LIMIT 1",
+                (self.bot_id, user_id)
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
     async def update_access_token(self, telegram_id: int, access_token: str):
-        tokens_data = await self._get_tokens_data(telegram_id)
-        if tokens_data:
-            tokens_data["access_token"] = access_token
-            await self._save_tokens_data(telegram_id, tokens_data)
+        write = PendingWrite()
+        write.fields["access_token"] = access_token
+        await self._enqueue(telegram_id, write)
 
     async def update_tokens(self, telegram_id: int, access_token: str, refresh_token: str):
-        tokens_data = await self._get_tokens_data(telegram_id)
-        if tokens_data:
-            tokens_data["access_token"] = access_token
-            tokens_data["refresh_token"] = refresh_token
-            await self._save_tokens_data(telegram_id, tokens_data)
+        write = PendingWrite()
+        write.fields.update(access_token=access_token, refresh_token=refresh_token)
+        await self._enqueue(telegram_id, write)
 
     async def get_all_telegram_ids(self) -> list[int]:
+        await self.flush()
         await self._init_db()
         telegram_ids = []
         async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT telegram_id FROM tokens")
+            cursor = await db.execute("SELECT telegram_id FROM tokens WHERE bot_id = ?", (self.bot_id,))
             rows = await cursor.fetchall()
             for row in rows:
                 telegram_ids.append(row[0])
         return telegram_ids
 
 
-token_storage = TokenStorage()
+    async def count_users(self) -> int:
+        await self.flush()
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute("SELECT COUNT(*) FROM tokens WHERE bot_id = ?", (self.bot_id,))
+            row = await cursor.fetchone()
+        return row[0]
+
+    async def iter_users(self, batch_size: int = 500) -> AsyncIterator[Tuple[int, Dict[str, Optional[str]]]]:
+        """
+        Потоково перебрать пользователей пачками по batch_size строк
+
+        Пачки читаются по первичному ключу (telegram_id > последнего прочитанного),
+        поэтому между пачками соединение не держит блокировку чтения и не мешает
+        сохранению токенов.
+
+        Yields:
+            Пары (telegram_id, данные пользователя как в get_user_data)
+        """
+        await self.flush()
+        await self._init_db()
+        last_id = None
+        while True:
+            async with aiosqlite.connect(self.db_path) as db:
+                if last_id is None:
+                    cursor = await db.execute(
+                        "SELECT telegram_id, username, first_name, last_name, photo_url FROM tokens "
+                        "WHERE bot_id = ? ORDER BY telegram_id LIMIT ?",
+                        (self.bot_id, batch_size)
+                    )
+                else:
+                    cursor = await db.execute(
+                        "SELECT telegram_id, username, first_name, last_name, photo_url FROM tokens "
+                        "WHERE bot_id = ? AND telegram_id > ? ORDER BY telegram_id LIMIT ?",
+                        (self.bot_id, last_id, batch_size)
+                    )
+                rows = await cursor.fetchall()
+
+            for row in rows:
+                yield row[0], {
+                    "username": row[1],
+                    "first_name": row[2],
+                    "last_name": row[3],
+                    "photo_url": row[4]
+                }
+
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+    async def set_notification_slots(self, telegram_id: int, slots: Iterable[Tuple[str, int]]):
+        """
+        Сохранить слоты напоминаний пользователя
+
+        Args:
+            telegram_id: ID пользователя в Telegram
+            slots: Пары (время HH:MM у пользователя, минута суток по UTC)
+        """
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute(
+                "DELETE FROM notification_slots WHERE bot_id = ? AND telegram_id = ?",
+                (self.bot_id, telegram_id)
+            )
+            await db.executemany(
+                "INSERT INTO notification_slots (bot_id, telegram_id, slot, utc_minute) VALUES (?, ?, ?, ?)",
+                [(self.bot_id, telegram_id, slot, utc_minute) for slot, utc_minute in slots]
+            )
+            await db.commit()
+
+    async def get_due_telegram_ids(self, from_minute: int, to_minute: int) -> List[int]:
+        """
+        Пользователи со слотами в интервале минут суток по UTC [from_minute, to_minute]
+
+        Интервал может переходить через полночь (from_minute > to_minute).
+        """
+        await self._init_db()
+        async with aiosqlite.connect(self.db_path) as db:
+            if from_minute <= to_minute:
+                cursor = await db.execute(
+                    "SELECT DISTINCT telegram_id FROM notification_slots "
+                    "WHERE bot_id = ? AND utc_minute BETWEEN ? AND ?",
+                    (self.bot_id, from_minute, to_minute)
+                )
+            else:
+                cursor = await db.execute(
+                    "SELECT DISTINCT telegram_id FROM notification_slots "
+                    "WHERE bot_id = ? AND (utc_minute >= ? OR utc_minute <= ?)",
+                    (self.bot_id, from_minute, to_minute)
+                )
+            rows = await cursor.fetchall()
+        return [row[0] for row in rows]
+
+
+token_storage = TokenStorage(write_delay_ms=TOKEN_WRITE_DELAY_MS, write_batch=TOKEN_WRITE_BATCH)
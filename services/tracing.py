@@ -0,0 +1,106 @@
+"""
+Трассировка обработки обновлений.
+
+Для каждого обновления TracingMiddleware открывает трассу в contextvar, а
+span() внутри обработчика (запросы к бэкенду, методы Telegram, чтение токенов)
+добавляет в неё замер. Длительности всех участков попадают в metrics и видны
+в /metrics как перцентили, а обновления дольше TRACE_SLOW_UPDATE_MS
+записываются в лог целиком, с разбивкой по участкам.
+
+Замер стоит два вызова perf_counter и добавление в список, поэтому трассировка
+остаётся включённой и в продакшене.
+"""
+import logging
+import re
+import time
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+from config import TRACE_SLOW_UPDATE_MS
+from services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+class Trace:
+    __slots__ = ("name", "started", "spans")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+class span:
+    """
+    Замер участка обработки: with span("backend GET /habits"): ...
+
+    Работает и как async with; вне трассы время пишется только в metrics.
+    """
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        finished = time.perf_counter()
+        duration = finished - self.started
+        metrics.observe(self.name, duration)
+        trace = _current.get()
+        if trace is not None:
+            trace.spans.append((self.name, self.started - trace.started, duration))
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+def route(method: str, path: str) -> str:
+    """Имя участка для запроса к бэкенду: числовые идентификаторы в пути заменяются на {id}"""
+    return f"backend {method} {_ID_SEGMENT.sub('/{id}', path.split('?', 1)[0])}"
+
+
+def start_trace(name: str) -> Trace:
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def finish_trace(trace: Trace, slow_ms: float = TRACE_SLOW_UPDATE_MS) -> float:
+    """
+    Завершить трассу: записать длительность обновления и выгрузить медленное в лог
+
+    Returns:
+        Длительность обработки в секундах
+    """
+    duration = time.perf_counter() - trace.started
+    metrics.observe(f"update {trace.name}", duration)
+    if slow_ms and duration * 1000 >= slow_ms:
+        metrics.inc("tracing.slow_updates")
+        logger.warning(
+            "Медленное обновление %s: %.0f мс; участки: %s",
+            trace.name, duration * 1000, _format_spans(trace.spans)
+        )
+    return duration
+
+
+def _format_spans(spans: List[Tuple[str, float, float]]) -> str:
+    if not spans:
+        return "нет"
+    return "; ".join(f"+{offset * 1000:.0f} мс {name} {duration * 1000:.0f} мс" for name, offset, duration in spans)
@@ -0,0 +1,81 @@
+"""
+Компактный реестр пользователей.
+
+Каждому telegram_id выдаётся плотный индекс, а поля пользователей хранятся
+в массивах array по этому индексу: 1–8 байт на поле вместо словаря с
+объектами int/datetime на каждого пользователя. Индекс — отсортированный
+array('q') с бинарным поиском; новые пользователи сначала попадают в
+небольшой словарь и периодически вливаются в массив.
+"""
+from array import array
+from bisect import bisect_left
+from typing import Dict
+
+RECENT_LIMIT = 1024
+
+
+class UserRegistry:
+    def __init__(self):
+        self._ids = array("q")
+        self._indexes = array("l")
+        self._recent: Dict[int, int] = {}
+        self._fields: Dict[str, array] = {}
+        self._defaults: Dict[str, object] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def find(self, telegram_id: int) -> int:
+        """Индекс пользователя или -1, если он ещё не встречался"""
+        pos = bisect_left(self._ids, telegram_id)
+        if pos < len(self._ids) and self._ids[pos] == telegram_id:
+            return self._indexes[pos]
+        return self._recent.get(telegram_id, -1)
+
+    def index(self, telegram_id: int) -> int:
+        """Индекс пользователя; новый пользователь регистрируется со значениями полей по умолчанию"""
+        index = self.find(telegram_id)
+        if index >= 0:
+            return index
+
+        index = self._count
+        self._count += 1
+        self._recent[telegram_id] = index
+        for name, values in self._fields.items():
+            values.append(self._defaults[name])
+        if len(self._recent) >= max(RECENT_LIMIT, len(self._ids) >> 2):
+            self._compact()
+        return index
+
+    def _compact(self):
+        # два уже упорядоченных отрезка: timsort сливает их за линейное время
+        pairs = sorted([*zip(self._ids, self._indexes), *sorted(self._recent.items())])
+        self._ids = array("q", [telegram_id for telegram_id, _ in pairs])
+        self._indexes = array("l", [index for _, index in pairs])
+        self._recent.clear()
+
+    def field(self, name: str, typecode: str, default=0) -> array:
+        """
+        Массив значений поля по индексу пользователя (создаётся при первом обращении)
+
+        Args:
+            name: Имя поля, общее для всех, кто его использует
+            typecode: Тип элементов array ("d", "l", "Q", "B", ...)
+            default: Значение для новых пользователей
+        """
+        values = self._fields.get(name)
+        if values is None:
+            values = array(typecode, [default]) * self._count
+            self._fields[name] = values
+            self._defaults[name] = default
+        return values
+
+    def memory_bytes(self) -> int:
+        """Примерный объём данных реестра в байтах"""
+        size = self._ids.itemsize * len(self._ids) + self._indexes.itemsize * len(self._indexes)
+        size += len(self._recent) * 100
+        return size + sum(values.itemsize * len(values) for values in self._fields.values())
+
+
+user_registry = UserRegistry()
@@ -0,0 +1,59 @@
+"""
+JSON-кодек для ответов бэкенда, HTTP сервера уведомлений и Telegram API
+
+Использует orjson или ujson, если они установлены, иначе стандартный json.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+if orjson is not None:
+    BACKEND = "orjson"
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS).decode()
+
+elif ujson is not None:
+    BACKEND = "ujson"
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return ujson.loads(data)
+
+    def dumps(obj: Any) -> str:
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return dumps(obj).encode()
+
+else:
+    BACKEND = "json"
+    _decoder = json.JSONDecoder()
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def loads(data: Union[str, bytes]) -> Any:
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode()
+        return _decoder.decode(data)
+
+    def dumps(obj: Any) -> str:
+        return _encoder.encode(obj)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode()
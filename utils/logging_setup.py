@@ -0,0 +1,108 @@
+"""
+Настройка логирования вне цикла событий
+
+Обработчики логгеров только кладут запись в очередь (QueueHandler), а
+форматирование и запись в stdout выполняет поток QueueListener. Сообщения
+лучше передавать с %-аргументами (logger.info("... %s", value)): строка
+собирается уже в потоке записи.
+
+Частые однотипные сообщения по пользователям можно прореживать:
+logger.info("...", value, extra={"sample": 100}) пропустит в лог первое
+и каждое сотое сообщение с тем же шаблоном. Прореживаются только DEBUG и
+INFO: предупреждения и ошибки пишутся всегда.
+"""
+import atexit
+import logging
+import queue
+import sys
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from utils import json_codec
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[QueueListener] = None
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает первое и каждое N-е сообщение DEBUG/INFO с одинаковым шаблоном, если у записи задан sample=N"""
+
+    def __init__(self):
+        super().__init__()
+        self.counts: Counter = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample", None)
+        if not rate or rate <= 1 or record.levelno > logging.INFO:
+            return True
+        key = (record.name, record.msg)
+        count = self.counts[key]
+        self.counts[key] = count + 1
+        return count % rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json_codec.dumps(entry)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: str = "INFO", fmt: str = "text", stream=None) -> QueueListener:
+    """
+    Направить корневой логгер через очередь в поток записи
+
+    Args:
+        level: Уровень логирования
+        fmt: "text" или "json"
+        stream: Поток вывода (по умолчанию stdout)
+
+    Returns:
+        Запущенный QueueListener; останавливается автоматически при выходе
+    """
+    global _listener
+    if _listener is not None:
+        stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Дописать оставшиеся в очереди записи и остановить поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,105 @@
+"""
+Пропуск неизменившихся редактирований сообщений
+
+Для каждого сообщения (chat_id, message_id) запоминается хэш последнего
+отрисованного ботом содержимого (текст, parse_mode, клавиатура) и отпечаток
+сообщения, каким его вернул Telegram. Если при следующем нажатии сообщение
+не менялось (отпечаток call.message совпадает) и новое содержимое даёт тот же
+хэш, запрос editMessageText не отправляется.
+"""
+from collections import OrderedDict
+from typing import Optional, Tuple
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, Message
+from services.metrics import metrics
+
+RENDER_CACHE_SIZE = 10000
+
+
+def markup_key(markup: Optional[InlineKeyboardMarkup]) -> tuple:
+    if not isinstance(markup, InlineKeyboardMarkup):
+        return ()
+    return tuple(
+        tuple((button.text, button.callback_data, button.url) for button in row)
+        for row in markup.inline_keyboard
+    )
+
+
+def message_state(message: Message) -> int:
+    """Отпечаток сообщения в том виде, в котором его видит Telegram"""
+    return hash((message.text, markup_key(message.reply_markup)))
+
+
+class RenderCache:
+    def __init__(self, max_size: int = RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._renders: "OrderedDict[Tuple[int, int], Tuple[int, int]]" = OrderedDict()
+
+    @staticmethod
+    def _key(message: Message) -> Tuple[int, int]:
+        return message.chat.id, message.message_id
+
+    def is_current(self, message: Message, render: int) -> bool:
+        cached = self._renders.get(self._key(message))
+        return cached is not None and cached == (render, message_state(message))
+
+    def remember(self, message: Message, render: int):
+        key = self._key(message)
+        self._renders[key] = (render, message_state(message))
+        self._renders.move_to_end(key)
+        if len(self._renders) > self.max_size:
+            self._renders.popitem(last=False)
+
+    def forget(self, message: Message):
+        self._renders.pop(self._key(message), None)
+
+
+render_cache = RenderCache()
+
+
+def render_hash(text: str, reply_markup: Optional[InlineKeyboardMarkup], parse_mode: Optional[str]) -> int:
+    return hash((text, parse_mode, markup_key(reply_markup)))
+
+
+def remember_sent(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                  parse_mode: Optional[str] = None):
+    """Запомнить содержимое только что отправленного сообщения"""
+    render_cache.remember(message, render_hash(text, reply_markup, parse_mode))
+
+
+async def edit_text(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                    parse_mode: Optional[str] = None) -> bool:
+    """
+    Отредактировать сообщение, если его содержимое действительно меняется
+
+    Args:
+        message: Редактируемое сообщение (call.message)
+        text: Новый текст
+        reply_markup: Новая inline-клавиатура
+        parse_mode: Режим разметки текста
+
+    Returns:
+        True, если сообщение изменено; False, если содержимое уже такое же
+    """
+    if not isinstance(message, Message):
+        await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return True
+
+    render = render_hash(text, reply_markup, parse_mode)
+    if render_cache.is_current(message, render):
+        metrics.inc("render_cache.skipped")
+        return False
+
+    try:
+        edited = await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            render_cache.forget(message)
+            raise
+        metrics.inc("render_cache.not_modified")
+        render_cache.remember(message, render)
+        return False
+
+    metrics.inc("render_cache.edited")
+    render_cache.remember(edited if isinstance(edited, Message) else message, render)
+    return True